@@ -119,9 +119,16 @@ random_field_order_flag=''
 if [[ $random_field_order = *"True"* ]]; then
     random_field_order_flag="--random_field_order"
 fi
+launcher="python3"
+distributed_flag=''
+if [[ -n $num_processes ]] && [[ $num_processes -gt 1 ]]; then
+    launcher="torchrun --nproc_per_node=$num_processes"
+    distributed_flag="--distributed"
+fi
 
-cmd="python3 -m src.experiments \
+cmd="$launcher -m src.experiments \
     $exp \
+    $distributed_flag \
     --data_dir $data_dir \
     --db_dir $db_dir \
     --dataset_name $dataset_name \
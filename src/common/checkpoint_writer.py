@@ -0,0 +1,163 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Background checkpoint writer.
+"""
+
+import glob
+import os
+import queue
+import re
+import shutil
+import threading
+
+import torch
+
+
+def to_cpu(x):
+    """
+    Recursively copy all tensors in a (nested) state dict to host memory, so that the copy is not affected by the
+    parameter updates that follow.
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().to('cpu', copy=True)
+    elif isinstance(x, dict):
+        return type(x)((k, to_cpu(v)) for k, v in x.items())
+    elif isinstance(x, list):
+        return [to_cpu(v) for v in x]
+    elif isinstance(x, tuple):
+        return tuple(to_cpu(v) for v in x)
+    else:
+        return x
+
+
+def atomic_torch_save(obj, path):
+    tmp_path = '{}.tmp'.format(path)
+    try:
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_copyfile(src, dst):
+    tmp_path = '{}.tmp'.format(dst)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_write_text(text, path):
+    tmp_path = '{}.tmp'.format(path)
+    try:
+        with open(tmp_path, 'w') as o_f:
+            o_f.write(text)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class CheckpointWriter(object):
+    """
+    Write checkpoints off the training thread.
+
+    The caller snapshots the checkpoint to host memory (which is the only part that blocks training) and a single
+    background thread serializes it. Every file is first written to a temporary path and then renamed, hence a crash
+    in the middle of a write never leaves a truncated checkpoint behind.
+
+    Retention policy: the best model is always kept; of the periodic checkpoint-<id>.tar files, only the last
+    keep_last_k are kept (keep_last_k = 0 keeps all).
+    """
+    def __init__(self, model_dir, keep_last_k=0, synchronous=False):
+        self.model_dir = model_dir
+        self.keep_last_k = keep_last_k
+        self.synchronous = synchronous
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = None
+
+    def submit(self, jobs):
+        """
+        :param jobs: list of (function, args) pairs to be executed in order.
+        """
+        self.check_error()
+        if self.synchronous:
+            self.run(jobs)
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+        self.queue.put(jobs)
+
+    def save(self, checkpoint_dict, checkpoint_id, is_best=False, best_path=None, save_periodic=True,
+             text_files=None):
+        """
+        :param checkpoint_dict: checkpoint whose tensors are already on the host.
+        :param checkpoint_id: index of the periodic checkpoint.
+        :param is_best: if set, (also) write the checkpoint to best_path.
+        :param save_periodic: if set, write the checkpoint to checkpoint-<checkpoint_id>.tar.
+        :param text_files: list of (text, path) pairs written alongside the checkpoint.
+        """
+        jobs = []
+        out_tar = os.path.join(self.model_dir, 'checkpoint-{}.tar'.format(checkpoint_id))
+        if save_periodic:
+            jobs.append((atomic_torch_save, (checkpoint_dict, out_tar)))
+            jobs.append((print, ('=> saving checkpoint to \'{}\''.format(out_tar),)))
+            jobs.append((self.apply_retention_policy, ()))
+        if is_best:
+            if save_periodic:
+                jobs.append((atomic_copyfile, (out_tar, best_path)))
+            else:
+                jobs.append((atomic_torch_save, (checkpoint_dict, best_path)))
+            jobs.append((print, ('=> best model updated \'{}\''.format(best_path),)))
+        for text, path in (text_files or []):
+            jobs.append((atomic_write_text, (text, path)))
+        self.submit(jobs)
+
+    def worker(self):
+        while True:
+            jobs = self.queue.get()
+            try:
+                if self.error is None:
+                    self.run(jobs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def run(self, jobs):
+        for fun, fun_args in jobs:
+            fun(*fun_args)
+
+    def apply_retention_policy(self):
+        if self.keep_last_k <= 0:
+            return
+        checkpoints = []
+        for path in glob.glob(os.path.join(self.model_dir, 'checkpoint-*.tar')):
+            match = re.match(r'checkpoint-(\d+)\.tar$', os.path.basename(path))
+            if match:
+                checkpoints.append((int(match.group(1)), path))
+        for _, path in sorted(checkpoints)[:-self.keep_last_k]:
+            os.remove(path)
+            print('=> checkpoint \'{}\' removed'.format(path))
+
+    def wait(self):
+        """
+        Block until all submitted checkpoints are on disk.
+        """
+        if self.thread is not None:
+            self.queue.join()
+        self.check_error()
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Background checkpoint write failed: {}'.format(error))
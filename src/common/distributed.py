@@ -0,0 +1,100 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Multi-process distributed data parallel utilities.
+
+ Processes are expected to be launched with torchrun (or torch.distributed.launch), which sets the RANK,
+ LOCAL_RANK and WORLD_SIZE environment variables:
+
+    torchrun --nproc_per_node=4 -m src.experiments --train --distributed --dist_backend gloo ...
+"""
+
+import contextlib
+import datetime
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+import src.common.ops as ops
+
+
+def init_distributed(args):
+    """
+    Join the process group and record rank information on args.
+    """
+    args.rank = int(os.environ.get('RANK', 0))
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
+    if args.dist_backend == 'nccl':
+        assert(torch.cuda.is_available())
+    dist.init_process_group(backend=args.dist_backend, init_method=args.dist_init_method,
+                            world_size=args.world_size, rank=args.rank,
+                            timeout=datetime.timedelta(minutes=args.dist_timeout))
+    print('=> process group initialized: rank {}/{}, backend = {}'.format(
+        args.rank, args.world_size, args.dist_backend))
+
+
+def wrap_model(mdl, args):
+    device_ids = [args.device.index] if args.device.type == 'cuda' else None
+    return DistributedDataParallel(mdl, device_ids=device_ids, output_device=device_ids[0] if device_ids else None,
+                                   find_unused_parameters=True)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def shard(examples):
+    """
+    Split a list of examples into disjoint, near equal-sized per-rank shards.
+    """
+    if not is_distributed():
+        return examples
+    return examples[get_rank()::get_world_size()]
+
+
+def all_reduce_mean(value):
+    """
+    Average a python scalar across ranks.
+    """
+    if not is_distributed():
+        return value
+    t = torch.tensor([float(value)], dtype=torch.float64, device=ops.device)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return float(t) / get_world_size()
+
+
+def maybe_no_sync(ddp_mdl, sync):
+    """
+    Skip the gradient all-reduce on micro-steps that only accumulate gradients locally.
+    """
+    if ddp_mdl is None or sync:
+        return contextlib.nullcontext()
+    return ddp_mdl.no_sync()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,171 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Disk cache of the contextualized embeddings computed by a frozen pre-trained transformer.
+"""
+
+import atexit
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import torch
+
+import src.common.ops as ops
+
+
+class EncoderFeatureCache(object):
+    """
+    Cache of the last hidden layer of a frozen transformer encoder (TransformerHiddens), keyed by the exact input
+    token id sequence.
+
+    The hidden states of all cached sequences are appended to a single binary file which is read memory-mapped; an
+    index maps each key to its row range in the file. The cache lives in a sub-directory named after a fingerprint of
+    the transformer weights, hence loading a different transformer checkpoint automatically switches to a new cache.
+
+    The cached features are computed with the transformer in eval mode, i.e. the dropout inside the transformer is
+    not applied, as in the uncached forward pass of a frozen TransformerHiddens; the TransformerHiddens output dropout
+    is still applied on top of the cached features.
+    """
+    def __init__(self, cache_root_dir, half_precision=False, rank=0, flush_interval=1000):
+        self.cache_root_dir = cache_root_dir
+        self.dtype = np.float16 if half_precision else np.float32
+        self.rank = rank
+        self.flush_interval = flush_interval
+
+        self.param_versions = None
+        self.cache_dir = None
+        self.data_path = None
+        self.index_path = None
+        self.hidden_dim = None
+        self.index = dict()
+        self.num_rows = 0
+        self.data_file = None
+        self.data = None
+        self.num_unflushed = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        atexit.register(self.flush)
+
+    def __call__(self, trans_hiddens, inputs, input_masks, segments=None, position_ids=None):
+        """
+        :param trans_hiddens: TransformerHiddens module.
+        :param inputs: [batch_size, seq_len]
+        :param input_masks: [batch_size, seq_len], True for padding positions.
+        :return: [batch_size, seq_len, hidden_dim] transformer last hidden states with dropout applied.
+        """
+        self.check_signature(trans_hiddens)
+        batch_size, seq_len = inputs.size()
+        seq_lens = (~input_masks).long().sum(dim=1).tolist()
+        inputs_cpu = inputs.cpu().numpy()
+        keys = [hashlib.sha1(inputs_cpu[i, :seq_lens[i]].astype(np.int64).tobytes()).hexdigest()
+                for i in range(batch_size)]
+
+        hiddens = ops.zeros_var([batch_size, seq_len, self.hidden_dim], device=inputs.device)
+        miss_ids = []
+        for i, key in enumerate(keys):
+            features = self.lookup(key)
+            if features is None:
+                miss_ids.append(i)
+            else:
+                hiddens[i, :seq_lens[i]] = torch.from_numpy(features.astype(np.float32)).to(hiddens.device)
+        self.num_hits += batch_size - len(miss_ids)
+        self.num_misses += len(miss_ids)
+
+        if miss_ids:
+            miss_idx = ops.long_var(miss_ids, device=inputs.device)
+            max_miss_len = max(seq_lens[i] for i in miss_ids)
+            miss_segments = segments[miss_idx, :max_miss_len] if segments is not None else None
+            miss_position_ids = position_ids[miss_idx, :max_miss_len] if position_ids is not None else None
+            was_training = trans_hiddens.trans_parameters.training
+            trans_hiddens.trans_parameters.eval()
+            with torch.no_grad():
+                miss_hiddens = trans_hiddens.encode(inputs[miss_idx, :max_miss_len],
+                                                    input_masks[miss_idx, :max_miss_len],
+                                                    segments=miss_segments, position_ids=miss_position_ids)
+            trans_hiddens.trans_parameters.train(was_training)
+            hiddens[miss_idx, :max_miss_len] = miss_hiddens.float()
+            miss_hiddens_cpu = miss_hiddens.cpu().numpy()
+            for j, i in enumerate(miss_ids):
+                self.add(keys[i], miss_hiddens_cpu[j, :seq_lens[i]])
+
+        return trans_hiddens.dropout(hiddens)
+
+    def lookup(self, key):
+        if key not in self.index:
+            return None
+        start, end = self.index[key]
+        if self.data is None or end > self.data.shape[0]:
+            self.data_file.flush()
+            self.data = np.memmap(self.data_path, dtype=self.dtype, mode='r', shape=(self.num_rows, self.hidden_dim))
+        return self.data[start:end]
+
+    def add(self, key, features):
+        self.data_file.write(features.astype(self.dtype).tobytes())
+        self.index[key] = (self.num_rows, self.num_rows + len(features))
+        self.num_rows += len(features)
+        self.num_unflushed += 1
+        if self.num_unflushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Make the cache persistent. The index is written after the features it refers to and replaced atomically.
+        """
+        if self.data_file is None or self.num_unflushed == 0:
+            return
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+        tmp_path = '{}.tmp'.format(self.index_path)
+        with open(tmp_path, 'wb') as o_f:
+            pickle.dump((self.hidden_dim, self.num_rows, self.index), o_f)
+        os.replace(tmp_path, self.index_path)
+        self.num_unflushed = 0
+
+    def check_signature(self, trans_hiddens):
+        """
+        (Re)open the cache if the transformer parameters were modified since the last call, e.g. by loading a
+        checkpoint. Parameter version counters are compared first, so the weights are only fingerprinted when they
+        may have changed.
+        """
+        params = list(trans_hiddens.trans_parameters.parameters())
+        param_versions = [p._version for p in params]
+        if param_versions == self.param_versions:
+            return
+        self.flush()
+        if self.data_file is not None:
+            self.data_file.close()
+
+        fingerprint = hashlib.sha1(trans_hiddens.model.encode('utf-8'))
+        for p in params:
+            fingerprint.update(p.detach().cpu().numpy().tobytes())
+        self.cache_dir = os.path.join(self.cache_root_dir, '{}.{}.{}'.format(
+            trans_hiddens.model, fingerprint.hexdigest()[:16], np.dtype(self.dtype).name))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.data_path = os.path.join(self.cache_dir, 'features.{}.bin'.format(self.rank))
+        self.index_path = os.path.join(self.cache_dir, 'index.{}.pkl'.format(self.rank))
+
+        self.hidden_dim = trans_hiddens.trans_parameters.config.hidden_size
+        self.index, self.num_rows = dict(), 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                hidden_dim, self.num_rows, self.index = pickle.load(f)
+            assert(hidden_dim == self.hidden_dim)
+        # Discard the features appended after the last index update
+        with open(self.data_path, 'ab') as o_f:
+            o_f.truncate(self.num_rows * self.hidden_dim * np.dtype(self.dtype).itemsize)
+        self.data_file = open(self.data_path, 'ab')
+        self.data = None
+        self.num_unflushed = 0
+        self.param_versions = param_versions
+        print('=> encoder feature cache: {} ({} sequences cached)'.format(self.cache_dir, len(self.index)))
+
+    def hit_rate(self):
+        num_lookups = self.num_hits + self.num_misses
+        return float(self.num_hits) / num_lookups if num_lookups > 0 else 0.0
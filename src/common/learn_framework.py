@@ -11,19 +11,21 @@ import copy
 import functools
 import numpy as np
 import os
-import pickle
 import random
-import shutil
 from tqdm import tqdm
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 
+from src.common.checkpoint_writer import CheckpointWriter, atomic_torch_save, to_cpu
+from src.common.restored_sql_cache import RestoredSQLCache
+import src.common.distributed as dist
 import src.common.lr_scheduler as lrs
+from src.common.step_profiler import StepProfiler, print_sink
 from src.common.nn_visualizer import LayerVisualizationDataWriter
 from src.data_processor.processor_utils import WIKISQL, SPIDER
-from src.data_processor.path_utils import get_wandb_group, get_wandb_tag, get_no_join_tag
+from src.data_processor.path_utils import get_wandb_group, get_wandb_tag, get_no_join_tag, get_model_subdir
 import src.data_processor.tokenizers as tok
 import src.eval.eval_tools as eval_tools
 import src.eval.eval_utils as eval_utils
@@ -47,6 +49,18 @@ learning_rate_scheduler_sigs = {
 }
 
 
+def load_torch_file(input_file):
+    """
+    Load a checkpoint file memory-mapped, so that tensors are paged in from disk only when they are read (e.g. the
+    optimizer states of a training checkpoint are never read at inference time).
+    """
+    try:
+        return torch.load(input_file, map_location='cpu', mmap=True, weights_only=False)
+    except (RuntimeError, TypeError):
+        # Legacy (non-zip) serialization format or PyTorch version without mmap support
+        return torch.load(input_file, map_location='cpu')
+
+
 class LFramework(nn.Module):
     """
     Learning framework interface.
@@ -90,8 +104,15 @@ class LFramework(nn.Module):
 
         self.decoding_algorithm = args.decoding_algorithm
         self.beam_size = args.beam_size
+        self.fast_beam_size = args.fast_beam_size
 
         self.save_all_checkpoints = args.save_all_checkpoints
+        self.checkpoint_writer = CheckpointWriter(self.model_dir, keep_last_k=args.num_checkpoints_to_keep,
+                                                  synchronous=args.synchronous_checkpointing)
+
+        # Distributed data parallel replica of self.mdl, created in run_train. It is kept out of the registered
+        # submodules so that state_dict() and checkpoints remain identical to single-process training.
+        object.__setattr__(self, 'ddp_mdl', None)
 
         # Visualization saver
         self.vis_writer = LayerVisualizationDataWriter(log_dir=args.viz_dir)
@@ -103,15 +124,39 @@ class LFramework(nn.Module):
         return 0
 
     def run_train(self, train_data, dev_data):
-        self.print_model_parameters()
-
-        import wandb
-        wandb.init(project='smore-{}-group-{}-final'.format(self.args.dataset_name,
-                                                     get_no_join_tag(self.args, separator_in_front=True)),
-                                                     group=get_wandb_group(self.args),
-                                                     name=get_wandb_tag(self.args))
-        os.environ["WANDB_RUN_GROUP"] = get_wandb_group(self.args)
-        wandb.watch(self)
+        is_main_process = dist.is_main_process()
+        if is_main_process:
+            # The post-processing workers of the dev set inference are forked before wandb and the checkpoint writer
+            # start their threads
+            self.start_post_processor()
+            self.print_model_parameters()
+
+            import wandb
+            wandb.init(project='smore-{}-group-{}-final'.format(self.args.dataset_name,
+                                                         get_no_join_tag(self.args, separator_in_front=True)),
+                                                         group=get_wandb_group(self.args),
+                                                         name=get_wandb_tag(self.args))
+            os.environ["WANDB_RUN_GROUP"] = get_wandb_group(self.args)
+            wandb.watch(self)
+
+        if self.args.distributed:
+            # Each rank trains on a disjoint shard of the data with a per-rank batch of size train_batch_size, hence
+            # the effective batch size is train_batch_size * world_size
+            object.__setattr__(self, 'ddp_mdl', dist.wrap_model(self.mdl, self.args))
+            train_data = dist.shard(train_data)
+            print('Rank {}: {} training examples in shard'.format(dist.get_rank(), len(train_data)))
+
+        # Step time and throughput profiling
+        profiler_sinks = []
+        if is_main_process:
+            profiler_sinks.append(print_sink)
+            profiler_sinks.append(lambda metrics: wandb.log(
+                {'{}/{}'.format(key, self.dataset): value for key, value in metrics.items()}))
+        profiler = StepProfiler(log_interval=self.args.profile_interval, sinks=profiler_sinks,
+                                device=self.device,
+                                trace_start_step=self.args.torch_profiler_start_step,
+                                trace_num_steps=self.args.torch_profiler_num_steps,
+                                trace_dir=os.path.join(self.model_dir, 'profiler'))
 
         if self.args.augment_with_wikisql:
             train_data_, train_data_augment = [], []
@@ -174,9 +219,9 @@ class LFramework(nn.Module):
             # Update model parameters
             self.train()
 
-            for s_id in tqdm(range(num_peek_steps)):
+            for s_id in tqdm(range(num_peek_steps), disable=not is_main_process):
                 step_id = interval_step_id + s_id
-                if self.log_in_wandb(step_id / self.num_accumulation_steps):
+                if is_main_process and self.log_in_wandb(step_id / self.num_accumulation_steps):
                     wandb.log({'learning_rate/{}'.format(self.dataset): self.optim.param_groups[0]['lr']})
                     wandb.log({'fine_tuning_rate/{}'.format(self.dataset): self.optim.param_groups[1]['lr']})
 
@@ -204,35 +249,47 @@ class LFramework(nn.Module):
                     mini_batch += train_data_augment[augment_example_id:augment_batch_end]
                     augment_example_id = augment_batch_end
 
-                formatted_batch = self.format_batch(mini_batch)
-                loss = self.loss(formatted_batch)
-                loss.backward()
+                sync_step = (step_id + 1) % self.num_accumulation_steps == 0
+                with profiler.stage('format_batch'):
+                    formatted_batch = self.format_batch(mini_batch)
+                with dist.maybe_no_sync(self.ddp_mdl, sync_step):
+                    with profiler.stage('forward'):
+                        loss = self.loss(formatted_batch)
+                    with profiler.stage('backward'):
+                        loss.backward()
                 epoch_losses.append(float(loss) * self.num_accumulation_steps)
 
-                if (step_id + 1) % self.num_accumulation_steps == 0:
+                if sync_step:
                     # Gradient clipping
                     if self.grad_norm > 0:
-                        nn.utils.clip_grad_norm_(self.parameters(), self.grad_norm)
-                    # Update learning rate scheduler
-                    self.lr_scheduler.step()
-                    # Update parameters
-                    self.optim.step()
-                    self.optim.zero_grad()
+                        with profiler.stage('clip'):
+                            nn.utils.clip_grad_norm_(self.parameters(), self.grad_norm)
+                    with profiler.stage('optim_step'):
+                        # Update learning rate scheduler
+                        self.lr_scheduler.step()
+                        # Update parameters
+                        self.optim.step()
+                        self.optim.zero_grad()
+                if profiler.enabled:
+                    profiler.step(len(mini_batch), *self.get_batch_token_counts(formatted_batch))
+                else:
+                    profiler.step(len(mini_batch))
 
             # Check training statistics
             if step_id > 0 and (step_id + 1) % num_peek_steps == 0:
-                stdout_msg = 'Step {}: average training loss = {}'.format(
-                    step_id / self.num_accumulation_steps, np.mean(epoch_losses))
-                print(stdout_msg)
-                wandb.log({'cross_entropy_loss/{}'.format(self.dataset): np.mean(epoch_losses)})
+                avg_loss = dist.all_reduce_mean(np.mean(epoch_losses))
+                if is_main_process:
+                    stdout_msg = 'Step {}: average training loss = {}'.format(
+                        step_id / self.num_accumulation_steps, avg_loss)
+                    print(stdout_msg)
+                    wandb.log({'cross_entropy_loss/{}'.format(self.dataset): avg_loss})
                 epoch_losses = []
 
-            # Check model performance
-            if step_id > 0 and (step_id + 1) % num_peek_steps == 0:
+            # Check model performance (evaluation and checkpointing are done by the main process only)
+            if step_id > 0 and (step_id + 1) % num_peek_steps == 0 and is_main_process:
                 self.eval()
                 if self.args.process_sql_in_execution_order:
                     pred_restored_cache = self.load_pred_restored_cache()
-                    pred_restored_cache_size = sum(len(v) for v in pred_restored_cache.values())
                 else:
                     pred_restored_cache = None
                 engine_path = os.path.join(self.args.data_dir, 'dev.db') if self.args.dataset_name == 'wikisql' else None
@@ -258,6 +315,8 @@ class LFramework(nn.Module):
                 if eval_metrics >= best_dev_metrics:
                     best_dev_metrics = eval_metrics
                     self.save_checkpoint(step_id, step_id / num_peek_steps, output_dict['pred_decoded'], is_best=True)
+                elif self.save_all_checkpoints:
+                    self.save_checkpoint(step_id, step_id / num_peek_steps, output_dict['pred_decoded'])
                 if self.args.augment_with_wikisql and (step_id + 1) % (num_peek_steps * 3) == 0:
                     wikisql_output_dict = self.inference(dev_data_augment, inline_eval=True, verbose=False)
                     wikisql_metrics = eval_tools.get_exact_match_metrics(dev_data_augment, wikisql_output_dict['pred_decoded'])
@@ -266,10 +325,17 @@ class LFramework(nn.Module):
                     print('Top-1 exact match: {}'.format(wikisql_metrics['top_1_em']))
                     print('Top-3 exact match: {}'.format(wikisql_metrics['top_3_em']))
                 if self.args.process_sql_in_execution_order:
-                    new_pred_restored_cache_size = sum(len(v) for v in output_dict['pred_restored_cache'].values())
-                    newly_cached_size = new_pred_restored_cache_size - pred_restored_cache_size
-                    if newly_cached_size > 0:
-                        self.save_pred_restored_cache(output_dict['pred_restored_cache'], newly_cached_size)
+                    print('{} sql order restoration newly cached'.format(pred_restored_cache.num_new_entries))
+                    pred_restored_cache.close()
+
+            if step_id > 0 and (step_id + 1) % num_peek_steps == 0:
+                dist.barrier()
+                # Exclude evaluation time from the training throughput statistics
+                profiler.reset()
+
+        # Make sure all checkpoints are on disk before returning
+        self.checkpoint_writer.wait()
+        self.close_post_processor()
 
     def forward(self, *args, **kwargs):
         """
@@ -277,6 +343,18 @@ class LFramework(nn.Module):
         """
         return
 
+    def start_post_processor(self):
+        """
+        Interface.
+        """
+        return
+
+    def close_post_processor(self):
+        """
+        Interface.
+        """
+        return
+
     def inference(self, *args, **kwargs):
         """
         Interface.
@@ -301,6 +379,29 @@ class LFramework(nn.Module):
         """
         return
 
+    def get_batch_token_counts(self, formatted_batch):
+        """
+        Interface.
+        :return: total number of positions and number of padding positions in a formatted mini-batch.
+        """
+        return 0, 0
+
+    @property
+    def forward_mdl(self):
+        """
+        Module that runs the forward pass: the distributed replica during training, self.mdl otherwise.
+        """
+        if self.ddp_mdl is not None and self.training:
+            return self.ddp_mdl
+        return self.mdl
+
+    @property
+    def device(self):
+        """
+        Device the model parameters are allocated on.
+        """
+        return next(self.parameters()).device
+
     def format_batch(self, mini_batch):
         if self.training and self.args.enumerate_ground_truth:
             for example in mini_batch:
@@ -345,65 +446,106 @@ class LFramework(nn.Module):
 
     # --- Data I/O --- #
     def load_pred_restored_cache(self):
+        """
+        Open the execution order restoration cache of the model. New restorations are written to the cache as they
+        are computed.
+        """
         split = 'test' if self.args.test else 'dev'
         pred_restored_cache_path = os.path.join(
-            self.model_dir, '{}.eo.pred.restored.pkl'.format(split))
-        pred_restored_cache = dict()
-        if os.path.exists(pred_restored_cache_path):
-            with open(pred_restored_cache_path, 'rb') as f:
-                pred_restored_cache = pickle.load(f)
-                pred_restored_cache_size = sum([len(pred_restored_cache[k]) for k in pred_restored_cache])
-                print('{} pre-computed prediction order reconstruction cached'.format(pred_restored_cache_size))
+            self.model_dir, '{}.eo.pred.restored.sqlite'.format(split))
+        is_new_cache = not os.path.exists(pred_restored_cache_path)
+        pred_restored_cache = RestoredSQLCache(pred_restored_cache_path, max_size=self.args.pred_restored_cache_size)
+        if is_new_cache:
+            # Import the pickled cache of the model or of the dataset
+            for legacy_cache_path in [os.path.join(self.model_dir, '{}.eo.pred.restored.pkl'.format(split)),
+                                      os.path.join(self.args.data_dir, '{}.eo.pred.restored.pkl'.format(split))]:
+                if os.path.exists(legacy_cache_path):
+                    pred_restored_cache.import_pickle(legacy_cache_path)
+                    break
+        print('{} pre-computed prediction order reconstruction cached'.format(len(pred_restored_cache)))
         return pred_restored_cache
 
-    def save_pred_restored_cache(self, pred_restored_cache, newly_cached_size):
-        split = 'test' if self.args.test else 'dev'
-        pred_restored_cache_path = os.path.join(
-            self.model_dir, '{}.eo.pred.restored.pkl'.format(split))
-        if os.path.exists(pred_restored_cache_path):
-            shutil.copyfile(pred_restored_cache_path, pred_restored_cache_path + '.copy')
-        with open(pred_restored_cache_path, 'wb') as o_f:
-            pickle.dump(pred_restored_cache, o_f)
-            print('{} sql order restoration newly cached'.format(newly_cached_size))
-
     # --- Model checkpoints --- #
 
     def save_checkpoint(self, checkpoint_id, interval_step_id, predictions, loss=None, is_best=False):
         """
         Save model checkpoint.
+
+        Only the snapshot of the model, optimizer and learning rate scheduler states to host memory happens on the
+        calling thread; the files are written by self.checkpoint_writer in the background.
+
         :param checkpoint_id: Model checkpoint index assigned by training loop.
         :param predictions: List of predicted strings.
         :param step_id: Training interval step id.
         :param is_best: if set, the model being saved is the best model on dev set.
         """
         checkpoint_dict = dict()
-        checkpoint_dict['model_state_dict'] = self.state_dict()
+        checkpoint_dict['model_state_dict'] = to_cpu(self.state_dict())
         if self.optim:
-            checkpoint_dict['optimizer_state_dict'] = self.optim.state_dict()
+            checkpoint_dict['optimizer_state_dict'] = to_cpu(self.optim.state_dict())
         if self.lr_scheduler:
-            checkpoint_dict['lr_scheduler_dict'] = self.lr_scheduler.state_dict()
+            checkpoint_dict['lr_scheduler_dict'] = to_cpu(self.lr_scheduler.state_dict())
         checkpoint_dict['interval_step_id'] = interval_step_id
         checkpoint_dict['loss'] = loss
 
-        out_tar = os.path.join(self.model_dir, 'checkpoint-{}.tar'.format(checkpoint_id))
+        best_path = os.path.join(self.model_dir, 'model-best.{}.tar'.format(self.beam_size))
+        text_files = []
         if is_best:
-            best_path = os.path.join(self.model_dir, 'model-best.{}.tar'.format(self.beam_size))
-            if os.path.exists(out_tar):
-                shutil.copyfile(out_tar, best_path)
-            else:
-                torch.save(checkpoint_dict, best_path)
-            print('=> best model updated \'{}\''.format(best_path))
-        else:
-            torch.save(checkpoint_dict, out_tar)
-            print('=> saving checkpoint to \'{}\''.format(out_tar))
+            text_files.append(('{}'.format(checkpoint_id),
+                               os.path.join(self.model_dir, 'best_dev_iteration.{}.dat'.format(self.beam_size))))
+            out_txt = os.path.join(self.model_dir, 'predictions.{}.txt'.format(self.beam_size))
+            text_files.append((''.join('{}\n'.format(pred_sql[0]) for pred_sql in predictions), out_txt))
+        self.checkpoint_writer.save(checkpoint_dict, checkpoint_id, is_best=is_best, best_path=best_path,
+                                    save_periodic=(not is_best or self.save_all_checkpoints), text_files=text_files)
+
+    def save_inference_checkpoint(self, out_path, vocabs, half_precision=False):
+        """
+        Export an inference-only checkpoint: model weights without the optimizer and learning rate scheduler states,
+        plus the vocabularies, hyperparameter signature and tokenizer configuration the weights were trained with.
+        The file contains only tensors and primitive types and is loaded memory-mapped by load_checkpoint.
+        :param out_path: Output file path.
+        :param vocabs: Dictionary of vocabularies used by the model.
+        :param half_precision: If set, store floating point weights in half precision.
+        """
+        state_dict = to_cpu(self.state_dict())
+        if half_precision:
+            for key in state_dict:
+                if state_dict[key].is_floating_point():
+                    state_dict[key] = state_dict[key].half()
+
+        tokenizer_config = dict()
+        if self.tu is not None:
+            tokenizer_config['pretrained_transformer'] = self.args.pretrained_transformer
+            tokenizer_config['tokenizer_class'] = type(self.tu.tokenizer).__name__
+            for key in ['pad_token', 'cls_token', 'sep_token', 'unk_token', 'table_marker', 'field_marker',
+                        'value_marker', 'primary_key_marker', 'asterisk_marker']:
+                tokenizer_config[key] = getattr(self.tu, key)
 
-        with open(os.path.join(self.model_dir, 'best_dev_iteration.{}.dat'.format(self.beam_size)), 'w') as o_f:
-            o_f.write('{}'.format(checkpoint_id))
-        out_txt = os.path.join(self.model_dir, 'predictions.{}.txt'.format(self.beam_size))
-        with open(out_txt, 'w') as o_f:
-            for pred_sql in predictions:
-                o_f.write('{}\n'.format(pred_sql[0]))
-            print('=> Model predictions saved to {}'.format(out_txt))
+        checkpoint_dict = dict()
+        checkpoint_dict['inference_only'] = True
+        checkpoint_dict['model_state_dict'] = state_dict
+        checkpoint_dict['vocabs'] = {
+            key: [(v, v_ent.in_vocab, v_ent.frequency) for v, v_ent in vocab.to_list()]
+            for key, vocab in vocabs.items()
+        }
+        checkpoint_dict['args_signature'] = get_model_subdir(self.args, with_time_stamp=False)
+        checkpoint_dict['args'] = {key: value for key, value in vars(self.args).items()
+                                   if value is None or isinstance(value, (bool, int, float, str))}
+        checkpoint_dict['tokenizer_config'] = tokenizer_config
+        atomic_torch_save(checkpoint_dict, out_path)
+        print('=> inference checkpoint ({}) saved to \'{}\''.format(
+            'fp16' if half_precision else 'fp32', out_path))
+
+    def check_inference_checkpoint(self, checkpoint):
+        args_signature = get_model_subdir(self.args, with_time_stamp=False)
+        if checkpoint['args_signature'] != args_signature:
+            print('Warning: inference checkpoint exported with hyperparameters {}, loaded with {}'.format(
+                checkpoint['args_signature'], args_signature))
+        for key, vocab in [('text', getattr(self, 'in_vocab', None)), ('program', getattr(self, 'out_vocab', None))]:
+            if vocab is not None and key in checkpoint['vocabs'] and \
+                    len(checkpoint['vocabs'][key]) != vocab.full_size:
+                raise ValueError('{} vocabulary size mismatch: checkpoint = {}, model = {}'.format(
+                    key, len(checkpoint['vocabs'][key]), vocab.full_size))
 
     def load_checkpoint(self, input_file):
         """
@@ -414,7 +556,10 @@ class LFramework(nn.Module):
         """
         if os.path.isfile(input_file):
             print('=> loading checkpoint \'{}\''.format(input_file))
-            checkpoint = torch.load(input_file)
+            checkpoint = load_torch_file(input_file)
+            if checkpoint.get('inference_only', False):
+                assert(not self.args.train)
+                self.check_inference_checkpoint(checkpoint)
             self.load_state_dict(checkpoint['model_state_dict'])
             if self.args.train:
                 self.start_step = checkpoint['interval_step_id'] + 1
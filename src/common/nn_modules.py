@@ -61,12 +61,35 @@ class TransformerHiddens(nn.Module):
         self.model = model
         self.dropout = nn.Dropout(dropout)
         self.requires_grad = requires_grad
+        if not requires_grad:
+            for param in self.trans_parameters.parameters():
+                param.requires_grad = False
+
+    def train(self, mode=True):
+        """
+        A frozen transformer stays in eval mode, i.e. the dropout inside the transformer is not applied during
+        training either, so that its outputs are the same with and without the encoder feature cache. The output
+        dropout of this module is still applied in training mode.
+        """
+        super().train(mode)
+        if not self.requires_grad:
+            self.trans_parameters.eval()
+        return self
 
     def forward(self, inputs, input_masks, segments=None, position_ids=None, output_all_encoded_layers=False):
-        last_hidden_states, pooler_output = (self.trans_parameters(
-            inputs, token_type_ids=segments, position_ids=position_ids, attention_mask=(~input_masks)))
+        with torch.set_grad_enabled(self.requires_grad and torch.is_grad_enabled()):
+            last_hidden_states, pooler_output = (self.trans_parameters(
+                inputs, token_type_ids=segments, position_ids=position_ids, attention_mask=(~input_masks)))
         return self.dropout(last_hidden_states), pooler_output
 
+    def encode(self, inputs, input_masks, segments=None, position_ids=None):
+        """
+        :return: last layer hidden states before dropout.
+        """
+        last_hidden_states, _ = self.trans_parameters(
+            inputs, token_type_ids=segments, position_ids=position_ids, attention_mask=(~input_masks))
+        return last_hidden_states
+
 
 class WeightDropoutLSTM(nn.Module):
     """
@@ -129,8 +152,7 @@ class WeightDrop(torch.nn.Module):
         for name_w in self.weights:
             raw_w = getattr(self.module, name_w + '_raw')
             if self.variational:
-                mask = torch.autograd.Variable(torch.ones(raw_w.size(0), 1))
-                if raw_w.is_cuda: mask = mask.cuda()
+                mask = torch.ones(raw_w.size(0), 1, device=raw_w.device)
                 mask = torch.nn.functional.dropout(mask, p=self.dropout, training=True)
                 w = mask.expand_as(raw_w) * raw_w
             else:
@@ -344,10 +366,10 @@ class AttentionDotProduct(nn.Module):
         # [batch_size, query_seq_len, key_seq_len]
         attn_weights = ops.matmul(query, key.transpose(1, 2))
         if (query.size(1) == key.size(1)) and self.causal:
-            causal_mask = ops.fill_var_cuda((query.size(1), key.size(1)), 1).triu(1)
+            causal_mask = ops.fill_var((query.size(1), key.size(1)), 1, device=query.device).triu(1)
             attn_weights -= causal_mask.unsqueeze(0) * ops.HUGE_INT
         if mask is not None:
-            attn_weights.data.masked_fill_(mask.unsqueeze(1).expand_as(attn_weights), -ops.HUGE_INT)
+            attn_weights = attn_weights.masked_fill(mask.unsqueeze(1).expand_as(attn_weights), -ops.HUGE_INT)
         attn_weights /= np.sqrt(key.size(-1))
         if self.return_normalized_weights:
             attn_weights = F.softmax(attn_weights, -1)
@@ -391,10 +413,10 @@ class Attention(nn.Module):
         attn_weights = self.ffn(torch.cat([tiled_query, tiled_key], dim=2)).view(batch_size, query_seq_len, key_seq_len)
 
         if (query.size(1) == key.size(1)) and self.causal:
-            causal_mask = ops.fill_var_cuda((query.size(1), key.size(1)), 1).triu(1)
+            causal_mask = ops.fill_var((query.size(1), key.size(1)), 1, device=query.device).triu(1)
             attn_weights -= causal_mask.unsqueeze(0) * ops.HUGE_INT
         if mask is not None:
-            attn_weights.data.masked_fill_(mask.unsqueeze(1).expand_as(attn_weights), -ops.HUGE_INT)
+            attn_weights = attn_weights.masked_fill(mask.unsqueeze(1).expand_as(attn_weights), -ops.HUGE_INT)
         attn_weights /= np.sqrt(key.size(-1))
         attn_weights = F.softmax(attn_weights, -1)
 
@@ -479,54 +501,65 @@ class SelfAttentionLayer(nn.Module):
         return self.res_feed_forward(x), sa_weights
 
 
-class RelationalAttentionSingleHead(nn.Module):
+class RelationalAttentionDotProduct(nn.Module):
+    """
+    Relation-aware dot-product attention of all heads.
 
+    The relation features are never gathered per (query, key) pair: the query is multiplied with the key features of
+    each edge label once and the scores are gathered by the adjacency matrix, and the attention weights are summed per
+    edge label before they are multiplied with the value features. The memory used is O(batch_size * num_heads *
+    query_seq_len * (key_seq_len + num_edge_labels)) instead of O(batch_size * query_seq_len * key_seq_len * dim).
+    """
     def __init__(self, sparse, attn_dropout=0.0):
         super().__init__()
-        self.attn = AttentionDotProduct(
-            attn_dropout, causal=False, return_attn_vec=False, return_normalized_weights=False)
+        self.dropout = nn.Dropout(attn_dropout)
         self.sparse = sparse
 
     def forward(self, query, key, value, mask, M, r_k, r_v=None):
         """
-        :param query: [batch_size, query_seq_len, query_dim]
-        :param key: [batch_size, key_seq_len, key_dim]
-        :param value: [batch_size, key_seq_len, value_dim]
+        :param query: [batch_size, num_heads, query_seq_len, head_dim]
+        :param key: [batch_size, num_heads, key_seq_len, head_dim]
+        :param value: [batch_size, num_heads, key_seq_len, head_dim]
         :param mask: [batch_size, key_seq_len] binary mask where the padding entries are set to 1
         :param M: [batch_size, query_seq_len, key_seq_len] adjacency matrix
             M[i, j] represents the relationship of j -> i
                 M[i, j] = 0 indicates a null relationship.
-        :param r_k: [num_edge_labels, key_dim]
-        :param r_v: [num_edge_labels, value_dim] If set to None, r_v = r_k.
+        :param r_k: [num_heads, num_edge_labels, head_dim]
+        :param r_v: [num_heads, num_edge_labels, head_dim] If set to None, r_v = r_k.
+        :return attn_vec: [batch_size, num_heads, query_seq_len, head_dim]
+        :return attn_weights: [batch_size, num_heads, query_seq_len, key_seq_len]
         """
         if r_v is None:
             r_v = r_k
-        # [batch_size, query_seq_len, key_seq_len]
-        r_mask = (M > 0).float()
-        # [batch_size, query_seq_len, key_seq_len]
-        base_attn_weights = self.attn(query, key, value, mask)
-        # [batch_size, query_seq_len, key_seq_len, key_dim]
-        r_k_M = r_k[M] * r_mask.unsqueeze(3)
-        # [batch_size, query_seq_len, key_seq_len, value_dim]
-        r_v_M = r_v[M] * r_mask.unsqueeze(3)
-        # [batch_size, query_seq_len, key_seq_len]
-        r_attn_weights = torch.matmul(query.unsqueeze(2), r_k_M.transpose(2, 3)).squeeze(2) / np.sqrt(r_k.size(1))
-        attn_weights = base_attn_weights + r_attn_weights
-        attn_weights = attn_weights - (1 - r_mask) * ops.HUGE_INT
-        attn_weights = base_attn_weights
-        attn_weights = F.softmax(attn_weights, -1)
-        # [batch_size, query_seq_len, value_dim]
-        base_attn_vec = torch.matmul(attn_weights, value)
-        r_attn_vec = torch.matmul(attn_weights.unsqueeze(2), r_v_M).squeeze(2)
-        attn_vec = base_attn_vec + r_attn_vec
-        attn_vec = base_attn_vec
-        return attn_vec, attn_weights
+        batch_size, num_heads, query_seq_len, head_dim = query.size()
+        key_seq_len = key.size(2)
+        # [batch_size, num_heads, query_seq_len, key_seq_len]
+        M = M.unsqueeze(1).expand(batch_size, num_heads, query_seq_len, key_seq_len)
+        r_mask = (M > 0)
+        # [batch_size, num_heads, query_seq_len, num_edge_labels]
+        r_attn_weights = torch.matmul(query, r_k.transpose(1, 2).unsqueeze(0))
+        # [batch_size, num_heads, query_seq_len, key_seq_len]
+        r_attn_weights = torch.gather(r_attn_weights, 3, M).masked_fill(~r_mask, 0)
+        attn_weights = torch.matmul(query, key.transpose(2, 3)) + r_attn_weights
+        if mask is not None:
+            attn_weights = attn_weights.masked_fill(mask.view(batch_size, 1, 1, key_seq_len), -ops.HUGE_INT)
+        if self.sparse:
+            attn_weights = attn_weights.masked_fill(~r_mask, -ops.HUGE_INT)
+        attn_weights = F.softmax(attn_weights / np.sqrt(head_dim), -1)
+        # [batch_size, num_heads, query_seq_len, head_dim]
+        base_attn_vec = torch.matmul(attn_weights, self.dropout(value))
+        # [batch_size, num_heads, query_seq_len, num_edge_labels]
+        r_attn_weights = ops.zeros_var([batch_size, num_heads, query_seq_len, r_v.size(1)], device=query.device,
+                                       dtype=attn_weights.dtype)
+        r_attn_weights.scatter_add_(3, M, attn_weights.masked_fill(~r_mask, 0))
+        r_attn_vec = torch.matmul(r_attn_weights, self.dropout(r_v).unsqueeze(0))
+        return base_attn_vec + r_attn_vec, attn_weights
 
 
 class RelationalAttention(nn.Module):
     def __init__(self, query_dim, key_dim, value_dim, num_heads, sparse, attn_dropout=0.0, use_wo=True):
         super().__init__()
-        self.attn = RelationalAttentionSingleHead(sparse, attn_dropout)
+        self.attn = RelationalAttentionDotProduct(sparse, attn_dropout)
         self.wq = Linear(query_dim, key_dim, bias=False)
         self.wk = Linear(key_dim, key_dim, bias=False)
         self.wv = Linear(value_dim, value_dim, bias=False)
@@ -549,17 +582,16 @@ class RelationalAttention(nn.Module):
         if r_v is None:
             r_v = r_k
         query, key, value = self.wq(query), self.wk(key), self.wv(value)
-        query, key, value = (x.chunk(self.num_heads, -1) for x in (query, key, value))
-        r_k, r_v = (x.chunk(self.num_heads, -1) for x in (r_k, r_v))
-        multi_head_attn_vecs, multi_head_attn_weights = [], []
-        for q, k, v, rk, rv in zip(query, key, value, r_k, r_v):
-            h_attn_vec, h_attn_weights = self.attn(q, k, v, mask, M, rk, rv)
-            multi_head_attn_vecs.append(h_attn_vec)
-            multi_head_attn_weights.append(h_attn_weights.unsqueeze(1))
+        # [batch_size, num_heads, seq_len, head_dim]
+        query, key, value = (x.view(x.size(0), x.size(1), self.num_heads, -1).transpose(1, 2)
+                             for x in (query, key, value))
+        # [num_heads, num_edge_labels, head_dim]
+        r_k, r_v = (x.view(x.size(0), self.num_heads, -1).transpose(0, 1) for x in (r_k, r_v))
+        # [batch_size, num_heads, query_seq_len, head_dim], [batch_size, num_heads, query_seq_len, key_seq_len]
+        multi_head_attn_vec, multi_head_attn_weights = self.attn(query, key, value, mask, M, r_k, r_v)
         # [batch_size, query_seq_len, value_dim]
-        multi_head_attn_vec = torch.cat(multi_head_attn_vecs, dim=2)
-        # [batch_size, num_heads, query_seq_len, key_seq_len]
-        multi_head_attn_weights = torch.cat(multi_head_attn_weights, dim=1)
+        multi_head_attn_vec = multi_head_attn_vec.transpose(1, 2).reshape(
+            multi_head_attn_vec.size(0), multi_head_attn_vec.size(2), -1)
         return multi_head_attn_vec, multi_head_attn_weights
 
 
@@ -598,6 +630,51 @@ class MultiTargetPointerSwitch(nn.Module):
         return F.softmax(self.project(*args), dim=2)
 
 
+class SpanExtractor(nn.Module):
+    def __init__(self, input_dim):
+        super().__init__()
+        self.start_pred = Linear(input_dim, 1)
+        self.end_pred = Linear(input_dim, 1)
+        self.log_softmax = nn.LogSoftmax(dim=-1)
+
+    def forward(self, encoder_hiddens, text_masks):
+        """
+        :param encoder_hiddens: [batch_size, encoder_seq_len, hidden_dim]
+        :param text_masks: [batch_size, text_len + text_start_offset]
+        """
+        # [batch_size, encoder_seq_len]
+        start_potential = self.start_pred(encoder_hiddens).squeeze(2)
+        end_potential = self.end_pred(encoder_hiddens).squeeze(2)
+        start_logit = self.log_softmax(start_potential - text_masks * ops.HUGE_INT)
+        end_logit = self.log_softmax(end_potential - text_masks * ops.HUGE_INT)
+        return torch.cat([start_logit.unsqueeze(1), end_logit.unsqueeze(1)], dim=1)
+
+    def extract(self, inputs_embedded, text_masks):
+        """
+        :param inputs_embedded: [batch_size, seq_len, hidden_dim] transformer encoding of [CLS] + text + [SEP] + ...
+        :param text_masks: [batch_size, text_len]
+        :return: [batch_size, 2, text_len + 1] start and end logits, where position 0 ([CLS]) stands for no span.
+        """
+        batch_size = len(inputs_embedded)
+        text_masks = torch.cat([ops.zeros_var([batch_size, 1], device=text_masks.device), text_masks.float()],
+                               dim=1)
+        return self(inputs_embedded[:, :text_masks.size(1), :], text_masks)
+
+    @staticmethod
+    def get_spans(output):
+        """
+        :param output: [batch_size, 2, encoder_seq_len] start and end logits.
+        :return: (start, end) of the highest scoring span of each example.
+        """
+        batch_size, _, encoder_seq_len = output.size()
+        # [batch_size, encoder_seq_len, encoder_seq_len]
+        span_logit = output[:, 0, :].unsqueeze(2) + output[:, 1, :].unsqueeze(1)
+        valid_span_pos = ops.ones_var([batch_size, encoder_seq_len, encoder_seq_len], device=output.device).triu()
+        span_logit = span_logit - (1 - valid_span_pos) * ops.HUGE_INT
+        span_pos = span_logit.view(batch_size, -1).argmax(dim=1).tolist()
+        return [(int(pos / encoder_seq_len), int(pos % encoder_seq_len)) for pos in span_pos]
+
+
 class CoattentiveLayer(nn.Module):
     """
     Coattention.
@@ -698,15 +775,52 @@ class MaskedCrossEntropyLoss(nn.Module):
 
 def selective_read(encoder_ptr_value_ids, memory_hiddens, attn_weights, last_output):
     """
-    :param encoder_ptr_value_ids:
+    :param encoder_ptr_value_ids: [batch_size, seq_len]
     :param memory_hiddens: [batch_size, seq_len, hidden_dim]
-    :param attn_weights: [batch_size, 1, seq_len]
-    :param last_output
-    :return:
+    :param attn_weights: [batch_size*beam_size, 1, seq_len]
+    :param last_output: [batch_size*beam_size, 1]
+    :return: [batch_size*beam_size, 1, hidden_dim]
+
+    The memory is shared by the beam_size hypotheses of each example (beam_size = 1 outside beam search).
     """
-    point_mask = (encoder_ptr_value_ids == last_output).float()
-    weights = point_mask * attn_weights.squeeze(1)
     batch_size = memory_hiddens.size(0)
-    weight_normalizer = weights.sum(dim=1)
+    full_size = last_output.size(0)
+    # [batch_size, beam_size, seq_len]
+    point_mask = (encoder_ptr_value_ids.unsqueeze(1) == last_output.reshape(batch_size, -1, 1)).float()
+    weights = point_mask * attn_weights.reshape(batch_size, -1, attn_weights.size(2))
+    weight_normalizer = weights.sum(dim=2, keepdim=True)
     weight_normalizer = weight_normalizer + (weight_normalizer == 0).float() * ops.EPSILON
-    return (weights.unsqueeze(2) * memory_hiddens).sum(dim=1, keepdim=True) / weight_normalizer.view(batch_size, 1, 1)
+    return (ops.matmul(weights, memory_hiddens) / weight_normalizer).view(full_size, 1, -1)
+
+
+def beam_attention(attn, query, memory, memory_masks):
+    """
+    Attention of the hypotheses in the beams over the memory of their examples, which is not tiled along the beams.
+    :param attn: MultiHead attention module.
+    :param query: [batch_size*beam_size, 1, query_dim]
+    :param memory: [batch_size, seq_len, hidden_dim]
+    :param memory_masks: [batch_size, seq_len]
+    :return attn_vec: [batch_size*beam_size, 1, value_dim]
+    :return attn_weights: [batch_size*beam_size, num_head, 1, seq_len]
+    """
+    batch_size = memory.size(0)
+    full_size = query.size(0)
+    # the hypotheses of an example are the query positions of a single attention over the example memory
+    attn_vec, attn_weights = attn(query.reshape(batch_size, -1, query.size(2)), memory, memory, memory_masks)
+    attn_vec = attn_vec.reshape(full_size, 1, attn_vec.size(2))
+    attn_weights = attn_weights.transpose(1, 2).reshape(full_size, attn_weights.size(1), 1, attn_weights.size(3))
+    return attn_vec, attn_weights
+
+
+def beam_scatter_add(x, index, src):
+    """
+    Scatter-add src to x along the last dimension using an index which is not tiled along the beams.
+    :param x: [batch_size*beam_size, 1, x_dim]
+    :param index: [batch_size, seq_len]
+    :param src: [batch_size*beam_size, 1, seq_len]
+    """
+    batch_size = index.size(0)
+    x_ = x.view(batch_size, -1, x.size(2))
+    x_.scatter_add_(index=index.unsqueeze(1).expand(-1, x_.size(1), -1),
+                    src=src.reshape(batch_size, -1, src.size(2)), dim=2)
+    return x
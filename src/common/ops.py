@@ -17,6 +17,36 @@ import torch.nn as nn
 EPSILON = float(np.finfo(float).eps)
 HUGE_INT = 1e31
 
+# Default device of the tensor factories below (arange_var, zeros_var, long_var, ...). Each factory also accepts an
+# explicit device argument, which should be used whenever a reference tensor or module is at hand so that the tensor is
+# allocated directly on the device of the model. The default is set once per process with set_device / setup_device.
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def set_device(device_):
+    global device
+    device = torch.device(device_)
+
+
+def select_device(args):
+    """
+    Device a process computes on: the CPU if requested or if no GPU is available, otherwise the GPU specified by
+    --gpu (or indexed by the local rank in distributed training).
+    """
+    if args.cpu or not torch.cuda.is_available():
+        return torch.device('cpu')
+    if getattr(args, 'distributed', False):
+        return torch.device('cuda:{}'.format(args.local_rank))
+    return torch.device('cuda:{}'.format(args.gpu))
+
+
+def setup_device(args):
+    args.device = select_device(args)
+    if args.device.type == 'cuda':
+        torch.cuda.set_device(args.device)
+    set_device(args.device)
+    return args.device
+
 
 def merge_padded_seq_3D(hiddens1, masks1, hidden2, masks2):
     batch_size = len(hiddens1)
@@ -25,13 +55,15 @@ def merge_padded_seq_3D(hiddens1, masks1, hidden2, masks2):
     merged_size = seq_len1 + seq_len2
     max_merged_size = int(merged_size.max())
     res1 = max_merged_size - hiddens1.size(1)
-    merged_hiddens = torch.cat([hiddens1, zeros_var_cuda([batch_size, res1, hiddens1.size(2)])], dim=1)
-    scatter_index2 = seq_len1.unsqueeze(1) + batch_arange_cuda(batch_size, hidden2.size(1))
+    merged_hiddens = torch.cat([hiddens1, zeros_var([batch_size, res1, hiddens1.size(2)], dtype=hiddens1.dtype,
+                                                    device=hiddens1.device)], dim=1)
+    scatter_index2 = seq_len1.unsqueeze(1) + batch_arange_var(batch_size, hidden2.size(1), device=hidden2.device)
     scatter_index_masks2 = (scatter_index2 < max_merged_size)
     scatter_index2 *= scatter_index_masks2.long()
     merged_hiddens.scatter_add_(index=scatter_index2.unsqueeze(2).expand_as(hidden2),
                                 src=hidden2 * scatter_index_masks2.unsqueeze(2).float(), dim=1)
-    merged_hidden_masks = batch_arange_cuda(batch_size, max_merged_size) >= merged_size.unsqueeze(1)
+    merged_hidden_masks = \
+        batch_arange_var(batch_size, max_merged_size, device=hiddens1.device) >= merged_size.unsqueeze(1)
     return merged_hiddens, merged_hidden_masks
 
 
@@ -64,7 +96,7 @@ def batch_lookup_3D(M, idx):
     batch_size, seq_len, dim = M.size()
     _, sample_size = idx.size()
     M = M.view(batch_size*seq_len, dim)
-    offset = long_var_cuda(torch.arange(batch_size).unsqueeze(1))
+    offset = arange_var(batch_size, device=idx.device).unsqueeze(1)
     idx = idx + offset * seq_len
     idx = idx.view(-1)
     # [batch_size*sample_size, dim]
@@ -82,11 +114,11 @@ def batch_binary_lookup(M, b_idx, pad_value):
     batch_size = M.size(0)
     seq_len = b_idx.sum(1, keepdim=True)
     max_seq_len = int(seq_len.max())
-    output_masks = batch_arange_cuda(batch_size, max_seq_len) >= seq_len
+    output_masks = batch_arange_var(batch_size, max_seq_len, device=M.device) >= seq_len
     pad_len = max_seq_len - seq_len
     max_pad_len = int(pad_len.max())
-    M = torch.cat([M, fill_var_cuda([batch_size, max_pad_len], pad_value, dtype=M.dtype)], dim=1)
-    pad_b_idx = batch_arange_cuda(batch_size, max_pad_len) < pad_len
+    M = torch.cat([M, fill_var([batch_size, max_pad_len], pad_value, dtype=M.dtype, device=M.device)], dim=1)
+    pad_b_idx = batch_arange_var(batch_size, max_pad_len, device=M.device) < pad_len
     b_idx = torch.cat([b_idx, pad_b_idx], dim=1)
     output = M[b_idx].view(batch_size, max_seq_len)
     return output, output_masks
@@ -104,11 +136,12 @@ def batch_binary_lookup_3D(M, b_idx, pad_value):
     hidden_dim = M.size(2)
     seq_len = b_idx.sum(1, keepdim=True)
     max_seq_len = int(seq_len.max())
-    output_masks = batch_arange_cuda(batch_size, max_seq_len) >= seq_len
+    output_masks = batch_arange_var(batch_size, max_seq_len, device=M.device) >= seq_len
     pad_len = max_seq_len - seq_len
     max_pad_len = int(pad_len.max())
-    M = torch.cat([M, fill_var_cuda([batch_size, max_pad_len, hidden_dim], pad_value, dtype=M.dtype)], dim=1)
-    pad_b_idx = batch_arange_cuda(batch_size, max_pad_len) < pad_len
+    M = torch.cat([M, fill_var([batch_size, max_pad_len, hidden_dim], pad_value, dtype=M.dtype, device=M.device)],
+                  dim=1)
+    pad_b_idx = batch_arange_var(batch_size, max_pad_len, device=M.device) < pad_len
     b_idx = torch.cat([b_idx, pad_b_idx], dim=1)
     output = M[b_idx].view(batch_size, max_seq_len, hidden_dim)
     return output, output_masks
@@ -123,7 +156,7 @@ def soft_embedding_lookup(embeddings, prob):
         assert(prob.size(1) == 1)
         prob = prob.squeeze(1)
     vocab_size = prob.size(-1)
-    indices = arange_cuda(vocab_size)
+    indices = arange_var(vocab_size, device=prob.device)
     embedded = embeddings(indices)
     soft_embedded = torch.matmul(prob, embedded)
     if input_dim == 3:
@@ -176,17 +209,18 @@ def unpack_bidirectional_lstm_state(state, num_directions=2):
     return torch.stack(torch.split(state, new_hidden_dim, dim=2), dim=1).view(-1, batch_size, new_hidden_dim)
 
 
-def pad_and_cat(a, padding_value, padding_dim=1, dtype=torch.long, fill_empty_batch=True, return_masks=False):
+def pad_and_cat(a, padding_value, padding_dim=1, dtype=torch.long, fill_empty_batch=True, return_masks=False,
+                device=None):
 
     def vectorize(a):
         if dtype == torch.uint8:
-            a = [byte_var_cuda(x) for x in a]
+            a = [byte_var(x, device=device) for x in a]
         elif dtype == torch.int:
-            a = [int_var_cuda(x) for x in a]
+            a = [int_var(x, device=device) for x in a]
         elif dtype == torch.long:
-            a = [long_var_cuda(x) for x in a]
+            a = [long_var(x, device=device) for x in a]
         else:
-            a = [var_cuda(x) for x in a]
+            a = [float_var(x, device=device) for x in a]
         return a
 
     if not list(itertools.chain(*a)):
@@ -202,7 +236,7 @@ def pad_and_cat(a, padding_value, padding_dim=1, dtype=torch.long, fill_empty_ba
     max_dim_size = max([x.size()[padding_dim] for x in a])
 
     if return_masks:
-        masks = byte_ones_var_cuda([len(a), max_dim_size])
+        masks = byte_ones_var([len(a), max_dim_size], device=a[0].device)
     padded_a = []
     for i, x in enumerate(a):
         if return_masks:
@@ -212,7 +246,8 @@ def pad_and_cat(a, padding_value, padding_dim=1, dtype=torch.long, fill_empty_ba
             if x.dim() == 2:
                 padded_a.append(pad_1d_right(x, res_len, padding_value))
             elif x.dim() == 3:
-                padded_a.append(torch.cat([x, fill_var_cuda([x.size(0), res_len, x.size(2)], padding_value)],
+                padded_a.append(torch.cat([x, fill_var([x.size(0), res_len, x.size(2)], padding_value, dtype=x.dtype,
+                                                    device=x.device)],
                                           dim=padding_dim))
             else:
                 raise NotImplementedError
@@ -226,7 +261,8 @@ def pad_and_cat(a, padding_value, padding_dim=1, dtype=torch.long, fill_empty_ba
         return padded_a
 
 
-def pad_and_cat_2d(a, padding_value, padding_dim=2, dtype=torch.long, list_padding_value=None, fill_empty_batch=True):
+def pad_and_cat_2d(a, padding_value, padding_dim=2, dtype=torch.long, list_padding_value=None, fill_empty_batch=True,
+                   device=None):
     if not list(itertools.chain(*a)):
         # "a" contains only empty vectors
         if fill_empty_batch:
@@ -244,21 +280,21 @@ def pad_and_cat_2d(a, padding_value, padding_dim=2, dtype=torch.long, list_paddi
         else:
             padded_a.append(l)
     flat_a = [x for l in padded_a for x in l]
-    padded_flat_a = pad_and_cat(flat_a, padding_value, padding_dim=(padding_dim-1), dtype=dtype)
+    padded_flat_a = pad_and_cat(flat_a, padding_value, padding_dim=(padding_dim-1), dtype=dtype, device=device)
     return padded_flat_a.view(batch_size, w, -1)
 
 
-def pad_and_cat_matrices(a, padd_value, dtype=torch.long):
+def pad_and_cat_matrices(a, padd_value, dtype=torch.long, device=None):
 
     def vectorize(a):
         if dtype == torch.uint8:
-            a = [byte_var_cuda(x) for x in a]
+            a = [byte_var(x, device=device) for x in a]
         elif dtype == torch.int:
-            a = [int_var_cuda(x) for x in a]
+            a = [int_var(x, device=device) for x in a]
         elif dtype == torch.long:
-            a = [long_var_cuda(x) for x in a]
+            a = [long_var(x, device=device) for x in a]
         else:
-            a = [var_cuda(x) for x in a]
+            a = [float_var(x, device=device) for x in a]
         return a
 
     if type(a[0]) is list or type(a[0]) is np.ndarray:
@@ -291,24 +327,24 @@ def pad_1d_left(x, padding_size, pad_id):
 
 def right_shift_pad(x, pad_id):
     if x.size(1) == 1:
-        return int_fill_var_cuda(x.size(), pad_id)
+        return int_fill_var(x.size(), pad_id, device=x.device)
     return pad_1d_left(x[:, :-1], 1, pad_id)
 
 
 def left_shift_pad(x, pad_id):
     if x.size(1) == 1:
-        return int_fill_var_cuda(x.size(), pad_id)
+        return int_fill_var(x.size(), pad_id, device=x.device)
     return pad_1d_right(x[:, 1:], 1, pad_id)
 
 
-def pad_batch(batch_seq_ids, pad_id, dtype=torch.long):
-    padded_seq = pad_and_cat(batch_seq_ids, pad_id, dtype=dtype)
+def pad_batch(batch_seq_ids, pad_id, dtype=torch.long, device=None):
+    padded_seq = pad_and_cat(batch_seq_ids, pad_id, dtype=dtype, device=device)
     pad_mask = (padded_seq == pad_id)
     return padded_seq, pad_mask
 
 
-def pad_batch_2D(batch_2D_seq_ids, pad_id, dtype=torch.long, output_2d_tensor=False):
-    padded_2D_seq = pad_and_cat_2d(batch_2D_seq_ids, pad_id, dtype=dtype)
+def pad_batch_2D(batch_2D_seq_ids, pad_id, dtype=torch.long, output_2d_tensor=False, device=None):
+    padded_2D_seq = pad_and_cat_2d(batch_2D_seq_ids, pad_id, dtype=dtype, device=device)
     pad_mask = (padded_2D_seq == pad_id)
     if output_2d_tensor:
         batch_size = padded_2D_seq.size(0)
@@ -319,7 +355,7 @@ def pad_batch_2D(batch_2D_seq_ids, pad_id, dtype=torch.long, output_2d_tensor=Fa
 
 def tile_along_beam(x, beam_size, dim=0):
     bs = x.size(dim)
-    tile_indices = arange_cuda(bs).view(bs, 1).repeat(1, beam_size).view(bs*beam_size)
+    tile_indices = arange_var(bs, device=x.device).view(bs, 1).repeat(1, beam_size).view(bs*beam_size)
     return torch.index_select(x, dim, tile_indices)
     # batch_size = len(x)
     # full_size = batch_size * beam_size
@@ -338,14 +374,10 @@ def tile_along_beam(x, beam_size, dim=0):
 
 def positional_encodings_like(x, t=None):
     if t is None:
-        positions = torch.arange(0, x.size(1), dtype=torch.float)
-        if x.is_cuda:
-            positions = positions.cuda(x.get_device())
+        positions = torch.arange(0, x.size(1), dtype=torch.float, device=x.device)
     else:
         positions = t
-    encodings = torch.zeros(*x.size()[1:])
-    if x.is_cuda:
-        encodings = encodings.cuda(x.get_device())
+    encodings = torch.zeros(*x.size()[1:], device=x.device)
     for channel in range(x.size(-1)):
         if channel % 2 == 0:
             encodings[:, channel] = torch.sin(
@@ -356,74 +388,78 @@ def positional_encodings_like(x, t=None):
     return encodings
 
 
-def arange_cuda(x, dtype=torch.long):
-    return torch.arange(x, dtype=dtype).cuda()
+def resolve_device(device_=None):
+    return device if device_ is None else device_
+
+
+def arange_var(x, dtype=torch.long, device=None):
+    return torch.arange(x, dtype=dtype, device=resolve_device(device))
 
 
-def batch_arange_cuda(batch_size, x, dtype=torch.long):
-    return zeros_var_cuda(batch_size, dtype=dtype).unsqueeze(1) + \
-           arange_cuda(x, dtype=dtype).unsqueeze(0)
+def batch_arange_var(batch_size, x, dtype=torch.long, device=None):
+    return arange_var(x, dtype=dtype, device=device).unsqueeze(0).repeat(batch_size, 1)
 
 
-def byte_ones_var_cuda(s, requires_grad=False):
-    return torch.ones(s, dtype=torch.uint8, requires_grad=requires_grad).cuda()
+def byte_ones_var(s, requires_grad=False, device=None):
+    return torch.ones(s, dtype=torch.uint8, requires_grad=requires_grad, device=resolve_device(device))
 
 
-def ones_var_cuda(s, requires_grad=False, dtype=torch.float32):
-    return torch.ones(s, requires_grad=requires_grad, dtype=dtype).cuda()
+def ones_var(s, requires_grad=False, dtype=torch.float32, device=None):
+    return torch.ones(s, requires_grad=requires_grad, dtype=dtype, device=resolve_device(device))
 
 
-def int_ones_var_cuda(s, requires_grad=False):
-    return torch.ones(s, dtype=torch.long, requires_grad=requires_grad).cuda()
+def int_ones_var(s, requires_grad=False, device=None):
+    return torch.ones(s, dtype=torch.long, requires_grad=requires_grad, device=resolve_device(device))
 
 
-def zeros_like_cuda(x, requires_grad=False, dtype=torch.float32):
-    return torch.zeros_like(x, requires_grad=requires_grad, dtype=dtype).cuda()
+def zeros_like_var(x, requires_grad=False, dtype=torch.float32):
+    return torch.zeros_like(x, requires_grad=requires_grad, dtype=dtype)
 
 
-def byte_zeros_var_cuda(s, requires_grad=False):
-    return torch.zeros(s, dtype=torch.uint8, requires_grad=requires_grad).cuda()
+def byte_zeros_var(s, requires_grad=False, device=None):
+    return torch.zeros(s, dtype=torch.uint8, requires_grad=requires_grad, device=resolve_device(device))
 
 
-def zeros_var_cuda(s, requires_grad=False, dtype=torch.float32):
-    return torch.zeros(s, requires_grad=requires_grad, dtype=dtype).cuda()
+def zeros_var(s, requires_grad=False, dtype=torch.float32, device=None):
+    return torch.zeros(s, requires_grad=requires_grad, dtype=dtype, device=resolve_device(device))
 
 
-def int_zeros_var_cuda(s, requires_grad=False):
-    return torch.zeros(s, dtype=torch.long, requires_grad=requires_grad).cuda()
+def int_zeros_var(s, requires_grad=False, device=None):
+    return torch.zeros(s, dtype=torch.long, requires_grad=requires_grad, device=resolve_device(device))
 
 
-def int_fill_var_cuda(s, value, requires_grad=False):
-    return torch.zeros(s, dtype=torch.long, requires_grad=requires_grad).cuda() + value
+def int_fill_var(s, value, requires_grad=False, device=None):
+    return torch.full(s, value, dtype=torch.long, requires_grad=requires_grad, device=resolve_device(device))
 
 
-def fill_var_cuda(s, value, dtype=None, requires_grad=False):
-    return torch.zeros(s, dtype=dtype, requires_grad=requires_grad).cuda() + value
+def fill_var(s, value, dtype=None, requires_grad=False, device=None):
+    dtype = dtype if dtype is not None else torch.float32
+    return torch.full(s, value, dtype=dtype, requires_grad=requires_grad, device=resolve_device(device))
 
 
-def byte_var_cuda(x, requires_grad=False):
-    tx = torch.ByteTensor(x).cuda()
+def byte_var(x, requires_grad=False, device=None):
+    tx = torch.as_tensor(x, dtype=torch.uint8, device=resolve_device(device))
     if requires_grad:
         tx.requires_grad_()
     return tx
 
 
-def int_var_cuda(x, requires_grad=False):
-    tx = torch.IntTensor(x).cuda()
+def int_var(x, requires_grad=False, device=None):
+    tx = torch.as_tensor(x, dtype=torch.int32, device=resolve_device(device))
     if requires_grad:
         tx.requires_grad_()
     return tx
 
 
-def long_var_cuda(x, requires_grad=False):
-    tx = torch.LongTensor(x).cuda()
+def long_var(x, requires_grad=False, device=None):
+    tx = torch.as_tensor(x, dtype=torch.long, device=resolve_device(device))
     if requires_grad:
         tx.requires_grad_()
     return tx
 
 
-def var_cuda(x, requires_grad=False):
-    tx = torch.Tensor(x).cuda()
+def float_var(x, requires_grad=False, device=None):
+    tx = torch.as_tensor(x, dtype=torch.float32, device=resolve_device(device))
     if requires_grad:
         tx.requires_grad_()
     return tx
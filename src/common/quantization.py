@@ -0,0 +1,77 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Dynamic int8 quantization for CPU inference.
+"""
+
+import io
+
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import quantize_dynamic
+
+from src.common.nn_modules import Linear, WeightDrop, WeightDropoutLSTM
+
+
+class DynamicQuantizedLinear(nnqd.Linear):
+    """
+    Dynamic quantized counterpart of nn_modules.Linear. The quantized linear kernel accepts inputs of arbitrary rank,
+    hence no reshaping is needed.
+    """
+    @classmethod
+    def from_float(cls, mod, *args, **kwargs):
+        float_mod = nn.Linear(mod.in_features, mod.out_features, bias=(mod.bias is not None))
+        float_mod.weight = mod.weight
+        float_mod.bias = mod.bias
+        float_mod.qconfig = mod.qconfig
+        return super().from_float(float_mod, *args, **kwargs)
+
+
+def remove_weight_dropout(mdl):
+    """
+    Unwrap the LSTMs wrapped in WeightDrop. Weight dropout is the identity at inference time, and the wrapped LSTM
+    parameters cannot be converted by the quantization passes.
+    """
+    for module in mdl.modules():
+        if isinstance(module, WeightDropoutLSTM) and isinstance(module.rnn, WeightDrop):
+            base_rnn = module.rnn.module
+            for name_w in module.rnn.weights:
+                raw_w = getattr(base_rnn, name_w + '_raw')
+                del base_rnn._parameters[name_w + '_raw']
+                setattr(base_rnn, name_w, raw_w)
+            if 'flatten_parameters' in base_rnn.__dict__:
+                del base_rnn.flatten_parameters
+            base_rnn._init_flat_weights()
+            module.rnn = base_rnn
+    return mdl
+
+
+def quantize_dynamic_int8(mdl):
+    """
+    Quantize the weights of all linear projections (the pre-trained transformer layers, the encoder feed-forwards and
+    the attention projections) and LSTMs to int8. The activations are quantized on the fly, hence no calibration data
+    is needed. The embedding layers are kept in fp32.
+
+    The quantized model runs on the CPU only.
+    """
+    mdl = remove_weight_dropout(mdl)
+    qconfig_spec = {nn.Linear, Linear, nn.LSTM}
+    mapping = {
+        nn.Linear: nnqd.Linear,
+        Linear: DynamicQuantizedLinear,
+        nn.LSTM: nnqd.LSTM
+    }
+    return quantize_dynamic(mdl, qconfig_spec=qconfig_spec, mapping=mapping, dtype=torch.qint8, inplace=True)
+
+
+def get_model_size(mdl):
+    """
+    Serialized size of the model weights in bytes.
+    """
+    buffer = io.BytesIO()
+    torch.save(mdl.state_dict(), buffer)
+    return buffer.tell()
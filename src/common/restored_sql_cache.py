@@ -0,0 +1,157 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Persistent cache of the SQL queries restored from execution order.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class RestoredSQLCache(object):
+    """
+    Key-value store of the SQL queries restored from the execution order, keyed by (db_name, eo_sql) and shared by
+    the training and inference processes of a model.
+
+    The store is a SQLite database in WAL mode: the readers do not block and are not blocked by the writer, and a new
+    restoration is a single row insert instead of a rewrite of the whole cache. The store holds at most max_size
+    entries, the least recently used entries beyond that are evicted. A failed restoration is stored as NULL.
+
+    The SQLite connections are opened lazily in each process and thread, so a cache object can be inherited by
+    forked processes, pickled or used from the worker threads of the demo server. A cache hit does not write to the
+    store: the access times of the hits are kept in memory and written in one transaction at the next insertion or
+    eviction, after eviction_interval hits, or when the cache is closed.
+    """
+    def __init__(self, path, max_size=1000000, eviction_interval=1000):
+        """
+        :param path: SQLite database file.
+        :param max_size: Maximum number of cached queries.
+        :param eviction_interval: Number of insertions between two evictions in a process.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.eviction_interval = eviction_interval
+        # number of queries inserted with put, including those of the post-processing workers (see BeamPostProcessor)
+        self.num_new_entries = 0
+        self.init_process_state()
+
+    def init_process_state(self):
+        # connection of each thread: (pid, connection)
+        self.local = threading.local()
+        # access times of the cache hits not yet written: {(db_name, eo_sql): last_access}
+        self.accessed = dict()
+        self.accessed_pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['local', 'accessed', 'accessed_pid', 'lock']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_process_state()
+
+    def connect(self):
+        pid, conn = getattr(self.local, 'conn', (None, None))
+        if pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS restored_sql (db_name TEXT NOT NULL, eo_sql TEXT NOT NULL, '
+                         'restored_sql TEXT, last_access REAL NOT NULL, PRIMARY KEY (db_name, eo_sql))')
+            conn.execute('CREATE INDEX IF NOT EXISTS restored_sql_last_access ON restored_sql (last_access)')
+            self.local.conn = (os.getpid(), conn)
+        return conn
+
+    def get(self, db_name, eo_sql):
+        """
+        :return hit: True if the query is cached.
+        :return restored_sql: Restored query, None if the restoration failed or the query is not cached.
+        """
+        row = self.connect().execute('SELECT restored_sql FROM restored_sql WHERE db_name = ? AND eo_sql = ?',
+                                     (db_name, eo_sql)).fetchone()
+        if row is None:
+            return False, None
+        with self.lock:
+            if self.accessed_pid != os.getpid():
+                # the access times inherited from the parent process are written by the parent
+                self.accessed, self.accessed_pid = dict(), os.getpid()
+            self.accessed[(db_name, eo_sql)] = time.time()
+            num_accessed = len(self.accessed)
+        if num_accessed >= self.eviction_interval:
+            self.flush()
+        return True, row[0]
+
+    def flush(self):
+        """
+        Write the access times of the cache hits.
+        """
+        with self.lock:
+            if self.accessed_pid != os.getpid():
+                self.accessed, self.accessed_pid = dict(), os.getpid()
+            accessed, self.accessed = self.accessed, dict()
+        if not accessed:
+            return
+        conn = self.connect()
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany('UPDATE restored_sql SET last_access = ? WHERE db_name = ? AND eo_sql = ?',
+                             [(last_access, db_name, eo_sql) for (db_name, eo_sql), last_access in accessed.items()])
+
+    def put(self, db_name, eo_sql, restored_sql):
+        self.flush()
+        self.connect().execute('INSERT OR REPLACE INTO restored_sql VALUES (?, ?, ?, ?)',
+                               (db_name, eo_sql, restored_sql, time.time()))
+        self.num_new_entries += 1
+        if self.num_new_entries % self.eviction_interval == 0:
+            self.evict()
+
+    def update(self, entries):
+        """
+        Insert a list of (db_name, eo_sql, restored_sql) entries in one transaction.
+        """
+        conn = self.connect()
+        access_time = time.time()
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany('INSERT OR REPLACE INTO restored_sql VALUES (?, ?, ?, ?)',
+                             [(db_name, eo_sql, restored_sql, access_time)
+                              for db_name, eo_sql, restored_sql in entries])
+        self.evict()
+
+    def evict(self):
+        self.flush()
+        self.connect().execute(
+            'DELETE FROM restored_sql WHERE rowid IN '
+            '(SELECT rowid FROM restored_sql ORDER BY last_access DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def import_pickle(self, path):
+        """
+        Import a cache pickled as a {db_name: {eo_sql: restored_sql}} dictionary.
+        """
+        with open(path, 'rb') as f:
+            pred_restored_cache = pickle.load(f)
+        self.update([(db_name, eo_sql, restored_sql) for db_name in pred_restored_cache
+                     for eo_sql, restored_sql in pred_restored_cache[db_name].items()])
+        print('execution order restoration cache imported from {}'.format(path))
+
+    def close(self):
+        """
+        Write the pending access times and close the connection of the current thread.
+        """
+        self.flush()
+        pid, conn = getattr(self.local, 'conn', (None, None))
+        if pid == os.getpid():
+            conn.close()
+            del self.local.conn
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM restored_sql').fetchone()[0]
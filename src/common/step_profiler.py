@@ -0,0 +1,137 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Training step profiler.
+"""
+
+import collections
+import contextlib
+import os
+import resource
+import time
+
+import torch
+
+
+class StepProfiler(object):
+    """
+    Record the wall time of each stage of a training step together with the throughput, padding ratio and peak memory
+    usage, and report rolling summaries every log_interval steps to each of the sinks (callables taking a dictionary
+    of metrics).
+
+    Optionally, a torch.profiler trace is recorded for trace_num_steps steps after the first trace_start_step
+    (warm-up) steps and saved in Chrome trace format to trace_dir.
+
+    With log_interval <= 0 and no trace window, all methods are no-ops.
+    """
+    def __init__(self, log_interval=0, sinks=None, device=None, trace_start_step=-1, trace_num_steps=0,
+                 trace_dir=None):
+        self.log_interval = log_interval
+        self.enabled = log_interval > 0
+        self.sinks = sinks or []
+        self.use_cuda = device is not None and torch.device(device).type == 'cuda'
+
+        self.trace_start_step = trace_start_step
+        self.trace_end_step = trace_start_step + trace_num_steps
+        self.trace_dir = trace_dir
+        self.torch_profiler = None
+
+        self.step_id = 0
+        self.reset()
+        self.update_trace()
+
+    def reset(self):
+        self.stage_times = collections.OrderedDict()
+        self.num_steps = 0
+        self.num_examples = 0
+        self.num_tokens = 0
+        self.num_padded_tokens = 0
+        self.start_time = time.perf_counter()
+        if self.enabled and self.use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def synchronize(self):
+        if self.use_cuda:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        # Wait for the kernels launched by the previous stage so that their run time is not attributed to this stage
+        self.synchronize()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.stage_times[name] = self.stage_times.get(name, 0) + time.perf_counter() - start_time
+
+    def step(self, num_examples, num_tokens=0, num_padded_tokens=0):
+        """
+        Mark the end of a training step.
+        :param num_examples: Number of examples in the mini-batch.
+        :param num_tokens: Total number of input/output positions in the (padded) mini-batch.
+        :param num_padded_tokens: Number of padding positions in the mini-batch.
+        """
+        self.step_id += 1
+        self.update_trace()
+        if not self.enabled:
+            return
+        self.num_steps += 1
+        self.num_examples += num_examples
+        self.num_tokens += num_tokens
+        self.num_padded_tokens += num_padded_tokens
+        if self.num_steps >= self.log_interval:
+            self.report()
+            self.reset()
+
+    def summary(self):
+        elapsed_time = time.perf_counter() - self.start_time
+        metrics = collections.OrderedDict()
+        for name, stage_time in self.stage_times.items():
+            metrics['step_time/{}_ms'.format(name)] = 1000 * stage_time / self.num_steps
+        metrics['step_time/total_ms'] = 1000 * elapsed_time / self.num_steps
+        metrics['throughput/examples_per_sec'] = self.num_examples / elapsed_time
+        metrics['throughput/tokens_per_sec'] = (self.num_tokens - self.num_padded_tokens) / elapsed_time
+        metrics['throughput/padding_ratio'] = \
+            float(self.num_padded_tokens) / self.num_tokens if self.num_tokens > 0 else 0.0
+        if self.use_cuda:
+            metrics['memory/peak_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+        else:
+            # ru_maxrss is reported in kilobytes on Linux
+            metrics['memory/peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        return metrics
+
+    def report(self):
+        metrics = self.summary()
+        for sink in self.sinks:
+            sink(metrics)
+
+    def update_trace(self):
+        if self.trace_dir is None or self.trace_start_step < 0:
+            return
+        if self.step_id == self.trace_start_step:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                                         profile_memory=True)
+            self.torch_profiler.__enter__()
+        elif self.step_id == self.trace_end_step and self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+            if not os.path.exists(self.trace_dir):
+                os.makedirs(self.trace_dir)
+            trace_path = os.path.join(self.trace_dir, 'trace.{}-{}.json'.format(
+                self.trace_start_step, self.trace_end_step))
+            self.torch_profiler.export_chrome_trace(trace_path)
+            self.torch_profiler = None
+            print('=> torch profiler trace saved to \'{}\''.format(trace_path))
+
+
+def print_sink(metrics):
+    print(', '.join('{} = {:.2f}'.format(key, value) for key, value in metrics.items()))
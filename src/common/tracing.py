@@ -0,0 +1,241 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Per-stage latency tracing of the inference path.
+
+ The stages are instrumented with the module-level functions, e.g.
+
+    with tracing.span('beam_search'):
+        ...
+
+ which report to the current tracer. The default tracer is a no-op; set_tracer(LatencyTracer()) turns tracing on.
+"""
+
+import bisect
+import collections
+import contextlib
+import json
+import threading
+import time
+
+import torch
+
+
+class Tracer(object):
+    """
+    No-op tracer.
+    """
+    enabled = False
+
+    def span(self, name):
+        return null_context
+
+    def trace(self, name, **attributes):
+        return null_context
+
+    def record(self, name, duration, start_time=None):
+        pass
+
+    def summary(self):
+        return dict()
+
+    def dump(self, out_json):
+        pass
+
+
+class LatencyHistogram(object):
+    """
+    Latency histogram with logarithmic buckets from 10us to 100s, 8 buckets per decade.
+    """
+    bucket_bounds = [0.01 * 10 ** (i / 8) for i in range(57)]
+
+    def __init__(self):
+        self.counts = [0 for _ in range(len(self.bucket_bounds) + 1)]
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, latency):
+        """
+        :param latency: Latency in milliseconds.
+        """
+        self.counts[bisect.bisect_left(self.bucket_bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.min = min(self.min, latency)
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """
+        :return: Upper bound of the bucket of the q-th percentile latency.
+        """
+        rank = q / 100 * self.count
+        cumulative_count = 0
+        for i, count in enumerate(self.counts):
+            cumulative_count += count
+            if cumulative_count >= rank and count > 0:
+                return min(self.bucket_bounds[i], self.max) if i < len(self.bucket_bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return collections.OrderedDict([
+            ('count', self.count),
+            ('mean_ms', self.total / self.count),
+            ('min_ms', self.min),
+            ('p50_ms', self.percentile(50)),
+            ('p90_ms', self.percentile(90)),
+            ('p99_ms', self.percentile(99)),
+            ('max_ms', self.max),
+            ('buckets', [[bound, count] for bound, count in zip(self.bucket_bounds + [float('inf')], self.counts)
+                         if count > 0])
+        ])
+
+
+class LatencyTracer(Tracer):
+    """
+    Aggregate the span latencies of each stage into a histogram and keep the spans of the last max_traces traces
+    (e.g. one per batch of requests).
+
+    Spans can be nested (e.g. the picklist matching is part of the serialization), the latency of a span includes
+    its nested spans. On a GPU, the device is synchronized at the span boundaries so that the run time of the
+    asynchronous kernels is attributed to the stage that launched them.
+    """
+    enabled = True
+
+    def __init__(self, max_traces=1000, device=None):
+        self.histograms = collections.OrderedDict()
+        self.traces = collections.deque(maxlen=max_traces)
+        self.use_cuda = device is not None and torch.device(device).type == 'cuda'
+        self.current = threading.local()
+        self.lock = threading.Lock()
+
+    def synchronize(self):
+        if self.use_cuda:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        self.synchronize()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.record(name, time.perf_counter() - start_time, start_time=start_time)
+
+    @contextlib.contextmanager
+    def trace(self, name, **attributes):
+        """
+        Collect the spans of the current thread in a trace.
+        """
+        if getattr(self.current, 'trace', None) is not None:
+            with self.span(name):
+                yield
+            return
+        start_time = time.perf_counter()
+        trace = collections.OrderedDict([('name', name), ('start_time', time.time())])
+        trace.update(attributes)
+        trace['spans'] = []
+        self.current.trace = trace
+        self.current.start_time = start_time
+        try:
+            with self.span(name):
+                yield
+        finally:
+            self.current.trace = None
+            with self.lock:
+                self.traces.append(trace)
+
+    def record(self, name, duration, start_time=None):
+        """
+        :param duration: Latency of the span in seconds.
+        :param start_time: time.perf_counter() at the start of the span, the end of the span by default.
+        """
+        latency = 1000 * duration
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].add(latency)
+        trace = getattr(self.current, 'trace', None)
+        if trace is not None:
+            if start_time is None:
+                start_time = time.perf_counter() - duration
+            trace['spans'].append(collections.OrderedDict([
+                ('name', name),
+                ('start_ms', 1000 * (start_time - self.current.start_time)),
+                ('duration_ms', latency)
+            ]))
+
+    def summary(self):
+        with self.lock:
+            return collections.OrderedDict([(name, histogram.summary())
+                                            for name, histogram in self.histograms.items()])
+
+    def dump(self, out_json):
+        with self.lock:
+            traces = list(self.traces)
+        with open(out_json, 'w') as o_f:
+            json.dump({'stages': self.summary(), 'traces': traces}, o_f, indent=2)
+        print('latency traces saved to {}'.format(out_json))
+
+
+class Accumulator(object):
+    """
+    Accumulate the latency of a stage that runs in several pieces (e.g. the picklist matching of each field) and
+    record it as one span.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration += time.perf_counter() - self.start_time
+
+    def record(self):
+        tracer.record(self.name, self.duration)
+
+
+class NullAccumulator(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def record(self):
+        pass
+
+
+null_context = contextlib.nullcontext()
+null_accumulator = NullAccumulator()
+tracer = Tracer()
+
+
+def set_tracer(new_tracer):
+    global tracer
+    tracer = new_tracer
+
+
+def get_tracer():
+    return tracer
+
+
+def span(name):
+    return tracer.span(name)
+
+
+def trace(name, **attributes):
+    return tracer.trace(name, **attributes)
+
+
+def accumulator(name):
+    return Accumulator(name) if tracer.enabled else null_accumulator
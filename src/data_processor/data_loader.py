@@ -26,22 +26,6 @@ def load_processed_data(args):
     """
     Load preprocessed data file.
     """
-    if args.process_sql_in_execution_order:
-        split = 'test' if args.test else 'dev'
-        pred_restored_cache_path = os.path.join(
-            args.model_dir, '{}.eo.pred.restored.pkl'.format(split))
-        if not os.path.exists(pred_restored_cache_path):
-            cache_path = os.path.join(args.data_dir, '{}.eo.pred.restored.pkl'.format(split))
-            if not os.path.exists(cache_path):
-                pred_restored_cache = collections.defaultdict(dict)
-                with open(cache_path, 'wb') as o_f:
-                    pickle.dump(pred_restored_cache, o_f)
-            shutil.copyfile(cache_path, pred_restored_cache_path)
-            print('execution order restoration cache copied')
-            print('source: {}'.format(cache_path))
-            print('dest: {}'.format(pred_restored_cache_path))
-            print()
-
     in_pkl = get_processed_data_path(args)
     print('loading preprocessed data: {}'.format(in_pkl))
     with open(in_pkl, 'rb') as f:
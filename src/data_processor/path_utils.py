@@ -195,6 +195,18 @@ def get_checkpoint_path(args):
     return checkpoint_path
 
 
+def get_inference_checkpoint_path(args):
+    return os.path.join(args.model_dir, 'model-best.inference.tar')
+
+
+def get_confusion_span_head_path(args):
+    return os.path.join(args.model_dir, 'confusion-span-head-best.tar')
+
+
+def get_compiled_model_dir(args):
+    return os.path.join(args.model_dir, 'compiled')
+
+
 def get_model_subdir(args, with_time_stamp=True):
     dataset = os.path.basename(args.dataset_name)
 
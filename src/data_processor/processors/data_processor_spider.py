@@ -7,6 +7,7 @@
  Preprocessing Spider examples released by Yu et al. 2017.
 """
 import numpy as np
+import src.common.tracing as tracing
 import src.utils.utils as utils
 import scipy.sparse as ssp
 
@@ -55,14 +56,15 @@ def preprocess_example(split, example, args, parsed_programs, text_tokenize, pro
 
     # Text feature extraction and set program ground truth list
     if isinstance(example, Text2SQLExample):
-        if args.pretrained_transformer:
-            text_features = text_tokenize(example.text)
-            text_tokens, token_starts, token_ends = get_memory_values(text_features, example.text, args)
-            if not token_starts:
-                token_restored = False
-        else:
-            text_tokens = text_tokenize(example.text, functional_tokens)
-            text_features = [t.lower() for t in text_tokens]
+        with tracing.span('tokenization'):
+            if args.pretrained_transformer:
+                text_features = text_tokenize(example.text)
+                text_tokens, token_starts, token_ends = get_memory_values(text_features, example.text, args)
+                if not token_starts:
+                    token_restored = False
+            else:
+                text_tokens = text_tokenize(example.text, functional_tokens)
+                text_features = [t.lower() for t in text_tokens]
         example.text_tokens = text_features
         example.text_ptr_values = text_tokens
         example.text_token_starts = token_starts
@@ -80,16 +82,17 @@ def preprocess_example(split, example, args, parsed_programs, text_tokenize, pro
         question_encoding = example.text if args.use_picklist else None
         tables = sorted([schema_graph.get_table_id(t_name) for t_name in example.gt_table_names]) \
             if args.use_oracle_tables else None
-        table_po, field_po = schema_graph.get_schema_perceived_order(tables)
-        schema_features, matched_values = schema_graph.get_serialization(
-            tu, flatten_features=True, table_po=table_po, field_po=field_po,
-            use_typed_field_markers=args.use_typed_field_markers, use_graph_encoding=args.use_graph_encoding,
-            question_encoding=question_encoding, top_k_matches=args.top_k_picklist_matches,
-            match_threshold=args.anchor_text_match_threshold, num_values_per_field=args.num_values_per_field,
-            no_anchor_text=args.no_anchor_text)
-        example.matched_values = matched_values
-        example.input_tokens, example.input_ptr_values, num_excluded_tables, num_excluded_fields = \
-            get_table_aware_transformer_encoder_inputs(text_tokens, text_features, schema_features, trans_utils)
+        with tracing.span('serialization'):
+            table_po, field_po = schema_graph.get_schema_perceived_order(tables)
+            schema_features, matched_values = schema_graph.get_serialization(
+                tu, flatten_features=True, table_po=table_po, field_po=field_po,
+                use_typed_field_markers=args.use_typed_field_markers, use_graph_encoding=args.use_graph_encoding,
+                question_encoding=question_encoding, top_k_matches=args.top_k_picklist_matches,
+                match_threshold=args.anchor_text_match_threshold, num_values_per_field=args.num_values_per_field,
+                no_anchor_text=args.no_anchor_text)
+            example.matched_values = matched_values
+            example.input_tokens, example.input_ptr_values, num_excluded_tables, num_excluded_fields = \
+                get_table_aware_transformer_encoder_inputs(text_tokens, text_features, schema_features, trans_utils)
         schema_truncated = (num_excluded_fields > 0)
         num_included_nodes = schema_graph.get_num_perceived_nodes(table_po) + 1 - num_excluded_tables - num_excluded_fields
         example.ptr_input_ids = vec.vectorize(example.input_tokens, text_vocab)
@@ -21,6 +21,7 @@ import scipy.sparse as ssp
 import sqlite3
 
 import src.common.ops as ops
+import src.common.tracing as tracing
 import src.common.content_encoder as ce
 from src.data_processor.sql.sql_operators import field_types
 from src.data_processor.vocab_utils import Vocabulary
@@ -153,14 +154,22 @@ class Field(Node):
 class SchemaGraphs(object):
     def __init__(self):
         self.db_index, self.db_rev_index = dict(), dict()
+        # the ids of the removed schema graphs are not reused
+        self.next_db_id = 0
         self.lexicalized = False
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'next_db_id' not in state:
+            # schema graphs pickled with the preprocessed data before the id counter was added
+            self.next_db_id = max(self.db_rev_index) + 1 if self.db_rev_index else 0
+
     def get_db_id(self, db_name):
         return self.db_index[db_name]
 
     def get_current_schema_layout(self, pad_id=None, add_paddings=False):
         F = []
-        for db_id in range(self.size):
+        for db_id in sorted(self.db_rev_index):
             schema_graph = self.db_rev_index[db_id]
             F.append(schema_graph.get_current_schema_layout())
         if add_paddings:
@@ -180,11 +189,22 @@ class SchemaGraphs(object):
         return vocab
 
     def index_schema_graph(self, schema_graph):
-        db_id = len(self.db_index)
+        db_id = self.next_db_id
         assert(schema_graph.name not in self.db_index)
+        self.next_db_id += 1
         self.db_index[schema_graph.name] = db_id
         self.db_rev_index[db_id] = schema_graph
 
+    def update_schema_graph(self, schema_graph):
+        """
+        Replace the indexed schema graph of the same name, which keeps its db_id.
+        """
+        self.db_rev_index[self.db_index[schema_graph.name]] = schema_graph
+
+    def remove_schema_graph(self, db_name):
+        db_id = self.db_index.pop(db_name)
+        del self.db_rev_index[db_id]
+
     def lexicalize_graphs(self, tokenize=None, normalized=False):
         for db_name in self.db_index:
             schema_graph = self.__getitem__(db_name)
@@ -360,6 +380,8 @@ class SchemaGraph(object):
         if table_po is None:
             table_po, field_po = self.get_schema_perceived_order()
 
+        # the picklist matching time of all fields is recorded as one span
+        picklist_matching = tracing.accumulator('picklist_matching')
         bert_features = [[asterisk_marker]]
         schema_pos = len(bert_features)
         for table_id in table_po:
@@ -407,15 +429,17 @@ class SchemaGraph(object):
                         if ref_node.is_primary_key:
                             table_features.extend(ref_node.get_serialization(tu, with_table=True))
                 if use_picklist:
-                    picklist = self.get_field_picklist(field_id)
+                    with picklist_matching:
+                        picklist = self.get_field_picklist(field_id)
                     if picklist and isinstance(picklist[0], string_types):
                         key = (question_encoding, table_node.name, field_node.name)
-                        if key in self.question_field_match_cache:
-                            matches = self.question_field_match_cache[key]
-                        else:
-                            matches = ce.get_matched_entries(
-                                question_encoding, picklist, m_theta=match_threshold, s_theta=match_threshold)
-                            self.question_field_match_cache[key] = matches
+                        with picklist_matching:
+                            if key in self.question_field_match_cache:
+                                matches = self.question_field_match_cache[key]
+                            else:
+                                matches = ce.get_matched_entries(
+                                    question_encoding, picklist, m_theta=match_threshold, s_theta=match_threshold)
+                                self.question_field_match_cache[key] = matches
                         if matches:
                             num_values_inserted = 0
                             for match_str, (field_value, s_match_str, match_score, s_match_score, match_size) in matches:
@@ -442,6 +466,8 @@ class SchemaGraph(object):
                             print(row_values)
                         table_features.extend(tu.tokenizer.tokenize(row_value))
             bert_features.append(table_features)
+        if use_picklist:
+            picklist_matching.record()
         if flatten_features:
             bert_features = [x for table_features in bert_features for x in table_features]
         return bert_features, matched_values
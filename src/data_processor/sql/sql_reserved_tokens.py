@@ -8,29 +8,7 @@
 SQL reserved tokens.
 """
 
-from src.data_processor.vocab_utils import SQLVocabulary, functional_token_index
-
-digits = {
-    '0',
-    '1',
-    '2',
-    '3',
-    '4',
-    '5',
-    '6',
-    '7',
-    '8',
-    '9',
-    '10',
-    '11',
-    '12',
-    '##0',
-    '##1',
-    '##2',
-    '##3',
-    '##4',
-    '##5'
-}
+from src.data_processor.vocab_utils import SQLVocabulary, functional_token_index, digits
 
 sql_reserved_tokens = SQLVocabulary('sql_reserved_tokens', functional_token_index)
 sql_reserved_tokens.index_token('!')
@@ -9,6 +9,8 @@
 import collections
 import numpy as np
 
+import src.common.ops as ops
+
 
 functional_token_index = collections.OrderedDict({
     'start_token': ' <START> ',
@@ -25,6 +27,29 @@ functional_token_index = collections.OrderedDict({
 })
 functional_tokens = set(functional_token_index.values())
 
+# Number tokens in the SQL vocabulary, which are decoded as values
+digits = {
+    '0',
+    '1',
+    '2',
+    '3',
+    '4',
+    '5',
+    '6',
+    '7',
+    '8',
+    '9',
+    '10',
+    '11',
+    '12',
+    '##0',
+    '##1',
+    '##2',
+    '##3',
+    '##4',
+    '##5'
+}
+
 
 class VocabularyEntry(object):
 
@@ -167,6 +192,27 @@ class SQLVocabulary(Vocabulary):
                   'str_token']:
             self.index_token(fti[v], True, -1)
 
+        # device -> category lookup tables
+        self.category_tables = dict()
+
+    def get_category_tables(self, device):
+        """
+        Lookup tables of the output token categories used at each decoding step, built once per device.
+        :return input_feed_table: [size] decoder input of each output token; the digits are fed as the value token.
+        :return input_type_table: [size, 4] (vocab, table, field, value) binary type of each output token.
+        """
+        if device not in self.category_tables:
+            digit_mask = self.digit_mask
+            input_feed_table = np.arange(self.size)
+            input_feed_table[digit_mask == 1] = self.value_id
+            input_type_table = np.zeros([self.size, 4])
+            input_type_table[:, 0] = 1 - digit_mask
+            input_type_table[self.table_id, 1] = 1
+            input_type_table[self.field_id, 2] = 1
+            input_type_table[input_feed_table == self.value_id, 3] = 1
+            self.category_tables[device] = (ops.long_var(input_feed_table, device=device),
+                                            ops.long_var(input_type_table, device=device))
+        return self.category_tables[device]
 
     @property
     def clause_mask(self):
@@ -200,6 +246,13 @@ class SQLVocabulary(Vocabulary):
         mask[self.to_idx('join')] = 1
         return mask
 
+    @property
+    def digit_mask(self):
+        mask = np.zeros(self.size)
+        for v in digits:
+            mask[self.to_idx(v)] = 1
+        return mask
+
     @property
     def unk_table_id(self):
         if self.unk_table_token is None:
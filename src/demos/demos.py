@@ -10,13 +10,18 @@ import os
 import sys
 import time
 
+import src.common.ops as ops
+import src.common.tracing as tracing
 import src.data_processor.data_loader as data_loader
 import src.data_processor.processor_utils as data_utils
 from src.data_processor.schema_graph import SchemaGraph, SchemaGraphs
 from src.data_processor.schema_loader import load_schema_graphs
-from src.data_processor.path_utils import get_model_dir, get_checkpoint_path
+from src.data_processor.path_utils import get_model_dir, get_checkpoint_path, get_inference_checkpoint_path, \
+    get_confusion_span_head_path
 from src.data_processor.processor_utils import WIKISQL
 from src.data_processor.processors.data_processor_spider import preprocess_example
+from src.demos.response_cache import ResponseCache
+from src.demos.schema_registry import SchemaRegistry
 import src.data_processor.schema_loader as schema_loader
 import src.data_processor.tokenizers as tok
 from src.semantic_parser.learn_framework import EncoderDecoderLFramework
@@ -30,16 +35,33 @@ def load_semantic_parser(args):
         sp = EncoderDecoderLFramework(args)
     else:
         raise NotImplementedError
-    sp.load_checkpoint(get_checkpoint_path(args))
-    sp.cuda()
+    # Prefer the slim inference checkpoint (see --export_inference_model) over the full training checkpoint
+    inference_checkpoint_path = get_inference_checkpoint_path(args)
+    if not args.checkpoint_path and os.path.exists(inference_checkpoint_path):
+        sp.load_checkpoint(inference_checkpoint_path)
+    else:
+        sp.load_checkpoint(get_checkpoint_path(args))
+    sp.to(ops.setup_device(args))
     sp.eval()
+    if args.quantize_inference:
+        sp.quantize()
     return sp
 
 
-def load_confusion_span_detector(args):
-    tc = TranslatabilityChecker(args)
-    tc.load_checkpoint(os.path.join(args.model_dir, 'trans_check_0.0001_3e-05', 'model-best.tar'))
-    tc.cuda()
+def load_confusion_span_detector(args, semantic_parser=None):
+    """
+    :param semantic_parser: If set, load a span extractor trained on the transformer encoder outputs of the semantic
+        parser (see --train_confusion_span_head) and attach it to the parser, so that both run in one encoder pass.
+    """
+    if semantic_parser is None:
+        tc = TranslatabilityChecker(args)
+        tc.load_checkpoint(os.path.join(args.model_dir, 'trans_check_0.0001_3e-05', 'model-best.tar'))
+    else:
+        tc = TranslatabilityChecker(args, shared_encoder_dim=semantic_parser.mdl.encoder_input_dim)
+        tc.load_checkpoint(get_confusion_span_head_path(semantic_parser.args))
+        semantic_parser.set_confusion_span_extractor(tc.span_extractor)
+    # The confusion span detector runs on the device of the semantic parser
+    tc.to(ops.device)
     tc.eval()
     return tc
 
@@ -61,15 +83,32 @@ class Text2SQLWrapper(object):
         # Vocabulary
         self.vocabs = data_loader.load_vocabs(args)
 
-        # Confusion span detector
-        self.confusion_span_detector = load_confusion_span_detector(cs_args)
+        # Per-stage latencies of the requests
+        if args.trace_latency:
+            tracing.set_tracer(tracing.LatencyTracer(device=ops.device))
+
+        # Outputs of the repeated questions, keyed by the schema versions (incremented when a schema is replaced)
+        if args.demo_response_cache_size > 0:
+            self.response_cache = ResponseCache(args.demo_response_cache_size, args.demo_response_cache_ttl)
+        else:
+            self.response_cache = None
 
         # Text-to-SQL model
         self.semantic_parser = load_semantic_parser(args)
         self.semantic_parser.schema_graphs = SchemaGraphs()
+        snapshot_dir = args.schema_snapshot_dir or os.path.join(args.model_dir, 'schema_snapshots')
+        self.schema_registry = SchemaRegistry(self.semantic_parser.schema_graphs, snapshot_dir,
+                                              max_memory=args.schema_registry_max_memory * 1024 * 1024)
+        # The post-processing workers are forked before the server starts its threads
+        self.semantic_parser.start_post_processor()
         if schema is not None:
             self.add_schema(schema)
 
+        # Confusion span detector
+        self.share_encoder = args.share_confusion_span_encoder
+        self.confusion_span_detector = load_confusion_span_detector(
+            cs_args, semantic_parser=(self.semantic_parser if self.share_encoder else None))
+
         # When generating SQL in execution order, cache reordered SQLs to save time
         if args.process_sql_in_execution_order:
             self.pred_restored_cache = self.semantic_parser.load_pred_restored_cache()
@@ -77,69 +116,163 @@ class Text2SQLWrapper(object):
             self.pred_restored_cache = None
 
     def confusion_span_detection(self, example):
-        text_tokens = example.text_tokens
-        confusion_span = self.confusion_span_detector.inference([example])
-        confusion_span = confusion_span[0]
-        if confusion_span[0] == 0:
-            return True, None, None
-        else:
-            if confusion_span[1] - confusion_span[0] + 1 >= 5:
-                return False, None, None
+        return self.confusion_span_detection_batch([example])[0]
+
+    def confusion_span_detection_batch(self, examples, confusion_spans=None):
+        """
+        :param confusion_spans: Spans detected by the semantic parser with the shared encoder. If set to None, the
+            spans are detected by the confusion span detector.
+        """
+        if confusion_spans is None:
+            confusion_spans = self.confusion_span_detector.inference(examples)
+        outputs = []
+        for example, confusion_span in zip(examples, confusion_spans):
+            text_tokens = example.text_tokens
+            if confusion_span[0] == 0:
+                outputs.append((True, None, None))
             else:
-                confuse_span = self.tu.tokenizer.convert_tokens_to_string(text_tokens[confusion_span[0] - 1 : confusion_span[1]])
-                return False, confuse_span, None
+                if confusion_span[1] - confusion_span[0] + 1 >= 5:
+                    outputs.append((False, None, None))
+                else:
+                    confuse_span = self.tu.tokenizer.convert_tokens_to_string(
+                        text_tokens[confusion_span[0] - 1 : confusion_span[1]])
+                    outputs.append((False, confuse_span, None))
+        return outputs
 
     def translate(self, example):
         """
         :param text: natural language question
         :return: SQL query corresponding to the input question
         """
+        return self.translate_batch([example])[0]
+
+    def translate_batch(self, examples, return_confusion_spans=False):
+        """
+        :param examples: preprocessed questions
+        :param return_confusion_spans: If set, also return the confusion spans detected with the shared encoder
+        :return: SQL queries corresponding to the input questions, decoded with one inference run
+        """
         start_time = time.time()
-        output = self.semantic_parser.inference([example], restore_clause_order=self.args.process_sql_in_execution_order,
+        output = self.semantic_parser.inference(examples, restore_clause_order=self.args.process_sql_in_execution_order,
                                                 pred_restored_cache=self.pred_restored_cache, verbose=False)
-        if len(output['pred_decoded'][0]) > 1:
-            pred_sql = output['pred_decoded'][0][0]
-        else:
-            pred_sql = None
+        pred_sqls = []
+        for pred_decoded in output['pred_decoded']:
+            if len(pred_decoded) > 1:
+                pred_sqls.append(pred_decoded[0])
+            else:
+                pred_sqls.append(None)
         print('inference time: {:.2f}s'.format(time.time() - start_time))
-        return pred_sql
+        if return_confusion_spans:
+            return pred_sqls, output['confusion_spans']
+        return pred_sqls
 
-    def process(self, text, schema_name, verbose=False):
-        schema = self.semantic_parser.schema_graphs[schema_name]
-        start_time = time.time()
+    def preprocess(self, text, schema_name):
+        schema = self.schema_registry.get(schema_name)
         example = data_utils.Text2SQLExample(data_utils.OTHERS, schema.name,
                                              db_id=self.semantic_parser.schema_graphs.get_db_id(schema.name))
         example.text = text
         demo_preprocess(self.args, example, self.vocabs, schema)
-        print('data processing time: {:.2f}s'.format(time.time() - start_time))
+        return example
+
+    def process(self, text, schema_name, verbose=False):
+        return self.process_batch([(text, schema_name)], verbose=verbose)[0]
 
-        translatable, confuse_span, replace_span = self.confusion_span_detection(example)
+    def process_batch(self, requests, verbose=False):
+        """
+        Translate a batch of questions, the outputs of the questions asked before are read from the response cache.
+        :param requests: list of (text, schema_name) pairs
+        :return: list of outputs of process, in the order of the requests
+        """
+        with tracing.trace('request', num_requests=len(requests),
+                           schema_names=sorted(set(schema_name for _, schema_name in requests))):
+            if self.response_cache is None:
+                return self.process_batch_without_cache(requests, verbose=verbose)
+            return self.process_batch_with_cache(requests, verbose=verbose)
+
+    def process_batch_with_cache(self, requests, verbose=False):
+        keys = [self.response_cache.get_key(text, schema_name, self.schema_registry.get_version(schema_name))
+                for text, schema_name in requests]
+        outputs = [self.response_cache.get(key) for key in keys]
+        # the repeated questions in the batch are translated once
+        miss_ids = dict()
+        for i, (key, output) in enumerate(zip(keys, outputs)):
+            if output is None and key not in miss_ids:
+                miss_ids[key] = i
+        if miss_ids:
+            miss_outputs = self.process_batch_without_cache([requests[i] for i in miss_ids.values()], verbose=verbose)
+            for key, output in zip(miss_ids, miss_outputs):
+                self.response_cache.put(key, output)
+            miss_outputs = dict(zip(miss_ids, miss_outputs))
+            outputs = [output if output is not None else dict(miss_outputs[key]) for key, output in zip(keys, outputs)]
+        return outputs
 
-        sql_query = None
-        if translatable:
-            print('Translatable!')
-            sql_query = self.translate(example)
-            if verbose:
-                print('Text: {}'.format(text))
-                print('SQL: {}'.format(sql_query))
-                print()
+    def process_batch_without_cache(self, requests, verbose=False):
+        """
+        Translate a batch of questions with one inference run of the confusion span detector and one of the
+        semantic parser.
+        """
+        # the schemas of the batch are not evicted before its inference is done
+        with self.schema_registry.pin([schema_name for _, schema_name in requests]):
+            return self.translate_requests(requests, verbose=verbose)
+
+    def translate_requests(self, requests, verbose=False):
+        start_time = time.time()
+        examples = [self.preprocess(text, schema_name) for text, schema_name in requests]
+        print('data processing time: {:.2f}s'.format(time.time() - start_time))
+
+        if self.share_encoder:
+            # The questions are encoded once for both the confusion span detection and the translation, the
+            # translations of the untranslatable questions are discarded
+            pred_sqls, confusion_spans = self.translate_batch(examples, return_confusion_spans=True)
+            detections = self.confusion_span_detection_batch(examples, confusion_spans=confusion_spans)
+            sql_queries = [pred_sql if translatable else None
+                           for pred_sql, (translatable, _, _) in zip(pred_sqls, detections)]
         else:
-            print('Untranslatable!')
+            with tracing.span('confusion_detection'):
+                detections = self.confusion_span_detection_batch(examples)
+            sql_queries = [None for _ in examples]
+            translatable_ids = [i for i, (translatable, _, _) in enumerate(detections) if translatable]
+            if translatable_ids:
+                pred_sqls = self.translate_batch([examples[i] for i in translatable_ids])
+                for i, pred_sql in zip(translatable_ids, pred_sqls):
+                    sql_queries[i] = pred_sql
 
-        output = dict()
-        output['translatable'] = translatable
-        output['sql_query'] = sql_query
-        output['confuse_span'] = confuse_span
-        output['replace_span'] = replace_span
-        return output
+        outputs = []
+        for (text, _), (translatable, confuse_span, replace_span), sql_query in \
+                zip(requests, detections, sql_queries):
+            if translatable:
+                print('Translatable!')
+                if verbose:
+                    print('Text: {}'.format(text))
+                    print('SQL: {}'.format(sql_query))
+                    print()
+            else:
+                print('Untranslatable!')
+
+            output = dict()
+            output['translatable'] = translatable
+            output['sql_query'] = sql_query
+            output['confuse_span'] = confuse_span
+            output['replace_span'] = replace_span
+            outputs.append(output)
+        return outputs
 
     def add_schema(self, schema):
+        """
+        Register a schema. A schema of the same name is replaced and its cached outputs are invalidated.
+        """
         schema.lexicalize_graph(tokenize=self.text_tokenize)
-        if schema.name not in self.semantic_parser.schema_graphs.db_index:
-            self.semantic_parser.schema_graphs.index_schema_graph(schema)
+        version = self.schema_registry.register(schema)
+        if version > 1 and self.response_cache is not None:
+            self.response_cache.invalidate(schema.name)
+
+    def remove_schema(self, schema_name):
+        self.schema_registry.unregister(schema_name)
+        if self.response_cache is not None:
+            self.response_cache.invalidate(schema_name)
 
     def schema_exists(self, schema_name):
-        return schema_name in self.semantic_parser.schema_graphs.db_index
+        return schema_name in self.schema_registry
 
 
 def demo_table(args, sp):
@@ -0,0 +1,162 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Micro-batching inference server of the demo.
+"""
+import asyncio
+import concurrent.futures
+import json
+import time
+
+import src.common.tracing as tracing
+
+
+class InferenceScheduler(object):
+    """
+    Queue concurrent process(text, schema_name) requests and translate them in dynamic batches.
+
+    A batch is closed once it has max_batch_size requests or max_latency seconds after its first request arrived.
+    It is translated with one Text2SQLWrapper.process_batch call in a worker thread, so the event loop keeps accepting
+    requests while the batch is decoded, and the requests arriving meanwhile form the next batch.
+    """
+    def __init__(self, t2sql, max_batch_size=16, max_latency=0.05):
+        """
+        :param t2sql: Text2SQLWrapper.
+        :param max_batch_size: Maximum number of requests translated together.
+        :param max_latency: Maximum time in seconds a request waits for the other requests of its batch.
+        """
+        self.t2sql = t2sql
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = None
+        self.worker = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def process(self, text, schema_name):
+        """
+        :return: output of Text2SQLWrapper.process for the question.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        await self.queue.put((text, schema_name, loop.time(), future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # requests whose client has gone away are not translated
+        return [request for request in batch if not request[3].done()]
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.next_batch()
+            if not batch:
+                continue
+            start_time = time.time()
+            try:
+                outputs = await loop.run_in_executor(
+                    self.executor, self.t2sql.process_batch, [(text, schema_name) for text, schema_name, _, _ in batch])
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, _, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+            print('{} requests translated in {:.2f}s'.format(len(batch), time.time() - start_time))
+
+
+async def handle_http_request(scheduler, reader, writer, default_schema_name=None):
+    """
+    Serve a POST /process request with a JSON body {"text": ..., "schema_name": ...}. The response body is the
+    output of Text2SQLWrapper.process in JSON. GET /stats returns the response cache and schema registry
+    statistics and the latency histograms of the stages (see --trace_latency).
+    """
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in [b'\r\n', b'\n', b'']:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        if request_line[:2] == ['GET', '/stats']:
+            response_cache = scheduler.t2sql.response_cache
+            cache_stats = response_cache.stats() if response_cache is not None else None
+            status, output = '200 OK', {'response_cache': cache_stats,
+                                        'schema_registry': scheduler.t2sql.schema_registry.stats(),
+                                        'latency': tracing.get_tracer().summary()}
+        elif len(request_line) < 2 or request_line[0] != 'POST' or request_line[1] != '/process':
+            status, output = '404 Not Found', {'error': 'only POST /process and GET /stats are supported'}
+        else:
+            request = json.loads(body.decode('utf-8'))
+            schema_name = request.get('schema_name', default_schema_name)
+            if not schema_name or not scheduler.t2sql.schema_exists(schema_name):
+                status, output = '400 Bad Request', {'error': 'unknown schema {}'.format(schema_name)}
+            else:
+                output = await scheduler.process(request['text'], schema_name)
+                status = '200 OK'
+    except (ValueError, KeyError, asyncio.IncompleteReadError) as e:
+        status, output = '400 Bad Request', {'error': 'invalid request: {}'.format(e)}
+    except Exception as e:
+        status, output = '500 Internal Server Error', {'error': repr(e)}
+    response = json.dumps(output).encode('utf-8')
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                 .format(status, len(response)).encode('latin-1') + response)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def serve(t2sql, host='localhost', port=8000, max_batch_size=16, max_latency=0.05, default_schema_name=None):
+    """
+    Run the micro-batching HTTP server until interrupted.
+    """
+    async def main():
+        scheduler = InferenceScheduler(t2sql, max_batch_size=max_batch_size, max_latency=max_latency)
+        scheduler.start()
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_http_request(scheduler, reader, writer, default_schema_name), host, port)
+        print('Serving on http://{}:{}/process'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await scheduler.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
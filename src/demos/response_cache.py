@@ -0,0 +1,95 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Response cache of the demo.
+"""
+import collections
+import threading
+import time
+
+
+def normalize_question(text):
+    """
+    Collapse the whitespaces and strip the trailing punctuations of a question. The case is kept since the values
+    copied from the question are case-sensitive.
+    """
+    return ' '.join(text.split()).rstrip('?.! ')
+
+
+class ResponseCache(object):
+    """
+    LRU cache of the outputs of Text2SQLWrapper.process, keyed by (normalized question, schema name, schema version).
+
+    A new version of a schema makes its cached outputs unreachable, they are also removed by invalidate. An entry
+    expires ttl seconds after it was cached.
+    """
+    def __init__(self, max_size=10000, ttl=3600):
+        """
+        :param max_size: Maximum number of cached outputs.
+        :param ttl: Time to live of a cached output in seconds, 0 for no expiration.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_expirations = 0
+
+    def get_key(self, text, schema_name, schema_version):
+        return normalize_question(text), schema_name, schema_version
+
+    def get(self, key):
+        """
+        :return: Copy of the cached output, None if the output is not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and self.ttl > 0 and time.time() > entry[1]:
+                del self.entries[key]
+                self.num_expirations += 1
+                entry = None
+            if entry is None:
+                self.num_misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+            return dict(entry[0])
+
+    def put(self, key, output):
+        with self.lock:
+            self.entries[key] = (dict(output), time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.num_evictions += 1
+
+    def invalidate(self, schema_name):
+        """
+        Remove the cached outputs of a schema.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == schema_name]:
+                del self.entries[key]
+
+    @property
+    def hit_rate(self):
+        num_lookups = self.num_hits + self.num_misses
+        return self.num_hits / num_lookups if num_lookups > 0 else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.num_hits,
+            'misses': self.num_misses,
+            'hit_rate': self.hit_rate,
+            'evictions': self.num_evictions,
+            'expirations': self.num_expirations
+        }
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,186 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Schema registry of the demo.
+"""
+import collections
+import contextlib
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import types
+
+import numpy as np
+import torch
+
+
+def get_object_size(obj, seen=None):
+    """
+    Estimate the memory size of an object and the objects it references in bytes.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    # shared code objects are not counted
+    if isinstance(obj, (types.ModuleType, types.FunctionType, types.MethodType, type)):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else 0)
+    if isinstance(obj, torch.Tensor):
+        return sys.getsizeof(obj) + obj.element_size() * obj.nelement()
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        size += sum(get_object_size(k, seen) + get_object_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(get_object_size(x, seen) for x in obj)
+    if hasattr(obj, '__dict__'):
+        size += get_object_size(obj.__dict__, seen)
+    return size
+
+
+class SchemaRegistry(object):
+    """
+    Registry of the schemas served by the demo, indexed in the SchemaGraphs of the semantic parser.
+
+    Each schema has a version, incremented when it is updated, and an estimated memory size (picklists, adjacency
+    matrix, caches, etc.). Once the schemas in memory exceed max_memory bytes, the least recently used ones are
+    pickled to the snapshot directory and removed from the SchemaGraphs. An evicted schema is reloaded from its
+    snapshot on its next request. The schemas pinned by a running batch are not evicted.
+    """
+    def __init__(self, schema_graphs, snapshot_dir, max_memory=0):
+        """
+        :param schema_graphs: SchemaGraphs of the semantic parser.
+        :param snapshot_dir: Directory of the snapshots of the evicted schemas.
+        :param max_memory: Memory budget of the schemas in bytes, 0 for no eviction.
+        """
+        self.schema_graphs = schema_graphs
+        self.snapshot_dir = snapshot_dir
+        self.max_memory = max_memory
+        self.versions = dict()
+        # schemas in memory, from the least to the most recently used: {name: memory size}
+        self.in_memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.pinned = collections.Counter()
+        self.lock = threading.RLock()
+        self.num_evictions = 0
+        self.num_reloads = 0
+
+    def get_snapshot_path(self, schema_name):
+        return os.path.join(self.snapshot_dir, '{}.pkl'.format(hashlib.md5(schema_name.encode('utf-8')).hexdigest()))
+
+    def register(self, schema):
+        """
+        Register a schema, or update the registered schema of the same name.
+        :return: Version of the schema.
+        """
+        with self.lock:
+            name = schema.name
+            if name in self.in_memory:
+                self.schema_graphs.update_schema_graph(schema)
+                self.memory_size -= self.in_memory.pop(name)
+            else:
+                self.schema_graphs.index_schema_graph(schema)
+                snapshot_path = self.get_snapshot_path(name)
+                if os.path.exists(snapshot_path):
+                    os.remove(snapshot_path)
+            self.track(schema)
+            self.versions[name] = self.versions.get(name, 0) + 1
+            self.evict()
+            return self.versions[name]
+
+    def unregister(self, schema_name):
+        with self.lock:
+            if schema_name in self.in_memory:
+                self.memory_size -= self.in_memory.pop(schema_name)
+                self.schema_graphs.remove_schema_graph(schema_name)
+            snapshot_path = self.get_snapshot_path(schema_name)
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+            del self.versions[schema_name]
+
+    def get(self, schema_name):
+        """
+        :return: Schema graph, reloaded from its snapshot if it has been evicted.
+        """
+        with self.lock:
+            if schema_name not in self.versions:
+                raise KeyError(schema_name)
+            if schema_name in self.in_memory:
+                self.in_memory.move_to_end(schema_name)
+                return self.schema_graphs[schema_name]
+            snapshot_path = self.get_snapshot_path(schema_name)
+            with open(snapshot_path, 'rb') as f:
+                schema = pickle.load(f)
+            os.remove(snapshot_path)
+            self.schema_graphs.index_schema_graph(schema)
+            self.track(schema)
+            self.num_reloads += 1
+            self.evict()
+            return schema
+
+    def get_version(self, schema_name):
+        return self.versions[schema_name]
+
+    @contextlib.contextmanager
+    def pin(self, schema_names):
+        """
+        Load the schemas and keep them in memory within the context.
+        """
+        with self.lock:
+            schema_names = set(schema_names)
+            self.pinned.update(schema_names)
+            try:
+                for schema_name in schema_names:
+                    self.get(schema_name)
+            except Exception:
+                self.pinned.subtract(schema_names)
+                raise
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pinned.subtract(schema_names)
+                self.pinned += collections.Counter()
+                self.evict()
+
+    def track(self, schema):
+        size = get_object_size(schema)
+        self.in_memory[schema.name] = size
+        self.memory_size += size
+
+    def evict(self):
+        if self.max_memory <= 0:
+            return
+        for schema_name in list(self.in_memory):
+            if self.memory_size <= self.max_memory:
+                break
+            if self.pinned[schema_name] > 0 or schema_name == next(reversed(self.in_memory)):
+                continue
+            if not os.path.exists(self.snapshot_dir):
+                os.makedirs(self.snapshot_dir)
+            with open(self.get_snapshot_path(schema_name), 'wb') as o_f:
+                pickle.dump(self.schema_graphs[schema_name], o_f)
+            self.schema_graphs.remove_schema_graph(schema_name)
+            self.memory_size -= self.in_memory.pop(schema_name)
+            self.num_evictions += 1
+
+    def stats(self):
+        return {
+            'num_schemas': len(self.versions),
+            'num_schemas_in_memory': len(self.in_memory),
+            'memory_size': self.memory_size,
+            'evictions': self.num_evictions,
+            'reloads': self.num_reloads
+        }
+
+    def __contains__(self, schema_name):
+        return schema_name in self.versions
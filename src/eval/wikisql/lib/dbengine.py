@@ -17,21 +17,34 @@ num_re = re.compile(r'[-+]?\d*\.\d+|\d+')
 class DBEngine:
 
     def __init__(self, fdb):
+        self.fdb = fdb
         self.db = records.Database('sqlite:///{}'.format(fdb))
         self.conn = self.db.get_connection()
+        self.table_schemas = dict()
 
     def execute_query(self, table_id, query, *args, **kwargs):
         return self.execute(table_id, query.sel_index, query.agg_index, query.conditions, *args, **kwargs)
 
-    def execute(self, table_id, select_index, aggregation_index, conditions, lower=True):
+    def get_table_schema(self, table_id):
+        if table_id not in self.table_schemas:
+            table_info = self.conn.query(
+                'SELECT sql from sqlite_master WHERE tbl_name = :name', name=table_id).all()[0].sql
+            schema_str = schema_re.findall(table_info)[0]
+            schema = {}
+            for tup in schema_str.split(', '):
+                c, t = tup.split()
+                schema[c] = t
+            self.table_schemas[table_id] = schema
+        return self.table_schemas[table_id]
+
+    def get_query_str(self, table_id, select_index, aggregation_index, conditions, lower=True):
+        """
+        :return query: SQL query string with named parameters.
+        :return where_map: Values of the named parameters.
+        """
         if not table_id.startswith('table'):
             table_id = 'table_{}'.format(table_id.replace('-', '_'))
-        table_info = self.conn.query('SELECT sql from sqlite_master WHERE tbl_name = :name', name=table_id).all()[0].sql
-        schema_str = schema_re.findall(table_info)[0]
-        schema = {}
-        for tup in schema_str.split(', '):
-            c, t = tup.split()
-            schema[c] = t
+        schema = self.get_table_schema(table_id)
         select = 'col{}'.format(select_index)
         agg = Query.agg_ops[aggregation_index]
         if agg:
@@ -52,5 +65,9 @@ class DBEngine:
         if where_clause:
             where_str = 'WHERE ' + ' AND '.join(where_clause)
         query = 'SELECT {} AS result FROM {} {}'.format(select, table_id, where_str)
+        return query, where_map
+
+    def execute(self, table_id, select_index, aggregation_index, conditions, lower=True):
+        query, where_map = self.get_query_str(table_id, select_index, aggregation_index, conditions, lower=lower)
         out = self.conn.query(query, **where_map)
         return [o.result for o in out]
@@ -10,31 +10,44 @@ import random
 import json
 import os
 import sys
+import time
 
+import src.common.distributed as dist
 import src.common.ops as ops
+import src.common.tracing as tracing
+from src.common.quantization import get_model_size
 import src.data_processor.data_loader as data_loader
 import src.data_processor.processor_utils as data_utils
+import src.data_processor.tokenizers as tok
 from src.data_processor.data_processor import preprocess
 from src.data_processor.vocab_processor import build_vocab
 from src.data_processor.schema_graph import SchemaGraph
-from src.data_processor.path_utils import get_model_dir, get_checkpoint_path
+from src.data_processor.schema_loader import load_schema_graphs
+from src.data_processor.path_utils import get_model_dir, get_checkpoint_path, get_inference_checkpoint_path, \
+    get_compiled_model_dir, get_confusion_span_head_path
 from src.demos.demos import Text2SQLWrapper
+import src.demos.inference_server as inference_server
 import src.eval.eval_tools as eval_tools
 from src.eval.wikisql.lib.dbengine import DBEngine
+from src.semantic_parser.ensemble import EnsembleRuntime
 from src.semantic_parser.learn_framework import EncoderDecoderLFramework
+from src.semantic_parser.streaming_inference import StreamingInference
 from src.trans_checker.args import args as cs_args
+import src.trans_checker.trans_checker as trans_checker
 import src.utils.utils as utils
 
 from src.parse_args import args
 
 import torch
-if not args.data_parallel:
-    torch.cuda.set_device('cuda:{}'.format(args.gpu))
+if args.distributed:
+    dist.init_distributed(args)
+if args.quantize_inference or args.quantization_report:
+    # Quantized kernels run on the CPU only
+    args.cpu = True
+device = ops.setup_device(args)
 torch.manual_seed(args.seed)
 torch.cuda.manual_seed_all(args.seed)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
 # Set model ID
 args.model_id = utils.model_index[args.model]
 assert(args.model_id is not None)
@@ -102,6 +115,10 @@ def inference(sp):
 
     sp.load_checkpoint(get_checkpoint_path(args))
     sp.eval()
+    if args.quantize_inference:
+        sp.quantize()
+    if args.compiled_inference:
+        sp.use_compiled_model(get_compiled_model_dir(args))
 
     if sp.args.augment_with_wikisql:
         examples_, examples_wikisql = [], []
@@ -112,18 +129,18 @@ def inference(sp):
                 examples_.append(example)
         examples = examples_
 
-    pred_restored_cache = sp.load_pred_restored_cache()
-    pred_restored_cache_size = sum(len(v) for v in pred_restored_cache.values())
-    pred_restored_cache = None
+    if args.process_sql_in_execution_order:
+        pred_restored_cache = sp.load_pred_restored_cache()
+    else:
+        pred_restored_cache = None
     out_dict = sp.inference(examples, restore_clause_order=args.process_sql_in_execution_order,
                             pred_restored_cache=pred_restored_cache,
                             check_schema_consistency_=args.sql_consistency_check,
                             engine=engine, inline_eval=True, verbose=True)
+    sp.close_post_processor()
     if args.process_sql_in_execution_order:
-        new_pred_restored_cache_size = sum(len(v) for v in out_dict['pred_restored_cache'].values())
-        newly_cached_size = new_pred_restored_cache_size - pred_restored_cache_size
-        if newly_cached_size > 0:
-            sp.save_pred_restored_cache(out_dict['pred_restored_cache'], newly_cached_size)
+        print('{} sql order restoration newly cached'.format(pred_restored_cache.num_new_entries))
+        pred_restored_cache.close()
 
     out_txt = os.path.join(sp.model_dir, 'predictions.{}.{}.{}.txt'.format(args.beam_size, args.bs_alpha, split))
     with open(out_txt, 'w') as o_f:
@@ -145,6 +162,45 @@ def inference(sp):
         evaluate(examples_wikisql, wikisql_out_dict)
 
 
+def stream_inference(sp):
+    """
+    Translate the questions of a JSONL file ({"question": ..., "db_id": ...} per line) in bounded memory. An
+    interrupted job is resumed by running the same command again.
+    """
+    assert(args.stream_input_path is not None)
+    tokenizers = tok.get_tokenizers(args)
+    schema_graphs = load_schema_graphs(args)
+    schema_graphs.lexicalize_graphs(tokenize=tokenizers[0], normalized=(args.model_id in [utils.BRIDGE]))
+    sp.schema_graphs = schema_graphs
+    vocabs = data_loader.load_vocabs(args)
+
+    sp.load_checkpoint(get_checkpoint_path(args))
+    sp.eval()
+    if args.quantize_inference:
+        sp.quantize()
+    if args.compiled_inference:
+        sp.use_compiled_model(get_compiled_model_dir(args))
+
+    if args.process_sql_in_execution_order:
+        pred_restored_cache = sp.load_pred_restored_cache()
+    else:
+        pred_restored_cache = None
+    out_jsonl = args.prediction_path or os.path.join(sp.model_dir, 'predictions.stream.jsonl')
+    streaming_inference = StreamingInference(sp, schema_graphs, vocabs, tokenizers,
+                                             chunk_size=args.stream_chunk_size,
+                                             num_workers=args.num_preprocess_workers,
+                                             restore_clause_order=args.process_sql_in_execution_order,
+                                             pred_restored_cache=pred_restored_cache,
+                                             check_schema_consistency_=args.sql_consistency_check)
+    try:
+        streaming_inference.run(args.stream_input_path, out_jsonl)
+    finally:
+        streaming_inference.close()
+        sp.close_post_processor()
+        if pred_restored_cache is not None:
+            pred_restored_cache.close()
+
+
 def ensemble():
     dataset = data_loader.load_processed_data(args)
     split = 'test' if args.test else 'dev'
@@ -199,22 +255,23 @@ def ensemble():
         checkpoint_path = os.path.join(model_dir, 'model-best.16.tar')
         sps[i].schema_graphs = dataset['schema']
         sps[i].load_checkpoint(checkpoint_path)
-        sps[i].cuda()
+        sps[i].to(device)
         sps[i].eval()
 
-    pred_restored_cache = sps[0].load_pred_restored_cache()
-    pred_restored_cache_size = sum(len(v) for v in pred_restored_cache.values())
+    if args.process_sql_in_execution_order:
+        pred_restored_cache = sps[0].load_pred_restored_cache()
+    else:
+        pred_restored_cache = None
 
     out_dict = sps[0].inference(dev_examples, restore_clause_order=args.process_sql_in_execution_order,
                                 pred_restored_cache=pred_restored_cache,
                                 check_schema_consistency_=args.sql_consistency_check, engine=engine,
-                                inline_eval=True, model_ensemble=[sp.mdl for sp in sps], verbose=True)
+                                inline_eval=True, model_ensemble=EnsembleRuntime([sp.mdl for sp in sps]), verbose=True)
+    sps[0].close_post_processor()
 
     if args.process_sql_in_execution_order:
-        new_pred_restored_cache_size = sum(len(v) for v in out_dict['pred_restored_cache'].values())
-        newly_cached_size = new_pred_restored_cache_size - pred_restored_cache_size
-        if newly_cached_size > 0:
-            sps[0].save_pred_restored_cache(out_dict['pred_restored_cache'], newly_cached_size)
+        print('{} sql order restoration newly cached'.format(pred_restored_cache.num_new_entries))
+        pred_restored_cache.close()
 
     out_txt = os.path.join(sps[0].model_dir, 'predictions.ens.{}.{}.{}.{}.txt'.format(args.beam_size, args.bs_alpha, split, len(model_dirs)))
     with open(out_txt, 'w') as o_f:
@@ -342,6 +399,77 @@ def fine_tune(sp):
     sp.run_train(fine_tune_data, dev_data)
 
 
+def export_inference_model(sp):
+    sp.load_checkpoint(get_checkpoint_path(args))
+    vocabs = {
+        'text': sp.in_vocab,
+        'program': sp.out_vocab
+    }
+    sp.save_inference_checkpoint(get_inference_checkpoint_path(args), vocabs,
+                                 half_precision=args.export_half_precision)
+
+
+def export_compiled_model(sp):
+    dataset = data_loader.load_processed_data(args)
+    sp.schema_graphs = dataset['schema']
+    sp.load_checkpoint(get_checkpoint_path(args))
+    sp.export_compiled_model(dataset['dev'], get_compiled_model_dir(args))
+
+
+def train_confusion_span_head(sp):
+    sp.load_checkpoint(get_checkpoint_path(args))
+    sp.eval()
+    dataset = trans_checker.load_data(cs_args)
+    trans_checker.train(dataset['train'], dataset['dev'], shared_encoder=sp.mdl,
+                        model_path=get_confusion_span_head_path(args))
+
+
+def quantization_report(sp):
+    """
+    Compare the int8 dynamic quantized model against the fp32 model on a dev subset.
+    """
+    dataset = data_loader.load_processed_data(args)
+    examples = dataset['dev'][:args.quantization_report_size]
+    sp.schema_graphs = dataset['schema']
+    if args.dataset_name == 'wikisql':
+        engine = DBEngine(os.path.join(args.data_dir, 'dev.db'))
+    else:
+        engine = None
+    print('{} dev examples loaded'.format(len(examples)))
+
+    sp.load_checkpoint(get_checkpoint_path(args))
+    sp.eval()
+
+    def evaluate():
+        start_time = time.time()
+        out_dict = sp.inference(examples, restore_clause_order=args.process_sql_in_execution_order,
+                                check_schema_consistency_=args.sql_consistency_check, engine=engine)
+        latency = (time.time() - start_time) / len(examples)
+        metrics = eval_tools.get_exact_match_metrics(examples, out_dict['pred_decoded'], engine=engine)
+        return out_dict['pred_decoded'], metrics['top_1_em'], latency, get_model_size(sp.mdl)
+
+    report = dict()
+    fp32_preds, report['fp32_top_1_em'], report['fp32_latency'], report['fp32_model_size'] = evaluate()
+    sp.quantize()
+    int8_preds, report['int8_top_1_em'], report['int8_latency'], report['int8_model_size'] = evaluate()
+    sp.close_post_processor()
+    report['top_1_agreement'] = \
+        float(sum(p1[0] == p2[0] for p1, p2 in zip(fp32_preds, int8_preds))) / len(examples)
+    report['num_examples'] = len(examples)
+
+    print('Quantization report ({} dev examples)'.format(len(examples)))
+    print('Top-1 exact match: fp32 = {:.3f}, int8 = {:.3f}'.format(report['fp32_top_1_em'], report['int8_top_1_em']))
+    print('Top-1 prediction agreement: {:.3f}'.format(report['top_1_agreement']))
+    print('Latency per example: fp32 = {:.1f}ms, int8 = {:.1f}ms'.format(
+        report['fp32_latency'] * 1000, report['int8_latency'] * 1000))
+    print('Model size: fp32 = {:.1f}MB, int8 = {:.1f}MB'.format(
+        report['fp32_model_size'] / 2 ** 20, report['int8_model_size'] / 2 ** 20))
+    out_json = os.path.join(sp.model_dir, 'quantization_report.json')
+    with open(out_json, 'w') as o_f:
+        json.dump(report, o_f, indent=4)
+    print('Quantization report saved to {}'.format(out_json))
+
+
 def process_data():
     """
     Data preprocess.
@@ -360,7 +488,7 @@ def process_data():
     preprocess(args, dataset, verbose=True)
 
 
-def demo(args):
+def load_demo_schema(args):
     data_dir = 'data/'
     db_name = 'pets_1'
     db_path = os.path.join(args.db_dir, db_name, '{}.sqlite'.format(db_name))
@@ -379,6 +507,11 @@ def demo(args):
                 break
         schema.load_data_from_spider_json(table)
     schema.pretty_print()
+    return schema
+
+
+def demo(args):
+    schema = load_demo_schema(args)
     t2sql = Text2SQLWrapper(args, cs_args, schema)
 
     sys.stdout.write('Enter a natural language question: ')
@@ -400,6 +533,20 @@ def demo(args):
         sys.stdout.write('\nEnter a natural language question: ')
         sys.stdout.write('> ')
         text = sys.stdin.readline()
+    save_latency_traces(args)
+
+
+def demo_server(args):
+    schema = load_demo_schema(args)
+    t2sql = Text2SQLWrapper(args, cs_args, schema)
+    inference_server.serve(t2sql, port=args.demo_server_port, max_batch_size=args.demo_max_batch_size,
+                           max_latency=args.demo_max_latency, default_schema_name=schema.name)
+    save_latency_traces(args)
+
+
+def save_latency_traces(args):
+    if args.trace_latency:
+        tracing.get_tracer().dump(args.latency_trace_path or os.path.join(args.model_dir, 'latency_traces.json'))
 
 
 def run_experiment(args):
@@ -412,7 +559,8 @@ def run_experiment(args):
                               'seq2seq.pg'])
         ensemble()
     else:
-        with torch.set_grad_enabled(args.train or args.search_random_seed or args.grid_search or args.fine_tune):
+        with torch.set_grad_enabled(args.train or args.search_random_seed or args.grid_search or args.fine_tune or
+                                    args.train_confusion_span_head):
             get_model_dir(args)
             if args.model in ['bridge',
                               'seq2seq',
@@ -421,17 +569,29 @@ def run_experiment(args):
             else:
                 raise NotImplementedError
 
-            sp.cuda()
+            sp.to(device)
             if args.train:
                 train(sp)
+            elif args.inference and args.stream_input_path:
+                stream_inference(sp)
             elif args.inference:
                 inference(sp)
             elif args.error_analysis:
                 error_analysis(sp)
+            elif args.demo and args.demo_server:
+                demo_server(args)
             elif args.demo:
                 demo(args)
             elif args.fine_tune:
                 fine_tune(sp)
+            elif args.export_inference_model:
+                export_inference_model(sp)
+            elif args.export_compiled_model:
+                export_compiled_model(sp)
+            elif args.quantization_report:
+                quantization_report(sp)
+            elif args.train_confusion_span_head:
+                train_confusion_span_head(sp)
             else:
                 print('No experiment specified. Exit now.')
                 sys.exit(1)
@@ -439,3 +599,4 @@ def run_experiment(args):
 
 if __name__ == '__main__':
     run_experiment(args)
+    dist.cleanup()
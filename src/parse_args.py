@@ -34,6 +34,40 @@ parser.add_argument('--fine_tune', action='store_true',
                     help='fine tuning model on a given dataset (default: False)')
 parser.add_argument('--demo', action='store_true',
                     help='run interactive commandline demo (default: False)')
+parser.add_argument('--share_confusion_span_encoder', action='store_true',
+                    help='in the demo, detect the confusion spans with a span extractor head on the transformer '
+                         'encoder of the semantic parser, so that both run in one encoder pass (default: False)')
+parser.add_argument('--train_confusion_span_head', action='store_true',
+                    help='train the confusion span extractor head on the frozen transformer encoder of the semantic '
+                         'parser, for --share_confusion_span_encoder (default: False)')
+parser.add_argument('--demo_response_cache_size', type=int, default=10000,
+                    help='maximum number of demo outputs cached for repeated questions, 0 to disable the cache '
+                         '(default: 10000)')
+parser.add_argument('--demo_response_cache_ttl', type=float, default=3600,
+                    help='time to live of a cached demo output in seconds, 0 for no expiration (default: 3600)')
+parser.add_argument('--schema_registry_max_memory', type=int, default=0,
+                    help='memory budget of the demo schemas in MB, the least recently used schemas beyond it are '
+                         'moved to disk snapshots, 0 for no limit (default: 0)')
+parser.add_argument('--schema_snapshot_dir', type=str, default=None,
+                    help='directory of the snapshots of the evicted demo schemas (default: schema_snapshots in the '
+                         'model directory)')
+parser.add_argument('--demo_server', action='store_true',
+                    help='run the demo as an HTTP server that translates concurrent requests in batches '
+                         '(default: False)')
+parser.add_argument('--demo_server_port', type=int, default=8000,
+                    help='port of the demo server (default: 8000)')
+parser.add_argument('--demo_max_batch_size', type=int, default=16,
+                    help='maximum number of requests translated together by the demo server (default: 16)')
+parser.add_argument('--demo_max_latency', type=float, default=0.05,
+                    help='maximum time in seconds a request to the demo server waits for other requests to be '
+                         'batched with (default: 0.05)')
+parser.add_argument('--trace_latency', action='store_true',
+                    help='record the latency of each stage of the demo requests (tokenization, picklist matching, '
+                         'serialization, confusion detection, encoder, beam search, post-processing and execution '
+                         'check) (default: False)')
+parser.add_argument('--latency_trace_path', type=str, default=None,
+                    help='JSON file the latency histograms and traces are saved to when the demo exits '
+                         '(default: latency_traces.json in the model directory)')
 parser.add_argument('--data_statistics', action='store_true',
                     help='print dataset statistics (default: False)')
 parser.add_argument('--search_random_seed', action='store_true',
@@ -45,6 +79,16 @@ parser.add_argument('--eval_by_relation_type', action='store_true',
                     help='compute evaluation metrics for to-M and to-1 relations separately (default: False)')
 parser.add_argument('--error_analysis', action='store_true',
                     help='run error analysis (default: False)')
+parser.add_argument('--export_inference_model', action='store_true',
+                    help='export the checkpoint as an inference-only model file (default: False)')
+parser.add_argument('--export_half_precision', action='store_true',
+                    help='If set, store the weights of the exported inference model in half precision '
+                         '(default: False)')
+parser.add_argument('--export_compiled_model', action='store_true',
+                    help='export the encoder and a single decoder step of the checkpoint as TorchScript graphs '
+                         '(default: False)')
+parser.add_argument('--compiled_inference', action='store_true',
+                    help='If set, run inference with the exported TorchScript graphs (default: False)')
 parser.add_argument('--data_dir', type=str, default=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data'),
                     help='directory where the data is stored (default: None)')
 parser.add_argument('--db_dir', type=str, default=None,
@@ -60,7 +104,23 @@ parser.add_argument('--viz_dir', type=str, default=os.path.join(os.path.dirname(
 parser.add_argument('--save_all_checkpoints', action='store_true',
                     help='If set, save all checkpoints during training; otherwise, save the checkpoints w/ the best '
                          'dev performance only. (default: False)')
+parser.add_argument('--num_checkpoints_to_keep', type=int, default=0,
+                    help='number of most recent periodic checkpoints kept on disk when --save_all_checkpoints is set, '
+                         'the best model is always kept (default: 0, keep all)')
+parser.add_argument('--synchronous_checkpointing', action='store_true',
+                    help='If set, write checkpoints on the training thread instead of in the background '
+                         '(default: False)')
 parser.add_argument('--gpu', type=int, default=0, help='gpu device (default: 0)')
+parser.add_argument('--cpu', action='store_true',
+                    help='If set, run on the CPU even if a GPU is available, e.g. for CPU inference (default: False)')
+parser.add_argument('--quantize_inference', action='store_true',
+                    help='If set, run inference on the CPU with the weights dynamically quantized to int8 '
+                         '(default: False)')
+parser.add_argument('--quantization_report', action='store_true',
+                    help='compare the accuracy, latency and size of the int8 quantized model against the fp32 model '
+                         'on a dev subset (default: False)')
+parser.add_argument('--quantization_report_size', type=int, default=200,
+                    help='number of dev examples used in the quantization report (default: 200)')
 
 # Leaderboard submission
 parser.add_argument('--leaderboard_submission', action='store_true',
@@ -73,6 +133,15 @@ parser.add_argument('--checkpoint_path', type=str, default=None,
                     help='path to a pretrained checkpoint (default: None)')
 parser.add_argument('--prediction_path', type=str, default=None,
                     help='path to which the model prediction is saved (default: None)')
+parser.add_argument('--stream_input_path', type=str, default=None,
+                    help='JSONL file of questions ({"question": ..., "db_id": ...} per line) translated by --inference '
+                         'in chunks, with the predictions appended to --prediction_path and the progress checkpointed '
+                         '(default: None)')
+parser.add_argument('--stream_chunk_size', type=int, default=1000,
+                    help='number of questions of the stream preprocessed and decoded together (default: 1000)')
+parser.add_argument('--num_preprocess_workers', type=int, default=0,
+                    help='number of worker processes that preprocess the next chunk of the stream while the current '
+                         'chunk is decoded; 0 preprocesses in the inference process (default: 0)')
 
 # Data
 parser.add_argument('--use_pred_tables', action='store_true',
@@ -104,7 +173,16 @@ parser.add_argument('--question_only', action='store_true',
 parser.add_argument('--pretrained_transformer', type=str, default='',
                     help='Specify pretrained transformer model to use.')
 parser.add_argument('--fix_pretrained_transformer_parameters', action='store_true',
-                    help='If set, no finetuning is performed on the pretrained BERT embeddings (default: False).')
+                    help='If set, no finetuning is performed on the pretrained BERT embeddings, which are computed '
+                         'without the dropout inside the transformer (default: False).')
+parser.add_argument('--cache_encoder_features', action='store_true',
+                    help='If set, cache the outputs of the fixed pretrained transformer on disk and reuse them for '
+                         'repeated inputs; requires --fix_pretrained_transformer_parameters (default: False).')
+parser.add_argument('--encoder_feature_cache_dir', type=str, default=None,
+                    help='directory where the transformer output cache is stored (default: '
+                         '<model_root_dir>/encoder_feature_cache)')
+parser.add_argument('--encoder_feature_cache_half_precision', action='store_true',
+                    help='If set, store the cached transformer outputs in half precision (default: False).')
 parser.add_argument('--use_typed_field_markers', action='store_true',
                     help='If set, use typed column special tokens to feed into the BERT layer (default: False).')
 parser.add_argument('--vocab_min_freq', type=int, default=1,
@@ -144,9 +222,24 @@ parser.add_argument('--process_sql_in_execution_order', action='store_true',
                     help='Generate and process SQL clauses in execution order (default: False)')
 parser.add_argument('--sql_consistency_check', action='store_true',
                     help='Check consistency of a genereated SQL query (default: False)')
+parser.add_argument('--pred_restored_cache_size', type=int, default=1000000,
+                    help='maximum number of queries in the execution order restoration cache, the least recently used '
+                         'ones are evicted (default: 1000000)')
 
 parser.add_argument('--data_parallel', action='store_true',
                     help='If set, use data parallelization. (default: False)')
+parser.add_argument('--distributed', action='store_true',
+                    help='If set, run multi-process distributed data parallel training, one process per rank '
+                         'launched with torchrun. (default: False)')
+parser.add_argument('--dist_backend', type=str, default='gloo',
+                    help='distributed communication backend, "gloo" runs on CPU-only machines (default: gloo)')
+parser.add_argument('--dist_init_method', type=str, default='env://',
+                    help='URL used to set up the distributed process group (default: env://)')
+parser.add_argument('--dist_timeout', type=int, default=120,
+                    help='minutes a rank waits at a collective before timing out, must cover a dev set evaluation '
+                         '(default: 120)')
+parser.add_argument('--local_rank', type=int, default=int(os.environ.get('LOCAL_RANK', 0)),
+                    help='rank of the process on the local node, set by the launcher (default: 0)')
 
 # Encoder-decoder model
 parser.add_argument('--model', type=str, default='bridge',
@@ -254,6 +347,14 @@ parser.add_argument('--num_accumulation_steps', type=int, default=1,
                     help='number of steps to wait before running an optimizer step (default: 1)')
 parser.add_argument('--num_log_steps', type=int, default=500,
                     help='number of steps to wait for next wandb log save (default: 500)')
+parser.add_argument('--profile_interval', type=int, default=0,
+                    help='number of training steps over which the step time, throughput, padding ratio and peak memory '
+                         'statistics are summarized, 0 disables the profiler (default: 0)')
+parser.add_argument('--torch_profiler_start_step', type=int, default=-1,
+                    help='number of training steps after which a torch.profiler trace is started, -1 disables the '
+                         'trace (default: -1)')
+parser.add_argument('--torch_profiler_num_steps', type=int, default=5,
+                    help='number of training steps recorded in the torch.profiler trace (default: 5)')
 parser.add_argument('--start_step', type=int, default=0,
                     help='step from which the training should start (default: 0)')
 parser.add_argument('--train_batch_size', type=int, default=256,
@@ -295,13 +396,36 @@ parser.add_argument('--random_parameters', type=bool, default=False,
 
 # Search Decoding
 parser.add_argument('--decoding_algorithm', type=str, default='beam-search',
-                    help='decoding algorithm (default: "beam-search")')
+                    choices=['beam-search', 'greedy', 'adaptive'],
+                    help='decoding algorithm; "greedy" and "adaptive" are supported for the bridge model only. '
+                         '"adaptive" decodes with a beam of size --fast_beam_size and re-decodes the examples without '
+                         'a valid prediction with a beam of size --beam_size (default: "beam-search")')
 parser.add_argument('--beam_size', type=int, default=100,
                     help='size of beam used in beam search inference (default: 100))')
+parser.add_argument('--fast_beam_size', type=int, default=1,
+                    help='size of beam used in the first pass of adaptive decoding (default: 1)')
 parser.add_argument('--bs_alpha', type=float, default=1,
                     help='bea, search length normalization coefficient')
 parser.add_argument('--execution_guided_decoding', action='store_true',
                     help='If set, use execution guided decoding to prune decoded queries.')
+parser.add_argument('--num_execution_workers', type=int, default=4,
+                    help='number of threads that execute the decoded queries in execution guided decoding '
+                         '(default: 4)')
+parser.add_argument('--execution_timeout', type=float, default=1.0,
+                    help='maximum execution time of a decoded query in seconds in execution guided decoding, a query '
+                         'that times out is pruned (default: 1.0)')
+parser.add_argument('--execution_max_rows', type=int, default=1000,
+                    help='maximum number of result rows fetched per decoded query in execution guided decoding '
+                         '(default: 1000)')
+parser.add_argument('--grammar_constrained_decoding', action='store_true',
+                    help='If set, prune the continuations that violate the SQL grammar or the schema at each beam search '
+                         'step; the bridge model only (default: False)')
+parser.add_argument('--num_post_process_workers', type=int, default=0,
+                    help='number of worker processes that post-process the beam search outputs while the next '
+                         'mini-batch is decoded; 0 post-processes in the inference process (default: 0)')
+parser.add_argument('--first_valid_prediction_only', action='store_true',
+                    help='If set, stop post-processing the beams of an example once one of them passes the checks and '
+                         'output this prediction only (default: False)')
 
 # Hyperparameter Search
 parser.add_argument('--tune', type=str, default='',
@@ -0,0 +1,119 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Post-processing of the beam search outputs in worker processes.
+"""
+
+import multiprocessing
+import weakref
+
+# State of the worker processes, inherited from the inference process when the workers are forked
+worker_framework = None
+# Execution order restoration cache of a worker, by path, reused by the tasks of all inference calls
+worker_restored_caches = dict()
+
+
+def get_worker_restored_cache(pred_restored_cache):
+    if pred_restored_cache is None:
+        return None
+    if pred_restored_cache.path not in worker_restored_caches:
+        worker_restored_caches[pred_restored_cache.path] = pred_restored_cache
+    return worker_restored_caches[pred_restored_cache.path]
+
+
+def post_process_example(task):
+    """
+    Post-process the beam search outputs of an example in a worker process.
+    :param task: ((example, preds, table_po, field_po, stop_at_first_valid), schema, kwargs) where preds holds the
+        beam search outputs of the example, schema is None if the worker was forked with the schema graph of the
+        example and kwargs are the keyword arguments of framework.post_process_beam_search_outputs.
+    :return: (list of (j, post_processed_output, pred_sql) of the post-processed beams, number of queries inserted in
+        the execution order restoration cache).
+    """
+    (example, preds, table_po, field_po, stop_at_first_valid), schema, kwargs = task
+    if schema is None:
+        schema = worker_framework.schema_graphs[example.db_name]
+    pred_restored_cache = get_worker_restored_cache(kwargs['pred_restored_cache'])
+    kwargs = dict(kwargs, pred_restored_cache=pred_restored_cache)
+    num_new_entries = pred_restored_cache.num_new_entries if pred_restored_cache is not None else 0
+    candidates = []
+    for candidate in worker_framework.post_process_beam_search_outputs(
+            0, example, preds, preds.size(0), schema, table_po=table_po, field_po=field_po, **kwargs):
+        candidates.append(candidate)
+        if stop_at_first_valid and candidate[2]:
+            break
+    if pred_restored_cache is not None:
+        # the workers are not notified when the inference call ends
+        pred_restored_cache.flush()
+        num_new_entries = pred_restored_cache.num_new_entries - num_new_entries
+    return candidates, num_new_entries
+
+
+class PostProcessResult(object):
+    """
+    Outputs of the tasks of a mini-batch.
+    """
+    def __init__(self, async_result, pred_restored_cache=None):
+        self.async_result = async_result
+        self.pred_restored_cache = pred_restored_cache
+
+    def get(self):
+        """
+        :return: list of task outputs (see post_process_example).
+        """
+        outputs = self.async_result.get()
+        if self.pred_restored_cache is not None:
+            # count the insertions of the workers in the cache object of the caller
+            self.pred_restored_cache.num_new_entries += sum(num_new_entries for _, num_new_entries in outputs)
+        return [candidates for candidates, _ in outputs]
+
+
+class BeamPostProcessor(object):
+    """
+    Pool of worker processes that de-vectorize the beam search outputs and check their syntax and schema
+    consistency, one task per example.
+
+    The workers are forked once per run and reused by all inference calls, since forking a process that runs other
+    threads (e.g. the checkpoint writer or the demo server) may deadlock the workers. They share the copy of the
+    model framework and the schema graphs of the inference process as of the fork; the schema graphs added or
+    replaced afterwards are sent with the tasks. The execution order restoration cache is a store shared by all
+    processes, to which the workers write their restorations directly. The tasks of a mini-batch are submitted
+    without blocking, so that they are processed while the next mini-batch is decoded.
+    """
+    def __init__(self, framework, num_workers):
+        """
+        :param framework: EncoderDecoderLFramework used for inference.
+        :param num_workers: Number of worker processes.
+        """
+        global worker_framework
+        worker_framework = framework
+        self.framework = framework
+        # schema graphs the workers were forked with
+        self.forked_schema_graphs = weakref.WeakValueDictionary()
+        if framework.schema_graphs is not None:
+            for db_name in framework.schema_graphs.db_index:
+                self.forked_schema_graphs[db_name] = framework.schema_graphs[db_name]
+        self.pool = multiprocessing.get_context('fork').Pool(num_workers)
+
+    def submit(self, tasks, **kwargs):
+        """
+        :param tasks: list of (example, preds, table_po, field_po, stop_at_first_valid).
+        :param kwargs: Keyword arguments passed to framework.post_process_beam_search_outputs.
+        :return: PostProcessResult of the tasks.
+        """
+        worker_tasks = []
+        for task in tasks:
+            db_name = task[0].db_name
+            schema = self.framework.schema_graphs[db_name]
+            worker_tasks.append((task, None if self.forked_schema_graphs.get(db_name) is schema else schema, kwargs))
+        return PostProcessResult(self.pool.map_async(post_process_example, worker_tasks, chunksize=1),
+                                 pred_restored_cache=kwargs.get('pred_restored_cache', None))
+
+    def close(self):
+        global worker_framework
+        self.pool.close()
+        self.pool.join()
+        worker_framework = None
@@ -17,15 +17,21 @@
             https://github.com/naver/sqlova
 """
 
+import os
+
 import torch
 import torch.nn as nn
 
-from src.semantic_parser.decoding_algorithms import beam_search
+import src.common.distributed as dist
+from src.common.encoder_feature_cache import EncoderFeatureCache
+from src.semantic_parser.decoding_algorithms import beam_search, get_beam_size, DECODING_ALGORITHMS
 from src.common.nn_modules import Embedding, ConcatAndProject, FusionLayer, Feedforward, Linear, PointerSwitch, \
-    SelfAttentionLayer, selective_read
+    SelfAttentionLayer, selective_read, beam_attention, beam_scatter_add
 import src.common.ops as ops
+import src.common.tracing as tracing
 from src.data_processor.sql.sql_operators import field_types
 from src.semantic_parser.seq2seq_ptr import PointerGenerator, RNNEncoder, RNNDecoder
+from src.semantic_parser.sql_grammar import SQLGrammar
 from src.utils.utils import BRIDGE
 
 
@@ -37,26 +43,53 @@ class Bridge(PointerGenerator):
         self.use_graph_encoding = args.use_graph_encoding
         super().__init__(args, in_vocab, out_vocab)
         self.model_id = BRIDGE
+        self.sql_grammar = SQLGrammar(self.out_vocab, in_execution_order=args.process_sql_in_execution_order) \
+            if args.grammar_constrained_decoding else None
+
+        # Frozen transformer encoder output cache
+        if args.cache_encoder_features:
+            assert(self.pretrained_transformer and self.fix_pretrained_transformer_parameters)
+            cache_root_dir = args.encoder_feature_cache_dir or \
+                os.path.join(args.model_root_dir, 'encoder_feature_cache')
+            self.encoder_feature_cache = EncoderFeatureCache(
+                cache_root_dir, half_precision=args.encoder_feature_cache_half_precision, rank=dist.get_rank())
+        else:
+            self.encoder_feature_cache = None
+
+        # Confusion span detector head sharing the transformer encoder (see set_confusion_span_extractor)
+        self.span_extractor = None
+
+    def encode_transformer(self, inputs, input_masks):
+        """
+        :return inputs_embedded: [batch_size, input_seq_len, encoder_input_dim] pretrained transformer encoding.
+        """
+        segment_ids, position_ids = self.get_segment_and_position_ids(inputs)
+        if self.encoder_feature_cache is not None:
+            trans_hiddens = self.encoder_embeddings.module if self.data_parallel else self.encoder_embeddings
+            return self.encoder_feature_cache(
+                trans_hiddens, inputs, input_masks, segments=segment_ids, position_ids=position_ids)
+        inputs_embedded, _ = self.encoder_embeddings(
+            inputs, input_masks, segments=segment_ids, position_ids=position_ids)
+        return inputs_embedded
 
     def forward(self, encoder_ptr_input_ids, encoder_ptr_value_ids, text_masks, schema_masks, feature_ids,
                 transformer_output_value_masks=None, schema_memory_masks=None, decoder_input_ids=None,
-                decoder_ptr_value_ids=None):
+                decoder_ptr_value_ids=None, beam_size=None):
         # Encoder operations
         # => [batch_size, input_seq_len]
         inputs, input_masks = encoder_ptr_input_ids
-        if self.pretrained_transformer:
-            segment_ids, position_ids = self.get_segment_and_position_ids(inputs)
-            inputs_embedded, _ = self.encoder_embeddings(
-                inputs, input_masks, segments=segment_ids, position_ids=position_ids)
-        else:
-            inputs_embedded = self.encoder_embeddings(inputs)
-        encoder_hiddens, encoder_hidden_masks, constant_hidden_masks, schema_hidden_masks, hidden = \
-            self.encoder(inputs_embedded,
-                         input_masks,
-                         text_masks,
-                         schema_masks,
-                         feature_ids,
-                         transformer_output_value_masks)
+        with tracing.span('encoder'):
+            if self.pretrained_transformer:
+                inputs_embedded = self.encode_transformer(inputs, input_masks)
+            else:
+                inputs_embedded = self.encoder_embeddings(inputs)
+            encoder_hiddens, encoder_hidden_masks, constant_hidden_masks, schema_hidden_masks, hidden = \
+                self.encoder(inputs_embedded,
+                             input_masks,
+                             text_masks,
+                             schema_masks,
+                             feature_ids,
+                             transformer_output_value_masks)
         # Decoder operations
         # => [batch_size, target_seq_len]
         if self.training:
@@ -73,7 +106,7 @@ class Bridge(PointerGenerator):
             return outputs[0]
         else:
             with torch.no_grad():
-                if self.decoding_algorithm == 'beam-search':
+                if self.decoding_algorithm in DECODING_ALGORITHMS:
                     # [batch_size, schema_seq_len]
                     table_masks, _ = feature_ids[3]
                     table_pos, _ = feature_ids[4]
@@ -82,22 +115,29 @@ class Bridge(PointerGenerator):
                         db_scope = (table_pos, table_field_scope)
                     else:
                         db_scope = None
-                    return beam_search(self.bs_alpha,
-                                       self.model_id,
-                                       self.decoder,
-                                       self.decoder_embeddings,
-                                       self.max_out_seq_len,
-                                       self.beam_size,
-                                       hidden,
-                                       encoder_hiddens=encoder_hiddens,
-                                       encoder_masks=encoder_hidden_masks,
-                                       constant_hidden_masks=constant_hidden_masks,
-                                       schema_hidden_masks=schema_hidden_masks,
-                                       table_masks=table_masks,
-                                       encoder_ptr_value_ids=encoder_ptr_value_ids,
-                                       schema_memory_masks=schema_memory_masks,
-                                       db_scope=db_scope,
-                                       no_from=(self.dataset_name == 'wikisql'))
+                    with tracing.span('beam_search'):
+                        outputs = beam_search(self.bs_alpha,
+                                              self.model_id,
+                                              self.decoder,
+                                              self.decoder_embeddings,
+                                              self.max_out_seq_len,
+                                              get_beam_size(self.decoding_algorithm, self.beam_size, beam_size),
+                                              hidden,
+                                              encoder_hiddens=encoder_hiddens,
+                                              encoder_masks=encoder_hidden_masks,
+                                              constant_hidden_masks=constant_hidden_masks,
+                                              schema_hidden_masks=schema_hidden_masks,
+                                              table_masks=table_masks,
+                                              encoder_ptr_value_ids=encoder_ptr_value_ids,
+                                              schema_memory_masks=schema_memory_masks,
+                                              db_scope=db_scope,
+                                              no_from=(self.dataset_name == 'wikisql'),
+                                              sql_grammar=self.sql_grammar)
+                    if self.span_extractor is not None:
+                        # [batch_size, 2, text_len + 1] confusion span logits from the same encoder pass
+                        with tracing.span('confusion_detection'):
+                            outputs = outputs + (self.span_extractor.extract(inputs_embedded, text_masks),)
+                    return outputs
                 else:
                     raise NotImplementedError
 
@@ -300,14 +340,16 @@ class BridgeDecoder(RNNDecoder):
         :param pointer_context
             p_pointer - [batch_size, seq_len(=1), 1]
             attn_weights - [batch_size, num_head, seq_len(=1), attn_value_dim]
-        :param encoder_hiddens: [batch_size, encoder_seq_len, hidden_dim]
-        :param encoder_hidden_masks: [batch_size, encoder_seq_len]
+        :param encoder_hiddens: [encoder_batch_size, encoder_seq_len, hidden_dim]
+            During beam search, the encoder outputs are shared by the beam_size hypotheses of each example, i.e.
+            batch_size = encoder_batch_size * beam_size.
+        :param encoder_hidden_masks: [encoder_batch_size, encoder_seq_len]
         :param pointer_context:
         :param vocab_masks: [batch_size, vocab_size] binary mask in which the banned vocab entries are set to 0 and the
             rest are set to 1.
         :param memory_masks: [batch_size, memory_seq_len] binary mask in which the banned memory entries are set
             to 0 and the rest are set to 1.
-        :param encoder_ptr_value_ids: [batch_size, encoder_seq_len] mapping element in the memory to the
+        :param encoder_ptr_value_ids: [encoder_batch_size, encoder_seq_len] mapping element in the memory to the
             pointing-generating vocabulary. If None, the pointing and generating libraries do not overlap.
         :param decoder_ptr_value_ids: [batch_size, decoder_seq_len]
             Decoder output ground truth. Used during training only.
@@ -320,14 +362,15 @@ class BridgeDecoder(RNNDecoder):
             attn_weights - [batch_size, num_head, seq_len(=1), encoder_seq_len]
         """
         assert (encoder_hiddens.size(1) == encoder_ptr_value_ids.size(1))
-        batch_size = len(input_embedded)
+        batch_size = input_embedded.size(0)
 
         # unpack input_embedded
         if pointer_context:
             p_pointer, attn_weights = pointer_context
         else:
-            p_pointer = ops.zeros_var_cuda([batch_size, 1, 1])
-            attn_weights = ops.zeros_var_cuda([batch_size, self.attn.num_heads, 1, encoder_hiddens.size(1)])
+            p_pointer = ops.zeros_var([batch_size, 1, 1], device=encoder_hiddens.device)
+            attn_weights = ops.zeros_var([batch_size, self.attn.num_heads, 1, encoder_hiddens.size(1)],
+                                         device=encoder_hiddens.device)
 
         outputs, hiddens = [], []
         seq_attn_weights = []
@@ -351,7 +394,7 @@ class BridgeDecoder(RNNDecoder):
                 hiddens.append(hidden)
             # a) compute attention vector and attention weights
             # [batch_size, 1, attn_value_dim], [batch_size, num_head, 1, encoder_seq_len]
-            attn_vec, attn_weights = self.attn(output, encoder_hiddens, encoder_hiddens, encoder_hidden_masks)
+            attn_vec, attn_weights = beam_attention(self.attn, output, encoder_hiddens, encoder_hidden_masks)
             # b) compute pointer-generator switch
             # [batch_size, 1, 3]
             p_pointer = self.pointer_switch(output, attn_vec)
@@ -378,10 +421,10 @@ class BridgeDecoder(RNNDecoder):
             if encoder_ptr_value_ids is None:
                 point_gen_prob = torch.cat([(1 - p_pointer) * gen_prob, weighted_point_prob], dim=2)
             else:
-                gen_prob_zeros_pad = ops.zeros_var_cuda((batch_size, 1, encoder_hiddens.size(1)))
+                gen_prob_zeros_pad = ops.zeros_var((batch_size, 1, encoder_hiddens.size(1)),
+                                                   device=encoder_hiddens.device)
                 weighted_gen_prob = torch.cat([(1 - p_pointer) * gen_prob, gen_prob_zeros_pad], dim=2)
-                point_gen_prob = weighted_gen_prob.scatter_add_(index=encoder_ptr_value_ids.unsqueeze(1),
-                                                                src=weighted_point_prob, dim=2)
+                point_gen_prob = beam_scatter_add(weighted_gen_prob, encoder_ptr_value_ids, weighted_point_prob)
             point_gen_logit = ops.safe_log(point_gen_prob)
 
             outputs.append(point_gen_logit), seq_attn_weights.append(attn_weights),\
@@ -0,0 +1,398 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ TorchScript export of the BRIDGE model for inference.
+
+ The model is exported as two TorchScript artifacts:
+    encoder.pt - pre-trained transformer + schema-aware encoder, mapping the encoder input tensors to the encoder
+        memory and the initial decoder state.
+    decoder_step.pt - a single BridgeDecoder step with explicit state inputs and outputs.
+ CompiledBridge loads the artifacts and drives beam search over them. It can replace Bridge at inference time.
+"""
+
+import copy
+import os
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+import src.common.ops as ops
+from src.common.quantization import remove_weight_dropout
+from src.semantic_parser.decoding_algorithms import beam_search, get_beam_size, DECODING_ALGORITHMS
+
+ENCODER_FILE_NAME = 'encoder.pt'
+DECODER_STEP_FILE_NAME = 'decoder_step.pt'
+
+
+@torch.jit.script
+def batch_binary_lookup_3D(M: torch.Tensor, b_idx: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    TorchScript version of ops.batch_binary_lookup_3D (with pad_value = 0). The output length depends on the input
+    values, hence this operation cannot be traced.
+    """
+    batch_size, hidden_dim = M.size(0), M.size(2)
+    b_idx = b_idx != 0
+    seq_len = b_idx.long().sum(dim=1, keepdim=True)
+    max_seq_len = int(seq_len.max())
+    output_masks = torch.arange(max_seq_len, device=M.device).unsqueeze(0) >= seq_len
+    pad_len = max_seq_len - seq_len
+    max_pad_len = int(pad_len.max())
+    M = torch.cat([M, torch.zeros([batch_size, max_pad_len, hidden_dim], dtype=M.dtype, device=M.device)], dim=1)
+    pad_b_idx = torch.arange(max_pad_len, device=M.device).unsqueeze(0) < pad_len
+    b_idx = torch.cat([b_idx, pad_b_idx], dim=1)
+    output = M[b_idx].view(batch_size, max_seq_len, hidden_dim)
+    return output, output_masks
+
+
+@torch.jit.script
+def merge_padded_seq_3D(hiddens1: torch.Tensor, masks1: torch.Tensor, hiddens2: torch.Tensor,
+                        masks2: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    TorchScript version of ops.merge_padded_seq_3D.
+    """
+    batch_size = hiddens1.size(0)
+    seq_len1 = masks1.size(1) - masks1.long().sum(dim=1)
+    seq_len2 = masks2.size(1) - masks2.long().sum(dim=1)
+    merged_size = seq_len1 + seq_len2
+    max_merged_size = int(merged_size.max())
+    res1 = max_merged_size - hiddens1.size(1)
+    merged_hiddens = torch.cat([hiddens1, torch.zeros([batch_size, res1, hiddens1.size(2)], dtype=hiddens1.dtype,
+                                                      device=hiddens1.device)], dim=1)
+    scatter_index2 = seq_len1.unsqueeze(1) + torch.arange(hiddens2.size(1), device=hiddens2.device).unsqueeze(0)
+    scatter_index_masks2 = (scatter_index2 < max_merged_size)
+    scatter_index2 = scatter_index2 * scatter_index_masks2.long()
+    merged_hiddens = merged_hiddens.scatter_add(
+        1, scatter_index2.unsqueeze(2).expand_as(hiddens2), hiddens2 * scatter_index_masks2.unsqueeze(2).float())
+    merged_hidden_masks = \
+        torch.arange(max_merged_size, device=hiddens1.device).unsqueeze(0) >= merged_size.unsqueeze(1)
+    return merged_hiddens, merged_hidden_masks
+
+
+class TransformerEncoder(nn.Module):
+    """
+    Encoder embedding layer (pre-trained transformer or word embeddings) with a fixed tensor signature.
+    """
+    def __init__(self, encoder_embeddings, pretrained):
+        super().__init__()
+        self.encoder_embeddings = encoder_embeddings
+        self.pretrained = pretrained
+
+    def forward(self, inputs, input_masks, segment_ids):
+        if self.pretrained:
+            inputs_embedded, _ = self.encoder_embeddings(inputs, input_masks, segments=segment_ids)
+            return inputs_embedded
+        else:
+            return self.encoder_embeddings(inputs)
+
+
+class ConstantEncoder(nn.Module):
+    def __init__(self, constant_encoder):
+        super().__init__()
+        self.constant_encoder = constant_encoder
+
+    def forward(self, constant_hiddens, constant_hidden_masks):
+        constant_hiddens, _ = self.constant_encoder(constant_hiddens, constant_hidden_masks)
+        return constant_hiddens
+
+
+class SchemaEncoder(nn.Module):
+    def __init__(self, schema_encoder):
+        super().__init__()
+        self.schema_encoder = schema_encoder
+
+    def forward(self, schema_hiddens, primary_key_ids, foreign_key_ids, field_type_ids, table_masks):
+        feature_ids = ((primary_key_ids, None), (foreign_key_ids, None), (field_type_ids, None), (table_masks, None))
+        return self.schema_encoder(schema_hiddens, feature_ids)
+
+
+class PassThrough(nn.Module):
+    """
+    Placeholder of an encoder layer disabled in the model configuration.
+    """
+    def forward(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        return x
+
+
+class PassThroughSchemaEncoder(nn.Module):
+    def forward(self, schema_hiddens: torch.Tensor, primary_key_ids: torch.Tensor, foreign_key_ids: torch.Tensor,
+                field_type_ids: torch.Tensor, table_masks: torch.Tensor) -> torch.Tensor:
+        return schema_hiddens
+
+
+class BridgeEncoderGraph(nn.Module):
+    """
+    Bridge encoder with explicit tensor inputs and outputs (mirrors Bridge.forward and
+    SchemaAwareTransformerEncoder.forward up to the decoder).
+
+    The submodules are traced separately, and this module is scripted on top of them, so that the value-dependent
+    sequence compaction is preserved in the exported graph.
+    """
+    def __init__(self, transformer_encoder, hidden_proj, constant_encoder, schema_encoder, sep_id, pretrained,
+                 read_picklist, num_const_attn_layers, decoder_hidden_dim):
+        super().__init__()
+        self.transformer_encoder = transformer_encoder
+        self.hidden_proj = hidden_proj
+        self.constant_encoder = constant_encoder
+        self.schema_encoder = schema_encoder
+        self.sep_id = sep_id
+        self.pretrained = pretrained
+        self.read_picklist = read_picklist
+        self.num_const_attn_layers = num_const_attn_layers
+        self.decoder_hidden_dim = decoder_hidden_dim
+
+    def forward(self, inputs: torch.Tensor, input_masks: torch.Tensor, text_masks: torch.Tensor,
+                schema_masks: torch.Tensor, transformer_output_value_masks: torch.Tensor,
+                primary_key_ids: torch.Tensor, foreign_key_ids: torch.Tensor, field_type_ids: torch.Tensor,
+                table_masks: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor,
+                                                    torch.Tensor, torch.Tensor]:
+        # [CLS] w1 w2 ... [SEP] * [T] ...
+        # 0     0  0  ...  0  1 1 ...
+        position_ids = torch.arange(inputs.size(1), device=inputs.device).unsqueeze(0)
+        seg1_end_pos = (inputs == self.sep_id).long().argmax(dim=1)
+        segment_ids = (position_ids > seg1_end_pos.unsqueeze(1)).long()
+        encoder_base_hiddens = self.transformer_encoder(inputs, input_masks, segment_ids)
+
+        # -- Text Encoder
+        text_hiddens = encoder_base_hiddens[:, 1:text_masks.size(1) + 1, :]
+        hidden = self.hidden_proj(text_hiddens[:, -1, :])
+        h = hidden[:, :self.decoder_hidden_dim].unsqueeze(0).contiguous()
+        c = hidden[:, self.decoder_hidden_dim:].unsqueeze(0).contiguous()
+        if self.read_picklist:
+            values_embedded, values_masks = batch_binary_lookup_3D(
+                encoder_base_hiddens, transformer_output_value_masks)
+            constant_hiddens, constant_hidden_masks = merge_padded_seq_3D(
+                text_hiddens, text_masks, values_embedded, values_masks)
+            for _ in range(self.num_const_attn_layers):
+                constant_hiddens = self.constant_encoder(constant_hiddens, constant_hidden_masks)
+        else:
+            constant_hiddens = text_hiddens
+            constant_hidden_masks = text_masks != 0
+
+        # -- Schema Encoder
+        schema_hiddens, schema_hidden_masks = batch_binary_lookup_3D(encoder_base_hiddens, schema_masks)
+        schema_hiddens = self.schema_encoder(schema_hiddens, primary_key_ids, foreign_key_ids, field_type_ids,
+                                             table_masks)
+
+        # -- Merge text and schema encodings
+        encoder_hiddens, encoder_hidden_masks = merge_padded_seq_3D(
+            constant_hiddens, constant_hidden_masks, schema_hiddens, schema_hidden_masks)
+        return encoder_hiddens, encoder_hidden_masks, constant_hidden_masks, schema_hidden_masks, h, c
+
+
+class BridgeDecoderStep(nn.Module):
+    """
+    A single decoding step of BridgeDecoder with explicit state inputs and outputs.
+    """
+    def __init__(self, decoder, decoder_embeddings):
+        super().__init__()
+        self.decoder = decoder
+        self.decoder_embeddings = decoder_embeddings
+
+    def forward(self, input_feed, last_output, h, c, p_pointer, attn_weights, encoder_hiddens, encoder_hidden_masks,
+                memory_masks, encoder_ptr_value_ids):
+        """
+        :param input_feed: [batch_size, 1] decoder input ids (copied memory entries mapped to their types).
+        :param last_output: [batch_size, 1] output ids of the previous step.
+        :param h: [num_layers, batch_size, hidden_dim]
+        :param c: [num_layers, batch_size, hidden_dim]
+        :param p_pointer: [batch_size, 1, 1]
+        :param attn_weights: [batch_size, num_heads, 1, encoder_seq_len]
+        :param memory_masks: [batch_size, encoder_seq_len]
+        :return: output logits [batch_size, 1, vocab_size + encoder_seq_len] and the updated state.
+        """
+        input_embedded = self.decoder_embeddings(input_feed)
+        output, (h, c), (p_pointer, attn_weights) = self.decoder(
+            input_embedded, (h, c), encoder_hiddens, encoder_hidden_masks, (p_pointer, attn_weights),
+            memory_masks=memory_masks, encoder_ptr_value_ids=encoder_ptr_value_ids, last_output=last_output)
+        return output, h, c, p_pointer, attn_weights
+
+
+def get_encoder_inputs(encoder_ptr_input_ids, text_masks, schema_masks, feature_ids,
+                       transformer_output_value_masks=None):
+    """
+    Flatten the Bridge.forward encoder arguments into the BridgeEncoderGraph inputs.
+    """
+    inputs, input_masks = encoder_ptr_input_ids
+    if transformer_output_value_masks is None:
+        transformer_output_value_masks = torch.zeros_like(input_masks)
+    return (inputs, input_masks, text_masks, schema_masks, transformer_output_value_masks, feature_ids[0][0],
+            feature_ids[1][0], feature_ids[2][0], feature_ids[3][0])
+
+
+def initial_pointer_context(batch_size, num_heads, encoder_seq_len, device):
+    return (ops.zeros_var([batch_size, 1, 1], device=device),
+            ops.zeros_var([batch_size, num_heads, 1, encoder_seq_len], device=device))
+
+
+def trace(mdl, example_inputs):
+    # The built-in trace check compares graphs of two tracing runs and fails on renamed values; the compiled model is
+    # compared against the eager model after export instead.
+    return torch.jit.trace(mdl, example_inputs, check_trace=False)
+
+
+def export_compiled_bridge(bridge, encoder_inputs, out_dir, read_picklist=False):
+    """
+    Trace and script the Bridge model on an example batch and save the artifacts to out_dir.
+    :param bridge: Bridge module with the trained weights loaded.
+    :param encoder_inputs: example BridgeEncoderGraph inputs (see get_encoder_inputs).
+    :param read_picklist: If set, the picklist values are encoded with the text.
+    """
+    if bridge.use_lstm_encoder:
+        raise NotImplementedError('Export of the LSTM schema-aware encoder is not supported')
+    bridge = remove_weight_dropout(copy.deepcopy(bridge)).eval()
+    encoder = bridge.encoder
+    pretrained = bool(bridge.pretrained_transformer) and bridge.pretrained_transformer != 'null'
+    sep_id = bridge.tu.sep_id if pretrained else -1
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    with torch.no_grad():
+        inputs, input_masks, text_masks, schema_masks, value_masks, primary_key_ids, foreign_key_ids, \
+            field_type_ids, table_masks = encoder_inputs
+
+        # Trace the submodules on the intermediate results of the example batch
+        encoder_embeddings = bridge.encoder_embeddings
+        if isinstance(encoder_embeddings, nn.DataParallel):
+            encoder_embeddings = encoder_embeddings.module
+        position_ids = ops.arange_var(inputs.size(1), device=inputs.device).unsqueeze(0)
+        segment_ids = (position_ids > (inputs == sep_id).long().argmax(dim=1).unsqueeze(1)).long()
+        transformer_encoder = TransformerEncoder(encoder_embeddings, pretrained)
+        encoder_base_hiddens = transformer_encoder(inputs, input_masks, segment_ids)
+        transformer_encoder = trace(transformer_encoder, (inputs, input_masks, segment_ids))
+
+        text_hiddens = encoder_base_hiddens[:, 1:text_masks.size(1) + 1, :]
+        hidden_proj = trace(encoder.hidden_proj, text_hiddens[:, -1, :])
+
+        if read_picklist and encoder.num_const_attn_layers > 0:
+            values_embedded, values_masks = batch_binary_lookup_3D(encoder_base_hiddens, value_masks)
+            constant_hiddens, constant_hidden_masks = merge_padded_seq_3D(
+                text_hiddens, text_masks, values_embedded, values_masks)
+            constant_encoder = trace(ConstantEncoder(encoder.constant_encoder),
+                                               (constant_hiddens, constant_hidden_masks))
+        else:
+            constant_encoder = torch.jit.script(PassThrough())
+
+        if encoder.use_meta_data_encoding:
+            schema_hiddens, _ = batch_binary_lookup_3D(encoder_base_hiddens, schema_masks)
+            schema_encoder = trace(
+                SchemaEncoder(encoder.schema_encoder),
+                (schema_hiddens, primary_key_ids, foreign_key_ids, field_type_ids, table_masks))
+        else:
+            schema_encoder = torch.jit.script(PassThroughSchemaEncoder())
+
+        encoder_graph = torch.jit.script(BridgeEncoderGraph(
+            transformer_encoder, hidden_proj, constant_encoder, schema_encoder, sep_id, pretrained, read_picklist,
+            encoder.num_const_attn_layers, encoder.decoder_hidden_dim))
+        encoder_path = os.path.join(out_dir, ENCODER_FILE_NAME)
+        encoder_graph.save(encoder_path)
+        print('=> compiled encoder saved to \'{}\''.format(encoder_path))
+
+        # Trace a single decoder step
+        encoder_hiddens, encoder_hidden_masks, _, _, h, c = encoder_graph(*encoder_inputs)
+        batch_size, encoder_seq_len = encoder_hidden_masks.size()
+        p_pointer, attn_weights = initial_pointer_context(
+            batch_size, bridge.decoder.attn.num_heads, encoder_seq_len, encoder_hiddens.device)
+        input_feed = ops.int_fill_var([batch_size, 1], bridge.out_vocab.start_id, device=encoder_hiddens.device)
+        memory_masks = ops.int_ones_var([batch_size, encoder_seq_len], device=encoder_hiddens.device)
+        encoder_ptr_value_ids = ops.int_zeros_var([batch_size, encoder_seq_len], device=encoder_hiddens.device)
+        decoder_step = trace(
+            BridgeDecoderStep(bridge.decoder, bridge.decoder_embeddings),
+            (input_feed, input_feed, h, c, p_pointer, attn_weights, encoder_hiddens, encoder_hidden_masks,
+             memory_masks, encoder_ptr_value_ids))
+        decoder_step_path = os.path.join(out_dir, DECODER_STEP_FILE_NAME)
+        decoder_step.save(decoder_step_path)
+        print('=> compiled decoder step saved to \'{}\''.format(decoder_step_path))
+
+
+class CompiledBridgeDecoder(object):
+    """
+    Adapter exposing the compiled decoder step through the BridgeDecoder interface used by beam_search.
+    """
+    def __init__(self, decoder_step, vocab, num_heads):
+        self.decoder_step = decoder_step
+        self.vocab = vocab
+        self.vocab_size = vocab.size
+        self.num_heads = num_heads
+        self.return_hiddens = False
+
+    @staticmethod
+    def embed(input_feed):
+        # The compiled decoder step embeds its own inputs
+        return input_feed
+
+    def __call__(self, input_feed, hidden, encoder_hiddens, encoder_hidden_masks, pointer_context=None,
+                 vocab_masks=None, memory_masks=None, encoder_ptr_value_ids=None, last_output=None):
+        batch_size = input_feed.size(0)
+        encoder_seq_len = encoder_hidden_masks.size(1)
+        if pointer_context is None:
+            pointer_context = initial_pointer_context(
+                batch_size, self.num_heads, encoder_seq_len, encoder_hiddens.device)
+        if memory_masks is None:
+            memory_masks = ops.int_ones_var([batch_size, encoder_seq_len], device=encoder_hiddens.device)
+        output, h, c, p_pointer, attn_weights = self.decoder_step(
+            input_feed, last_output, hidden[0], hidden[1], pointer_context[0], pointer_context[1], encoder_hiddens,
+            encoder_hidden_masks, memory_masks, encoder_ptr_value_ids)
+        return output, (h, c), (p_pointer, attn_weights)
+
+
+class CompiledBridge(nn.Module):
+    """
+    Inference runtime of the compiled Bridge model. The encoder and the decoder steps run as TorchScript graphs;
+    beam search runs in Python on top of them.
+    """
+    def __init__(self, bridge, model_dir, map_location='cpu'):
+        super().__init__()
+        self.encoder = torch.jit.load(os.path.join(model_dir, ENCODER_FILE_NAME), map_location=map_location)
+        self.decoder_step = torch.jit.load(os.path.join(model_dir, DECODER_STEP_FILE_NAME),
+                                           map_location=map_location)
+        self.decoder = CompiledBridgeDecoder(self.decoder_step, bridge.out_vocab, bridge.decoder.attn.num_heads)
+        self.in_vocab = bridge.in_vocab
+        self.out_vocab = bridge.out_vocab
+        self.tu = bridge.tu
+        self.model_id = bridge.model_id
+        self.decoding_algorithm = bridge.decoding_algorithm
+        self.bs_alpha = bridge.bs_alpha
+        self.beam_size = bridge.beam_size
+        self.max_out_seq_len = bridge.max_out_seq_len
+        self.dataset_name = bridge.dataset_name
+        self.sql_grammar = bridge.sql_grammar
+
+    def forward(self, encoder_ptr_input_ids, encoder_ptr_value_ids, text_masks, schema_masks, feature_ids,
+                transformer_output_value_masks=None, schema_memory_masks=None, decoder_input_ids=None,
+                decoder_ptr_value_ids=None, beam_size=None):
+        assert(not self.training)
+        with torch.no_grad():
+            encoder_hiddens, encoder_hidden_masks, constant_hidden_masks, schema_hidden_masks, h, c = self.encoder(
+                *get_encoder_inputs(encoder_ptr_input_ids, text_masks, schema_masks, feature_ids,
+                                    transformer_output_value_masks))
+            if self.decoding_algorithm in DECODING_ALGORITHMS:
+                table_masks, _ = feature_ids[3]
+                table_pos, _ = feature_ids[4]
+                if table_pos is not None:
+                    table_field_scope, _ = feature_ids[5]
+                    db_scope = (table_pos, table_field_scope)
+                else:
+                    db_scope = None
+                return beam_search(self.bs_alpha,
+                                   self.model_id,
+                                   self.decoder,
+                                   self.decoder.embed,
+                                   self.max_out_seq_len,
+                                   get_beam_size(self.decoding_algorithm, self.beam_size, beam_size),
+                                   (h, c),
+                                   encoder_hiddens=encoder_hiddens,
+                                   encoder_masks=encoder_hidden_masks,
+                                   constant_hidden_masks=constant_hidden_masks,
+                                   schema_hidden_masks=schema_hidden_masks,
+                                   table_masks=table_masks,
+                                   encoder_ptr_value_ids=encoder_ptr_value_ids,
+                                   schema_memory_masks=schema_memory_masks,
+                                   db_scope=db_scope,
+                                   no_from=(self.dataset_name == 'wikisql'),
+                                   sql_grammar=self.sql_grammar)
+            else:
+                raise NotImplementedError
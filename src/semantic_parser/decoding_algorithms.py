@@ -14,11 +14,112 @@ import torch
 import src.common.ops as ops
 from src.utils.utils import SEQ2SEQ, SEQ2SEQ_PG, BRIDGE
 
+# beam-search - beam search with the full beam
+# greedy - beam search with a beam of size 1
+# adaptive - beam search with a small beam first; the examples without a valid prediction are re-decoded with the full
+#   beam
+DECODING_ALGORITHMS = ['beam-search', 'greedy', 'adaptive']
+
+
+def get_beam_size(decoding_algorithm, beam_size, beam_size_override=None):
+    """
+    :param beam_size: full beam size.
+    :param beam_size_override: beam size of the current decoding pass, if different from the default of the algorithm.
+    """
+    if beam_size_override is not None:
+        return beam_size_override
+    return 1 if decoding_algorithm == 'greedy' else beam_size
+
+
+class BeamSearchHistory(object):
+    """
+    Beam search history stored in buffers preallocated for the maximum number of decoding steps.
+
+    At each step, the new state of every hypothesis and a back-pointer to its parent hypothesis are written to the
+    buffers, hence the cost of a step does not grow with the output length. The history of the final hypotheses is
+    reconstructed by following the back-pointers once the search is done.
+    """
+    def __init__(self, num_steps, num_rows, device):
+        self.num_steps = num_steps
+        self.num_rows = num_rows
+        self.device = device
+        # [num_steps, num_rows]
+        self.back_pointers = ops.int_zeros_var([num_steps, num_rows], device=device)
+        self.buffers = dict()
+        self.layouts = dict()
+        self.step = 0
+
+    def append(self, beam_offset, **states):
+        """
+        :param beam_offset: [num_rows] parent of each hypothesis in the previous step.
+        :param states: name -> (state, row_dim, seq_dim), the state of each hypothesis at the current step;
+            row_dim is the hypothesis dimension and seq_dim the (size 1) sequence dimension of the state tensor.
+        """
+        self.back_pointers[self.step] = beam_offset
+        for name, (state, row_dim, seq_dim) in states.items():
+            # [num_rows, ...]
+            state = state.movedim((row_dim, seq_dim), (0, 1)).squeeze(1)
+            if name not in self.buffers:
+                self.buffers[name] = torch.zeros([self.num_steps] + list(state.size()), dtype=state.dtype,
+                                                 device=self.device)
+                self.layouts[name] = (row_dim, seq_dim)
+            self.buffers[name][self.step] = state
+        self.step += 1
+
+    def get_ancestors(self):
+        """
+        :return: [num_steps_taken, num_rows] row of the ancestor of each final hypothesis at each step.
+        """
+        ancestors = [ops.arange_var(self.num_rows, device=self.device)]
+        for t in range(self.step - 1, 0, -1):
+            ancestors.append(self.back_pointers[t][ancestors[-1]])
+        return torch.stack(ancestors[::-1])
+
+    def get(self, name, ancestors=None):
+        """
+        :return: history of the final hypotheses in the layout of the appended states, with the decoding steps
+            along seq_dim.
+        """
+        if ancestors is None:
+            ancestors = self.get_ancestors()
+        num_steps_taken = ancestors.size(0)
+        # [num_steps_taken, num_rows, ...]
+        history = self.buffers[name][ops.arange_var(num_steps_taken, device=self.device).unsqueeze(1), ancestors]
+        row_dim, seq_dim = self.layouts[name]
+        return history.movedim((0, 1), (seq_dim, row_dim))
+
+
+def update_field_masks(m_field_masks, memory_pos, db_scope, constant_seq_len):
+    """
+    Include the fields of the tables copied at the last decoding step in the field masks, without synchronizing with
+    the host.
+    :param m_field_masks: [full_size, memory_size] binary mask of the fields that can be copied.
+    :param memory_pos: [full_size, 1] memory position copied at the last step, 0 if a vocabulary token was generated.
+    :param db_scope: ([full_size, max_num_tables], [full_size, max_num_tables, max_num_fields_per_table]) memory
+        position of each table and of its fields in the schema.
+    :param constant_seq_len: [full_size] number of memory entries before the schema.
+    """
+    full_size = m_field_masks.size(0)
+    table_memory_pos, table_field_scopes = db_scope
+    # [full_size, max_num_tables]
+    table_input_mask = (memory_pos == table_memory_pos)
+    # [full_size, max_num_tables * max_num_fields_per_table]
+    db_scope_update_mask = (table_input_mask.unsqueeze(2) & (table_field_scopes > 0)).view(full_size, -1)
+    db_scope_update_idx = constant_seq_len.unsqueeze(1) + table_field_scopes.view(full_size, -1)
+    # *
+    m_field_masks = m_field_masks.scatter_add(
+        index=constant_seq_len.unsqueeze(1), src=table_input_mask.any().long().expand(full_size, 1), dim=1)
+    m_field_masks.scatter_add_(index=db_scope_update_idx, src=db_scope_update_mask.long(), dim=1)
+    return (m_field_masks > 0).long()
+
 
 def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size, encoder_final_hidden,
                 encoder_hiddens=None, encoder_masks=None, encoder_ptr_value_ids=None, constant_hiddens=None,
                 constant_hidden_masks=None, schema_hiddens=None, schema_hidden_masks=None, table_masks=None,
-                schema_memory_masks=None, db_scope=None, no_from=False, start_embedded=None):
+                schema_memory_masks=None, db_scope=None, no_from=False, start_embedded=None, sql_grammar=None):
+    """
+    :param sql_grammar: If set, the continuations which violate the SQL grammar are pruned at each step (Bridge only).
+    """
 
     def compute_memory_inputs(constant_seq_len, schema_seq_len, table_masks):
         """
@@ -28,7 +129,7 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
         """
         memory_size = constant_seq_len + schema_seq_len
         memory_max_size = int(max(memory_size))
-        memory_input_constant_masks = (ops.batch_arange_cuda(batch_size, memory_max_size) <
+        memory_input_constant_masks = (ops.batch_arange_var(batch_size, memory_max_size, device=device) <
                                        constant_seq_len.unsqueeze(1)).long()
         memory_input_schema_masks = 1 - memory_input_constant_masks
         memory_inputs = memory_input_constant_masks * decoder.vocab.value_id + \
@@ -40,14 +141,14 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
         memory_inputs = memory_inputs.view(batch_size, memory_max_size)
 
         memory_input_table_masks = (memory_inputs == decoder.vocab.table_id).long()
-        memory_input_field_masks = ops.int_ones_var_cuda(memory_input_table_masks.size()) if no_from else \
-                                   ops.int_zeros_var_cuda(memory_input_table_masks.size())
+        memory_input_field_masks = ops.int_ones_var(memory_input_table_masks.size(), device=device) if no_from else \
+                                   ops.int_zeros_var(memory_input_table_masks.size(), device=device)
         return memory_inputs, memory_input_table_masks, memory_input_field_masks, memory_input_constant_masks
 
     def get_vocab_cat_masks():
-        v_clause_mask = ops.int_var_cuda(decoder.vocab.clause_mask)
-        v_op_mask = ops.int_var_cuda(decoder.vocab.op_mask)
-        v_join_mask = ops.int_var_cuda(decoder.vocab.join_mask)
+        v_clause_mask = ops.int_var(decoder.vocab.clause_mask, device=device)
+        v_op_mask = ops.int_var(decoder.vocab.op_mask, device=device)
+        v_join_mask = ops.int_var(decoder.vocab.join_mask, device=device)
         v_others_mask = 1 - v_clause_mask - v_op_mask - v_join_mask
         return v_clause_mask, v_op_mask, v_join_mask, v_others_mask
 
@@ -57,43 +158,41 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
         else:
             return torch.index_select(h, 1, beam_offset)
 
-    def update_beam_search_history(history, state, beam_offset, offset_dim, seq_dim, offset_state=False):
-        if history is None:
-            return state
-        else:
-            history = torch.index_select(history, offset_dim, beam_offset)
-            if offset_state:
-                state = torch.index_select(state, offset_dim, beam_offset)
-            return torch.cat([history, state], seq_dim)
+    def select_rows(x, rows, dim=0):
+        if x is None:
+            return None
+        if isinstance(x, tuple):
+            return tuple(select_rows(x_, rows, dim=dim) for x_ in x)
+        return torch.index_select(x, dim, rows)
+
+    def expand_to_all_rows(x, fill_value=0):
+        """
+        Scatter the state of the active rows into a tensor covering all rows. The rows of the finished examples are
+        set to fill_value.
+        """
+        if active_rows is None:
+            return x
+        x_all = ops.fill_var((num_rows,) + x.size()[1:], fill_value, dtype=x.dtype, device=device)
+        x_all[active_rows] = x
+        return x_all
 
     if encoder_hiddens is None:
         batch_size = constant_hiddens.size(0)
     else:
         batch_size = encoder_hiddens.size(0)
     full_size = batch_size * beam_size
+    device = constant_hidden_masks.device
+    # The decoder stops once all hypotheses finished. The examples whose hypotheses all finished are removed from the
+    # subsequent decoding steps (active set compaction); active_rows maps the remaining rows to their original
+    # positions, None if no example has been removed.
+    num_rows = full_size
+    active_rows = None
+    early_stopping = not decoder.return_hiddens
+    compact_active_set = early_stopping and model in [SEQ2SEQ_PG, BRIDGE]
 
     start_id = decoder.vocab.start_id
     eos_id = decoder.vocab.eos_id
-    digit_0_id = decoder.vocab.to_idx('0')
-    digit_1_id = decoder.vocab.to_idx('1')
-    digit_2_id = decoder.vocab.to_idx('2')
-    digit_3_id = decoder.vocab.to_idx('3')
-    digit_4_id = decoder.vocab.to_idx('4')
-    digit_5_id = decoder.vocab.to_idx('5')
-    digit_6_id = decoder.vocab.to_idx('6')
-    digit_7_id = decoder.vocab.to_idx('7')
-    digit_8_id = decoder.vocab.to_idx('8')
-    digit_9_id = decoder.vocab.to_idx('9')
-    digit_10_id = decoder.vocab.to_idx('10')
-    digit_11_id = decoder.vocab.to_idx('11')
-    digit_12_id = decoder.vocab.to_idx('12')
-    digit_s0_id = decoder.vocab.to_idx('##0')
-    digit_s1_id = decoder.vocab.to_idx('##1')
-    digit_s2_id = decoder.vocab.to_idx('##2')
-    digit_s3_id = decoder.vocab.to_idx('##3')
-    digit_s4_id = decoder.vocab.to_idx('##4')
-    digit_s5_id = decoder.vocab.to_idx('##5')
-    seen_eos = ops.byte_zeros_var_cuda([full_size, 1])
+    seen_eos = ops.byte_zeros_var([full_size, 1], device=device)
     seq_len = 0
 
     if type(encoder_final_hidden) is tuple:
@@ -108,15 +207,16 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
     constant_seq_len = constant_hidden_masks.size(1) - constant_hidden_masks.sum(dim=1)
     vocab_masks, memory_masks = None, None
     if model in [BRIDGE]:
+        input_feed_table, input_type_table = decoder.vocab.get_category_tables(device)
         schema_seq_len = schema_hidden_masks.size(1) - schema_hidden_masks.sum(dim=1)
         memory_inputs, m_table_masks, m_field_masks, m_value_masks = \
             compute_memory_inputs(constant_seq_len, schema_seq_len, table_masks)
         if db_scope is not None:
-            # vocab_mask = ops.int_ones_var_cuda(decoder.vocab.size)
+            # vocab_mask = ops.int_ones_var(decoder.vocab.size)
             # vocab_mask[decoder.vocab.to_idx('from')] = 1
             # vocab_mask[decoder.vocab.to_idx('(')] = 1
             # v_clause_mask, v_op_mask, v_join_mask, v_others_mask = get_vocab_cat_masks()
-            memory_masks = ops.int_zeros_var_cuda([batch_size, memory_inputs.size(1)])
+            memory_masks = ops.int_zeros_var([batch_size, memory_inputs.size(1)], device=device)
 
             table_pos, table_field_scopes = db_scope
             table_memory_pos = constant_seq_len.unsqueeze(1) * (table_pos > 0).long() + table_pos
@@ -125,10 +225,15 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
             db_scope = (table_memory_pos, table_field_scopes)
     else:
         memory_inputs = None
+    if sql_grammar is not None:
+        assert(model in [BRIDGE])
+        grammar_state = sql_grammar.init_state(full_size, memory_inputs)
+    else:
+        grammar_state = None
 
+    # The encoder outputs and the memory features that do not change during decoding are shared by the hypotheses of
+    # each example and are not tiled along the beams
     if model in [SEQ2SEQ_PG, BRIDGE]:
-        encoder_hiddens = ops.tile_along_beam(encoder_hiddens, beam_size)
-        encoder_masks = ops.tile_along_beam(encoder_masks, beam_size)
         if memory_masks is not None:
             # assert(vocab_mask is not None)
             # vocab_masks = ops.tile_along_beam(vocab_mask.unsqueeze(0), batch_size * beam_size)
@@ -137,92 +242,52 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
             # v_join_masks = ops.tile_along_beam(v_join_mask.unsqueeze(0), batch_size * beam_size)
             # v_others_masks = ops.tile_along_beam(v_others_mask.unsqueeze(0), batch_size * beam_size)
             memory_masks = ops.tile_along_beam(memory_masks, beam_size)
-            m_table_masks = ops.tile_along_beam(m_table_masks, beam_size)
             m_field_masks = ops.tile_along_beam(m_field_masks, beam_size)
-            m_value_masks = ops.tile_along_beam(m_value_masks, beam_size)
         if memory_inputs is not None:
             constant_seq_len = ops.tile_along_beam(constant_seq_len, beam_size)
-            memory_inputs = ops.tile_along_beam(memory_inputs, beam_size)
-        if encoder_ptr_value_ids is not None:
-            encoder_ptr_value_ids = ops.tile_along_beam(encoder_ptr_value_ids, beam_size)
-        seq_p_pointers = None
         ptr_context = None
-        seq_text_ptr_weights = None
     elif model == SEQ2SEQ:
-        seq_text_ptr_weights = None
+        pass
     else:
         raise NotImplementedError
 
     pred_score = 0
-    outputs, hiddens = None, (None, None)
+    history = BeamSearchHistory(num_steps, num_rows, device)
+    final_pred_score = ops.zeros_var([num_rows, 1], device=device)
+    final_seq_len = ops.zeros_var([num_rows, 1], device=device)
 
     for i in range(num_steps):
         if i > 0:
             if model in [BRIDGE]:
-                # [batch_size, 1]
-                vocab_mask = (input < decoder.vocab_size).long()
-                point_mask = 1 - vocab_mask
-                memory_pos = (input - decoder.vocab_size) * point_mask
-                memory_input = ops.batch_lookup(memory_inputs, memory_pos, vector_output=False)
-                input_ = vocab_mask * input + point_mask * memory_input
-                digit_mask = ((input == digit_0_id) |
-                       (input == digit_1_id) |
-                       (input == digit_2_id) |
-                       (input == digit_3_id) |
-                       (input == digit_4_id) |
-                       (input == digit_5_id) |
-                       (input == digit_6_id) |
-                       (input == digit_7_id) |
-                       (input == digit_8_id) |
-                       (input == digit_9_id) |
-                       (input == digit_10_id) |
-                       (input == digit_11_id) |
-                       (input == digit_12_id) |
-                       (input == digit_s0_id) |
-                       (input == digit_s1_id) |
-                       (input == digit_s2_id) |
-                       (input == digit_s3_id) |
-                       (input == digit_s4_id) |
-                       (input == digit_s5_id))
-                vocab_mask[digit_mask] = 0
-                input_[digit_mask] = decoder.vocab.value_id
+                # [full_size, 1]
+                vocab_mask = (input < decoder.vocab_size)
+                memory_pos = (input - decoder.vocab_size) * (~vocab_mask).long()
+                memory_input = ops.batch_lookup(
+                    memory_inputs, memory_pos.view(batch_size, beam_size), vector_output=False).view(full_size, 1)
+                token = torch.where(vocab_mask, input, memory_input)
+                # the digits are decoded as values
+                input_ = input_feed_table[token]
+                if grammar_state is not None:
+                    grammar_state = grammar_state.index_select(beam_offset)
+                    grammar_state.update(input_.squeeze(1))
                 if db_scope is not None:
-                    # [full_size, 3 (table, field, value）]
-                    input_types = ops.long_var_cuda([decoder.vocab.table_id,
-                                                     decoder.vocab.field_id,
-                                                     decoder.vocab.value_id]).unsqueeze(0).expand([input_.size(0), 3])
                     # [full_size, 4 (vocab, table, field, value)]
-                    input_type = torch.cat([vocab_mask, (input_ == input_types).long()], dim=1)
-                    # [full_size, max_num_tables], [full_size, max_num_tables, max_num_fields_per_table]
-                    table_memory_pos, table_field_scopes = db_scope
+                    input_type = input_type_table[token.squeeze(1)]
+                    input_type[:, 0] *= vocab_mask.squeeze(1).long()
                     # update vocab masks
                     # vocab_masks = torch.index_select(vocab_masks, 0, beam_offset)
                     # update memory masks
-                    m_field_masks = torch.index_select(m_field_masks, 0, beam_offset)
-                    # [full_size, max_num_tables]
-                    table_input_mask = (memory_pos == table_memory_pos)
-                    if table_input_mask.max() > 0:
-                        # [full_size, 1, max_num_fields_per_table]
-                        db_scope_update_idx, _ = ops.batch_binary_lookup_3D(
-                            table_field_scopes, table_input_mask, pad_value=0)
-                        assert(db_scope_update_idx.size(1) == 1)
-                        db_scope_update_idx.squeeze_(1)
-                        db_scope_update_mask = (db_scope_update_idx > 0)
-                        db_scope_update_idx = constant_seq_len.unsqueeze(1) + db_scope_update_idx
-                        # db_scope_update: [full_size, memory_seq_len] binary mask in which the newly included table
-                        # fields are set to 1 and the rest are set to 0
-                        # assert (db_scope_update.max() <= 1)
-                        # *
-                        m_field_masks.scatter_(index=constant_seq_len.unsqueeze(1),
-                                               src=ops.int_ones_var_cuda([batch_size*beam_size, 1]), dim=1)
-                        m_field_masks.scatter_add_(index=db_scope_update_idx, src=db_scope_update_mask.long(), dim=1)
-                        m_field_masks = (m_field_masks > 0).long()
+                    m_field_masks = update_field_masks(
+                        torch.index_select(m_field_masks, 0, beam_offset), memory_pos, db_scope, constant_seq_len)
                     # Heuristics:
                     # - table/field only appear after SQL keywords
                     # - value only appear after SQL keywords or other value token
-                    memory_masks = input_type[:, 0].unsqueeze(1) * m_table_masks + \
-                                   input_type[:, 0].unsqueeze(1) * m_field_masks + \
-                                   (input_type[:, 0] + input_type[:, 3]).unsqueeze(1) * m_value_masks
+                    # [batch_size, beam_size, 1]
+                    vocab_input_type = input_type[:, 0].view(batch_size, beam_size, 1)
+                    value_input_type = input_type[:, 3].view(batch_size, beam_size, 1)
+                    memory_masks = (vocab_input_type * m_table_masks.unsqueeze(1) +
+                                    (vocab_input_type + value_input_type) * m_value_masks.unsqueeze(1))
+                    memory_masks = memory_masks.view(full_size, -1) + input_type[:, 0].unsqueeze(1) * m_field_masks
                     # print(input_type[0])
                     # print(memory_masks[0])
                     # import pdb
@@ -234,7 +299,7 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
             input_embedded = decoder_embeddings(input_)
         else:
             if start_embedded is None:
-                input = ops.int_fill_var_cuda([full_size, 1], start_id)
+                input = ops.int_fill_var([full_size, 1], start_id, device=device)
                 input_embedded = decoder_embeddings(input)
             else:
                 raise NotImplementedError
@@ -266,16 +331,19 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
         # [full_size, vocab_size]
         output.squeeze_(1)
         vocab_size = output.size(1)
+        if grammar_state is not None:
+            grammar_vocab_masks, grammar_memory_masks = grammar_state.get_masks()
+            output = output.masked_fill(~torch.cat([grammar_vocab_masks, grammar_memory_masks], dim=1), -ops.HUGE_INT)
 
         seq_len += (1 - seen_eos.float())
         n_len_norm_factor = torch.pow(5 + seq_len, alpha) / np.power(5 + 1, alpha)
         # [full_size, vocab_size]
         if i == 0:
-            raw_scores = \
-                output + (ops.arange_cuda(beam_size).repeat(batch_size) > 0).float().unsqueeze(1) * (-ops.HUGE_INT)
+            beam_masks = (ops.arange_var(beam_size, device=device).repeat(batch_size) > 0).float().unsqueeze(1)
+            raw_scores = output + beam_masks * (-ops.HUGE_INT)
         else:
             raw_scores = (pred_score * len_norm_factor + output * (1 - seen_eos.float())) / n_len_norm_factor
-            eos_mask = ops.ones_var_cuda([1, vocab_size])
+            eos_mask = ops.ones_var([1, vocab_size], device=device)
             eos_mask[0, eos_id] = 0
             raw_scores += (seen_eos.float() * eos_mask) * (-ops.HUGE_INT)
 
@@ -285,7 +353,14 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
         # [batch_size, beam_size]
         log_pred_prob, pred_idx = torch.topk(raw_scores, beam_size, dim=1)
         # [full_size]
-        beam_offset = (pred_idx // vocab_size + ops.arange_cuda(batch_size).unsqueeze(1) * beam_size).view(-1)
+        beam_offset = (pred_idx // vocab_size +
+                       ops.arange_var(batch_size, device=device).unsqueeze(1) * beam_size).view(-1)
+        # [num_rows]
+        if active_rows is None:
+            history_offset = beam_offset
+        else:
+            history_offset = ops.arange_var(num_rows, device=device)
+            history_offset[active_rows] = active_rows[beam_offset]
         # [full_size, 1]
         pred_idx = (pred_idx % vocab_size).view(full_size, 1)
         log_pred_prob = log_pred_prob.view(full_size, 1)
@@ -294,17 +369,16 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
         # [num_layers*num_directions, full_size, hidden_dim]
         hidden = offset_hidden(hidden, beam_offset)
         # [num_layers*num_directions, full_size, seq_len, hidden_dim]
+        history_states = dict()
         if decoder.return_hiddens:
-            hiddens = (
-                update_beam_search_history(hiddens[0], hidden[0].unsqueeze(2), beam_offset, 1, 2),
-                update_beam_search_history(hiddens[1], hidden[1].unsqueeze(2), beam_offset, 1, 2)
-            )
-        if outputs is not None:
+            history_states['h'] = (hidden[0].unsqueeze(2), 1, 2)
+            history_states['c'] = (hidden[1].unsqueeze(2), 1, 2)
+        if i > 0:
             seq_len = torch.index_select(seq_len, 0, beam_offset)
             len_norm_factor = torch.index_select(len_norm_factor, 0, beam_offset)
             seen_eos = torch.index_select(seen_eos, 0, beam_offset)
         seen_eos = seen_eos | (pred_idx == eos_id)
-        outputs = update_beam_search_history(outputs, pred_idx, beam_offset, 0, 1)
+        history_states['outputs'] = (expand_to_all_rows(pred_idx, eos_id), 0, 1)
         pred_score = log_pred_prob
 
         input = pred_idx
@@ -313,15 +387,62 @@ def beam_search(alpha, model, decoder, decoder_embeddings, num_steps, beam_size,
         if model in [SEQ2SEQ_PG, BRIDGE]:
             ptr_context = (torch.index_select(ptr_context[0], 0, beam_offset),
                            torch.index_select(ptr_context[1], 0, beam_offset))
-            seq_text_ptr_weights = update_beam_search_history(
-                seq_text_ptr_weights, ptr_context[1], beam_offset, 0, 2)
-            seq_p_pointers = update_beam_search_history(
-                seq_p_pointers, ptr_context[0].squeeze(2), beam_offset, 0, 1)
+            history_states['text_ptr_weights'] = (expand_to_all_rows(ptr_context[1]), 0, 2)
+            history_states['p_pointers'] = (expand_to_all_rows(ptr_context[0].squeeze(2)), 0, 1)
         elif model == SEQ2SEQ:
-            seq_text_ptr_weights = update_beam_search_history(
-                seq_text_ptr_weights, text_ptr_weights, beam_offset, 0, 2, offset_state=True)
+            history_states['text_ptr_weights'] = (torch.index_select(text_ptr_weights, 0, beam_offset), 0, 2)
         else:
             raise NotImplementedError
+        history.append(history_offset, **history_states)
+
+        if early_stopping:
+            # [batch_size]
+            example_finished = seen_eos.view(batch_size, beam_size).bool().all(dim=1)
+            if bool(example_finished.all()):
+                break
+            if compact_active_set and bool(example_finished.any()):
+                row_finished = example_finished.unsqueeze(1).expand(batch_size, beam_size).reshape(-1)
+                if active_rows is None:
+                    active_rows = ops.arange_var(num_rows, device=device)
+                final_pred_score[active_rows[row_finished]] = pred_score[row_finished]
+                final_seq_len[active_rows[row_finished]] = seq_len[row_finished]
+                # [batch_size], [full_size]
+                keep_examples = torch.nonzero(~example_finished).squeeze(1)
+                keep = torch.nonzero(~row_finished).squeeze(1)
+                active_rows = active_rows[keep]
+                batch_size = int(keep.size(0) / beam_size)
+                full_size = keep.size(0)
+                hidden = select_rows(hidden, keep, dim=1)
+                seq_len, len_norm_factor, seen_eos, pred_score, input = \
+                    select_rows((seq_len, len_norm_factor, seen_eos, pred_score, input), keep)
+                ptr_context = select_rows(ptr_context, keep)
+                encoder_hiddens, encoder_masks, encoder_ptr_value_ids = \
+                    select_rows((encoder_hiddens, encoder_masks, encoder_ptr_value_ids), keep_examples)
+                if model in [BRIDGE]:
+                    memory_inputs = select_rows(memory_inputs, keep_examples)
+                    constant_seq_len = select_rows(constant_seq_len, keep)
+                    if db_scope is not None:
+                        m_table_masks, m_value_masks = select_rows((m_table_masks, m_value_masks), keep_examples)
+                        memory_masks, db_scope = select_rows((memory_masks, db_scope), keep)
+                    if grammar_state is not None:
+                        grammar_state = grammar_state.select_examples(keep_examples)
+                    # m_field_masks and the grammar states are aligned with the search history at the beginning of
+                    # the next step
+                    beam_offset = beam_offset[keep]
+
+    if active_rows is None:
+        final_pred_score, final_seq_len = pred_score, seq_len
+    else:
+        final_pred_score[active_rows] = pred_score
+        final_seq_len[active_rows] = seq_len
+    pred_score, seq_len = final_pred_score, final_seq_len
+    ancestors = history.get_ancestors()
+    outputs = history.get('outputs', ancestors)
+    seq_text_ptr_weights = history.get('text_ptr_weights', ancestors)
+    if model in [SEQ2SEQ_PG, BRIDGE]:
+        seq_p_pointers = history.get('p_pointers', ancestors)
+    if decoder.return_hiddens:
+        hiddens = (history.get('h', ancestors), history.get('c', ancestors))
 
     if model in [SEQ2SEQ_PG, BRIDGE]:
         output_obj = outputs, pred_score, seq_p_pointers, seq_text_ptr_weights, seq_len
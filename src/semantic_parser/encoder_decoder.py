@@ -69,7 +69,8 @@ class EncoderDecoder(nn.Module):
 
     def get_segment_and_position_ids(self, encoder_input_ids):
         batch_size, input_size = encoder_input_ids.size()
-        position_ids = ops.arange_cuda(input_size).unsqueeze(0).expand_as(encoder_input_ids)
+        position_ids = \
+            ops.arange_var(input_size, device=encoder_input_ids.device).unsqueeze(0).expand_as(encoder_input_ids)
         # [CLS] w1 w2 ... [SEP] * [T] ...
         # 0     0  0  ...  0  1 1 ...
         seg1_end_pos = torch.nonzero(encoder_input_ids == self.tu.sep_id)[:, 1].view(batch_size, 2)[:, 0]
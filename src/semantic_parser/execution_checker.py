@@ -0,0 +1,109 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Execution checks of the decoded queries for execution-guided decoding.
+"""
+
+import concurrent.futures
+import sqlite3
+import threading
+import time
+
+from src.eval.wikisql.lib.query import Query
+
+
+class ExecutionChecker(object):
+    """
+    Execute the candidate queries of execution-guided decoding in a pool of worker threads, each with a read-only
+    connection to the database of a DBEngine.
+
+    SQLite releases the GIL while it runs a query, hence the candidates of a mini-batch run concurrently. A query that
+    runs longer than timeout seconds is interrupted by the SQLite progress handler and at most max_rows rows of its
+    result are fetched. A query passes the check if it returns a non-empty result within these limits.
+    """
+    def __init__(self, engine, num_workers=4, timeout=1.0, max_rows=1000):
+        """
+        :param engine: DBEngine of the database the queries are executed against.
+        :param num_workers: Number of worker threads.
+        :param timeout: Maximum execution time of a query in seconds.
+        :param max_rows: Maximum number of rows fetched per query.
+        """
+        self.engine = engine
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.connections = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(num_workers)
+
+    def get_connection(self):
+        if not hasattr(self.connections, 'conn'):
+            self.connections.conn = sqlite3.connect('file:{}?mode=ro'.format(self.engine.fdb), uri=True)
+        return self.connections.conn
+
+    def execute(self, query, where_map, cancelled):
+        if cancelled.is_set():
+            return False
+        conn = self.get_connection()
+        deadline = time.time() + self.timeout
+        # a non-zero return value interrupts the query
+        conn.set_progress_handler(lambda: cancelled.is_set() or time.time() > deadline, 1000)
+        try:
+            return len(conn.execute(query, where_map).fetchmany(self.max_rows)) > 0
+        except sqlite3.Error:
+            return False
+        finally:
+            conn.set_progress_handler(None, 1000)
+
+    def submit(self, db_name, pred_sqls):
+        """
+        Start the execution checks of the candidate queries of an example.
+        :param db_name: Table of the example.
+        :param pred_sqls: Candidate queries in WikiSQL format, None if a candidate failed the other checks.
+        :return: ExecutionCheck of the candidates.
+        """
+        cancelled = threading.Event()
+        futures = []
+        for pred_sql in pred_sqls:
+            future = None
+            if pred_sql:
+                try:
+                    pred_query = Query.from_dict(pred_sql, ordered=False)
+                    query, where_map = self.engine.get_query_str(
+                        db_name, pred_query.sel_index, pred_query.agg_index, pred_query.conditions, lower=True)
+                    future = self.pool.submit(self.execute, query, where_map, cancelled)
+                except Exception:
+                    pass
+            futures.append(future)
+        return ExecutionCheck(futures, cancelled)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+class ExecutionCheck(object):
+    """
+    Pending execution checks of the candidate queries of an example.
+    """
+    def __init__(self, futures, cancelled):
+        self.futures = futures
+        self.cancelled = cancelled
+
+    def result(self, j):
+        """
+        :return: True if the j-th submitted candidate returned a non-empty result.
+        """
+        future = self.futures[j]
+        if future is None or future.cancelled():
+            return False
+        return future.result()
+
+    def cancel(self):
+        """
+        Cancel the checks that have not finished, e.g. once a higher-ranked candidate passed.
+        """
+        self.cancelled.set()
+        for future in self.futures:
+            if future is not None:
+                future.cancel()
@@ -16,8 +16,10 @@ import torch
 
 import moz_sp
 from src.common.learn_framework import LFramework
-from src.common.nn_modules import MaskedCrossEntropyLoss
+from src.common.nn_modules import MaskedCrossEntropyLoss, SpanExtractor
 import src.common.ops as ops
+import src.common.tracing as tracing
+from src.common.quantization import quantize_dynamic_int8
 import src.data_processor.data_loader as data_loader
 from src.data_processor.processor_utils import get_table_aware_transformer_encoder_inputs, \
     get_transformer_output_value_mask
@@ -25,13 +27,16 @@ from src.data_processor.processor_utils import SPIDER, WIKISQL
 from src.data_processor.schema_graph import DUMMY_REL
 import src.data_processor.tokenizers as tok
 import src.data_processor.vectorizers as vec
+from src.semantic_parser.beam_post_processor import BeamPostProcessor
 from src.semantic_parser.ensemble import ensemble_beam_search
+from src.semantic_parser.execution_checker import ExecutionChecker
 from src.semantic_parser.seq2seq import Seq2Seq
 from src.semantic_parser.seq2seq_ptr import PointerGenerator
 from src.semantic_parser.bridge import Bridge
+from src.semantic_parser.compiled_bridge import CompiledBridge, export_compiled_bridge, get_encoder_inputs
+from src.semantic_parser.decoding_algorithms import DECODING_ALGORITHMS
 import src.eval.eval_tools as eval_tools
 import src.eval.spider.evaluate as spider_eval_tools
-from src.eval.wikisql.lib.query import Query
 from src.utils.utils import SEQ2SEQ, SEQ2SEQ_PG, BRIDGE
 
 
@@ -52,6 +57,7 @@ class EncoderDecoderLFramework(LFramework):
             self.mdl = Seq2Seq(args, self.in_vocab, self.out_vocab)
         else:
             raise NotImplementedError
+        self.quantized = False
 
         # Specify loss function
         if self.args.loss == 'cross_entropy':
@@ -65,9 +71,82 @@ class EncoderDecoderLFramework(LFramework):
 
         # Post-process
         _, _, self.output_post_process, _ = tok.get_tokenizers(args)
+        self.post_processor = None
 
         print('{} module created'.format(self.model))
 
+    def quantize(self):
+        """
+        Switch to int8 dynamic quantized CPU inference. Must be called after the model weights are loaded; the
+        quantized model cannot be trained or saved as a training checkpoint.
+        """
+        if self.device.type != 'cpu':
+            raise ValueError('Quantized inference runs on the CPU only, move the model to the CPU first (--cpu)')
+        self.eval()
+        self.mdl = quantize_dynamic_int8(self.mdl)
+        self.quantized = True
+        print('{} module quantized to int8'.format(self.model))
+
+    def export_compiled_model(self, examples, out_dir):
+        """
+        Export the model as TorchScript graphs, using the first mini-batch of examples as the tracing inputs. The
+        predictions of the compiled model are checked against the eager model on the same mini-batch.
+        """
+        if self.model_id != BRIDGE:
+            raise NotImplementedError('Compiled export is supported for the {} model only'.format(BRIDGE))
+        self.eval()
+        formatted_batch = self.format_batch(examples[:self.dev_batch_size])
+        encoder_inputs = get_encoder_inputs(formatted_batch[2],
+                                            self.get_text_masks(formatted_batch[0]),
+                                            self.get_schema_masks(formatted_batch[2][0]),
+                                            formatted_batch[8],
+                                            formatted_batch[5][0])
+        export_compiled_bridge(self.mdl, encoder_inputs, out_dir, read_picklist=self.args.read_picklist)
+
+        with torch.no_grad():
+            preds, pred_scores = self.forward(formatted_batch)[:2]
+            mdl = self.mdl
+            self.use_compiled_model(out_dir)
+            compiled_preds, compiled_pred_scores = self.forward(formatted_batch)[:2]
+            self.mdl = mdl
+        print('Compiled vs. eager model on {} examples: prediction match = {}, max score diff = {}'.format(
+            len(preds), bool((preds == compiled_preds).all()), (pred_scores - compiled_pred_scores).abs().max()))
+
+    def use_compiled_model(self, model_dir):
+        """
+        Switch to inference with the TorchScript graphs exported by export_compiled_model. Must be called after the
+        model weights are loaded.
+        """
+        self.eval()
+        self.mdl = CompiledBridge(self.mdl, model_dir, map_location=self.device)
+        print('{} module compiled graphs loaded from {}'.format(self.model, model_dir))
+
+    def start_post_processor(self):
+        """
+        Fork the beam search post-processing workers (--num_post_process_workers), which are reused by the following
+        inference calls until close_post_processor is called. Call it before the process starts other threads.
+        :return: BeamPostProcessor, None if the beam search outputs are post-processed by the inference process.
+        """
+        if self.post_processor is None and self.args.num_post_process_workers > 0:
+            self.post_processor = BeamPostProcessor(self, self.args.num_post_process_workers)
+        return self.post_processor
+
+    def close_post_processor(self):
+        if self.post_processor is not None:
+            self.post_processor.close()
+            self.post_processor = None
+
+    def set_confusion_span_extractor(self, span_extractor):
+        """
+        Attach the span extractor of a translatability checker trained on the transformer encoder outputs of this
+        model (see TranslatabilityChecker). Inference then also detects the confusion spans, with the same encoder
+        pass as decoding.
+        """
+        if not isinstance(self.mdl, Bridge):
+            raise NotImplementedError(
+                'Shared encoder confusion span detection is supported for the eager {} model only'.format(BRIDGE))
+        self.mdl.span_extractor = span_extractor.to(self.device)
+
     def get_text_masks(self, encoder_input_ids):
         return encoder_input_ids[1]
 
@@ -102,7 +181,7 @@ class EncoderDecoderLFramework(LFramework):
         loss /= self.num_accumulation_steps
         return loss
 
-    def forward(self, formatted_batch, model_ensemble=None):
+    def forward(self, formatted_batch, model_ensemble=None, beam_size=None):
         encoder_input_ids = formatted_batch[0]
         decoder_input_ids = formatted_batch[1][0] if self.training else None
         if self.model_id in [SEQ2SEQ_PG, BRIDGE]:
@@ -121,22 +200,37 @@ class EncoderDecoderLFramework(LFramework):
                                                    text_masks, schema_masks, feature_ids, None,
                                                    transformer_output_value_masks, schema_memory_masks)
                 else:
-                    outputs = self.mdl(encoder_ptr_input_ids, encoder_ptr_value_ids,
-                                       text_masks, schema_masks, feature_ids,
-                                       transformer_output_value_masks=transformer_output_value_masks,
-                                       schema_memory_masks=schema_memory_masks,
-                                       decoder_input_ids=decoder_input_ids,
-                                       decoder_ptr_value_ids=decoder_ptr_value_ids)
+                    outputs = self.forward_mdl(encoder_ptr_input_ids, encoder_ptr_value_ids,
+                                               text_masks, schema_masks, feature_ids,
+                                               transformer_output_value_masks=transformer_output_value_masks,
+                                               schema_memory_masks=schema_memory_masks,
+                                               decoder_input_ids=decoder_input_ids,
+                                               decoder_ptr_value_ids=decoder_ptr_value_ids,
+                                               beam_size=beam_size)
             else:
-                outputs = self.mdl(encoder_ptr_input_ids, encoder_ptr_value_ids, text_masks,
-                                   decoder_input_ids=decoder_input_ids,
-                                   decoder_ptr_value_ids=decoder_ptr_value_ids)
+                outputs = self.forward_mdl(encoder_ptr_input_ids, encoder_ptr_value_ids, text_masks,
+                                           decoder_input_ids=decoder_input_ids,
+                                           decoder_ptr_value_ids=decoder_ptr_value_ids)
         elif self.model_id == SEQ2SEQ:
-            outputs = self.mdl(encoder_input_ids, decoder_input_ids)
+            outputs = self.forward_mdl(encoder_input_ids, decoder_input_ids)
         else:
             raise NotImplementedError
         return outputs
 
+    def get_batch_token_counts(self, formatted_batch):
+        if self.model_id in [SEQ2SEQ_PG, BRIDGE]:
+            encoder_masks = formatted_batch[2][1]
+            decoder_masks = formatted_batch[4][1]
+        else:
+            encoder_masks = formatted_batch[0][1]
+            decoder_masks = formatted_batch[1][1]
+        num_tokens, num_padded_tokens = 0, 0
+        for masks in [encoder_masks, decoder_masks]:
+            if masks is not None:
+                num_tokens += masks.numel()
+                num_padded_tokens += int(masks.sum())
+        return num_tokens, num_padded_tokens
+
     def inference(self, examples, decode_str_output=True, restore_clause_order=False, pred_restored_cache=None,
                   check_schema_consistency_=True, engine=None, inline_eval=False, model_ensemble=None, verbose=False):
 
@@ -148,19 +242,18 @@ class EncoderDecoderLFramework(LFramework):
             assert (not verbose and not inline_eval and not self.args.use_oracle_tables)
 
         pred_list, pred_score_list, pred_decoded_list, pred_decoded_score_list = [], [], [], []
-        if restore_clause_order:
-            if pred_restored_cache is None:
-                pred_restored_cache = dict()
+        confusion_span_list = []
         if self.save_vis:
             text_ptr_weights_vis, pointer_vis = [], []
 
-        num_error_cases = 0
-        for batch_start_id in tqdm(range(0, len(examples), self.dev_batch_size)):
-            mini_batch = examples[batch_start_id:batch_start_id + self.dev_batch_size]
+        def decode(mini_batch, beam_size=None):
             formatted_batch = self.format_batch(mini_batch)
-            outputs = self.forward(formatted_batch, model_ensemble)
+            outputs = self.forward(formatted_batch, model_ensemble, beam_size=beam_size)
+            confusion_spans = None
             if self.model_id in [SEQ2SEQ_PG, BRIDGE]:
-                preds, pred_scores, text_p_pointers, text_ptr_weights, seq_len = outputs
+                preds, pred_scores, text_p_pointers, text_ptr_weights, seq_len = outputs[:5]
+                if len(outputs) > 5:
+                    confusion_spans = SpanExtractor.get_spans(outputs[5])
                 text_p_pointers.unsqueeze_(2)
                 p_pointers = torch.cat([1 - text_p_pointers, text_p_pointers], dim=2)
             elif self.model_id == SEQ2SEQ:
@@ -168,115 +261,229 @@ class EncoderDecoderLFramework(LFramework):
                 p_pointers = None
             else:
                 raise NotImplementedError
-
-            pred_list.append(preds)
-            pred_score_list.append(pred_scores)
-            if decode_str_output or verbose:
-                for i in range(len(mini_batch)):
-                    example = mini_batch[i]
-                    db_name = example.db_name
-                    schema = self.schema_graphs[db_name]
-                    table_po, field_po = None, None
-                    if self.args.use_oracle_tables:
-                        # TODO: The implementation below is incorrect.
-                        if self.args.num_random_tables_added > 0:
-                            table_po, field_po = formatted_batch[-1][i]
-
-                    exp_output_strs, exp_output_scores, exp_seq_lens, exp_correct = [], [], [], []
-
+            beam_size = int(preds.size(0) / len(mini_batch))
+            return formatted_batch, (preds, pred_scores, text_ptr_weights, p_pointers, seq_len, beam_size), \
+                confusion_spans
+
+        post_process_kwargs = {
+            'restore_clause_order': restore_clause_order,
+            'pred_restored_cache': pred_restored_cache,
+            'check_schema_consistency_': check_schema_consistency_,
+            'verbose': verbose
+        }
+
+        def get_candidates(example_id, example, schema, decoded, table_po=None, field_po=None):
+            preds, pred_scores, text_ptr_weights, p_pointers, seq_len, beam_size = decoded
+            return self.post_process_beam_search_outputs(
+                example_id, example, preds, beam_size, schema, text_ptr_weights=text_ptr_weights,
+                p_pointers=p_pointers, table_po=table_po, field_po=field_po, **post_process_kwargs)
+
+        def post_process_beam(example_id, example, schema, decoded, table_po=None, field_po=None,
+                              gt_program_list=None, candidates=None, execution_check=None):
+            """
+            Post-process the top-k predictions of an example and return the valid ones.
+            :param candidates: Outputs of post_process_beam_search_outputs computed by the post-processing workers. If
+                set to None, the beams are post-processed here.
+            :param execution_check: ExecutionCheck of the candidates started by the caller. If set to None, the
+                execution checks are started here.
+            """
+            preds, pred_scores, text_ptr_weights, p_pointers, seq_len, beam_size = decoded
+            exp_output_strs, exp_output_scores, exp_seq_lens, exp_correct = [], [], [], []
+            if candidates is None:
+                candidates = get_candidates(example_id, example, schema, decoded, table_po=table_po, field_po=field_po)
+            if execution_checker is not None and execution_check is None:
+                candidates = list(candidates)
+                execution_check = execution_checker.submit(example.db_name, [c[2] for c in candidates])
+            # time spent waiting for the execution results of the candidates
+            execution_wait = tracing.accumulator('execution_check')
+            for k, (j, post_processed_output, pred_sql) in enumerate(candidates):
+                beam_id = example_id * beam_size + j
+                if pred_sql and execution_check is not None:
+                    with execution_wait:
+                        executable = execution_check.result(k)
+                    if not executable:
+                        pred_sql = None
+                if pred_sql:
+                    exp_output_strs.append(pred_sql)
+                    exp_output_scores.append(float(pred_scores[beam_id]))
+                    exp_seq_lens.append(int(seq_len[beam_id]))
+                    if self.save_vis:
+                        self.save_vis_parameters(post_processed_output, text_ptr_weights_vis, pointer_vis)
                     if inline_eval:
-                        if example.dataset_id == SPIDER:
-                            gt_program_list = example.program_list
-                            gt_program_ast = example.program_ast_list_[0] \
-                                if example.program_ast_list_ else example.program
-                            hardness = spider_eval_tools.Evaluator().eval_hardness(
-                                gt_program_ast, db_dir=self.args.db_dir, db_name=example.db_name)
-                        elif example.dataset_id == WIKISQL:
-                            gt_program_list = example.program_ast_list_
-                        else:
-                            raise NotImplementedError
-                        if example.dataset_id == WIKISQL:
-                            hardness = 'easy'
-
-                    if self.decoding_algorithm == 'beam-search':
-                        for j in range(self.beam_size):
-                            beam_id = i * self.beam_size + j
-                            post_processed_output = self.post_process_nn_output(
-                                beam_id, example.dataset_id, example, preds, schema, text_ptr_weights, p_pointers,
-                                table_po=table_po, field_po=field_po, verbose=verbose)
-                            if post_processed_output:
-                                pred_sql = post_processed_output[0]
-                                # print('{}\t{}'.format(pred_sql, float(pred_scores[beam_id])))
-                                if restore_clause_order:
-                                    if pred_restored_cache and db_name in pred_restored_cache and \
-                                            pred_sql in pred_restored_cache[db_name]:
-                                        restored_pred = pred_restored_cache[db_name][pred_sql]
-                                    else:
-                                        restored_pred = moz_sp.restore_clause_order(
-                                            pred_sql, schema, check_schema_consistency_=check_schema_consistency_,
-                                            verbose=verbose)
-                                        if pred_restored_cache:
-                                            if db_name not in pred_restored_cache:
-                                                pred_restored_cache[db_name] = dict()
-                                            pred_restored_cache[db_name][pred_sql] = restored_pred
-                                    if restored_pred:
-                                        pred_sql = restored_pred
-                                    else:
-                                        pred_sql = None
-                                else:
-                                    if check_schema_consistency_:
-                                        if not moz_sp.check_schema_consistency(
-                                                pred_sql, schema,
-                                                in_execution_order=self.args.process_sql_in_execution_order):
-                                            pred_sql = None
-                                if pred_sql and self.args.execution_guided_decoding:
-                                    assert(engine is not None)
-                                    try:
-                                        pred_query = Query.from_dict(pred_sql, ordered=False)
-                                        pred_ex = engine.execute_query(example.db_name, pred_query, lower=True)
-                                        if not pred_ex:
-                                            pred_sql = None
-                                    except Exception:
-                                        pred_sql = None
-                            else:
-                                pred_sql = None
-                            if pred_sql:
-                                exp_output_strs.append(pred_sql)
-                                exp_output_scores.append(float(pred_scores[beam_id]))
-                                exp_seq_lens.append(int(seq_len[beam_id]))
-                                if self.save_vis:
-                                    self.save_vis_parameters(post_processed_output, text_ptr_weights_vis, pointer_vis)
-                                if inline_eval:
-                                    results = eval_tools.eval_prediction(
-                                        pred=pred_sql,
-                                        gt_list=gt_program_list,
-                                        dataset_id=example.dataset_id,
-                                        db_name=example.db_name,
-                                        in_execution_order=(self.args.process_sql_in_execution_order and
-                                                            not restore_clause_order))
-                                    correct, _, _ = results
-                                    exp_correct.append(correct)
-                                    correct_ = correct[1] if isinstance(correct, tuple) else correct
-                                    if correct_:
-                                        break
+                        results = eval_tools.eval_prediction(
+                            pred=pred_sql,
+                            gt_list=gt_program_list,
+                            dataset_id=example.dataset_id,
+                            db_name=example.db_name,
+                            in_execution_order=(self.args.process_sql_in_execution_order and
+                                                not restore_clause_order))
+                        correct, _, _ = results
+                        exp_correct.append(correct)
+                        correct_ = correct[1] if isinstance(correct, tuple) else correct
+                        if correct_:
+                            break
+                    if self.args.first_valid_prediction_only:
+                        break
+            if execution_check is not None:
+                # The candidates ranked below the last prediction are not needed
+                execution_check.cancel()
+                execution_wait.record()
+            return exp_output_strs, exp_output_scores, exp_seq_lens, exp_correct
+
+        def get_schema_perceived_order(formatted_batch, i):
+            table_po, field_po = None, None
+            if self.args.use_oracle_tables:
+                # TODO: The implementation below is incorrect.
+                if self.args.num_random_tables_added > 0:
+                    table_po, field_po = formatted_batch[-1][i]
+            return table_po, field_po
+
+        def post_process_batch(batch_start_id, mini_batch, formatted_batch, decoded, batch_candidates=None):
+            nonlocal num_error_cases, num_fallback_cases
+            batch_execution_checks = None
+            if execution_checker is not None:
+                # The candidates of all examples in the mini-batch are executed concurrently
+                if batch_candidates is None:
+                    batch_candidates = [
+                        list(get_candidates(i, example, self.schema_graphs[example.db_name], decoded,
+                                            *get_schema_perceived_order(formatted_batch, i)))
+                        for i, example in enumerate(mini_batch)]
+                batch_execution_checks = [execution_checker.submit(example.db_name, [c[2] for c in candidates])
+                                          for example, candidates in zip(mini_batch, batch_candidates)]
+            batch_outputs, fallback_ids = [], []
+            for i in range(len(mini_batch)):
+                example = mini_batch[i]
+                db_name = example.db_name
+                schema = self.schema_graphs[db_name]
+                table_po, field_po = get_schema_perceived_order(formatted_batch, i)
+
+                gt_program_list, hardness = None, None
+                if inline_eval:
+                    if example.dataset_id == SPIDER:
+                        gt_program_list = example.program_list
+                        gt_program_ast = example.program_ast_list_[0] \
+                            if example.program_ast_list_ else example.program
+                        hardness = spider_eval_tools.Evaluator().eval_hardness(
+                            gt_program_ast, db_dir=self.args.db_dir, db_name=example.db_name)
+                    elif example.dataset_id == WIKISQL:
+                        gt_program_list = example.program_ast_list_
                     else:
                         raise NotImplementedError
-                    num_preds = len(exp_output_strs)
-                    pred_decoded_list.append(exp_output_strs)
-                    pred_decoded_score_list.append(exp_output_scores[:num_preds])
-                    if verbose:
-                        predictions = zip(exp_output_strs, exp_output_scores, exp_seq_lens, exp_correct)
-                        is_error_case = self.print_predictions(batch_start_id + i, example, hardness, predictions, schema)
-                        if is_error_case:
-                            num_error_cases += 1
-                            print('Error Case {}'.format(num_error_cases))
-                            print()
-                            # if num_error_cases == 50:
-                            #     import sys
-                            #     sys.exit()
-                    if not pred_decoded_list[-1] and not self.args.demo:
-                        pred_decoded_list[-1].append(get_default_prediction(schema))
-                        pred_decoded_score_list[-1].append(-ops.HUGE_INT)
+                    if example.dataset_id == WIKISQL:
+                        hardness = 'easy'
+
+                outputs = post_process_beam(
+                    i, example, schema, decoded, table_po=table_po, field_po=field_po,
+                    gt_program_list=gt_program_list,
+                    candidates=(batch_candidates[i] if batch_candidates is not None else None),
+                    execution_check=(batch_execution_checks[i] if batch_execution_checks is not None else None))
+                if not outputs[0] and self.decoding_algorithm == 'adaptive' and \
+                        self.fast_beam_size < self.beam_size:
+                    fallback_ids.append(i)
+                batch_outputs.append((schema, gt_program_list, hardness, table_po, field_po, outputs))
+
+            if fallback_ids:
+                # The examples without a valid prediction are re-decoded together with the full beam
+                fallback_batch, fallback_decoded, _ = decode([mini_batch[i] for i in fallback_ids])
+                for j, i in enumerate(fallback_ids):
+                    schema, gt_program_list, hardness, table_po, field_po, _ = batch_outputs[i]
+                    if self.args.use_oracle_tables and self.args.num_random_tables_added > 0:
+                        table_po, field_po = fallback_batch[-1][j]
+                    outputs = post_process_beam(
+                        j, mini_batch[i], schema, fallback_decoded, table_po=table_po, field_po=field_po,
+                        gt_program_list=gt_program_list)
+                    batch_outputs[i] = (schema, gt_program_list, hardness, table_po, field_po, outputs)
+                num_fallback_cases += len(fallback_ids)
+                # The top beams of the re-decoded examples replace their first pass beams in the output tensors
+                preds, pred_scores, batch_beam_size = decoded[0], decoded[1], decoded[-1]
+                fallback_preds, fallback_pred_scores, fallback_beam_size = \
+                    fallback_decoded[0], fallback_decoded[1], fallback_decoded[-1]
+                fallback_index = {i: j for j, i in enumerate(fallback_ids)}
+                pred_rows, pred_score_rows = [], []
+                for i in range(len(mini_batch)):
+                    if i in fallback_index:
+                        start = fallback_index[i] * fallback_beam_size
+                        pred_rows.append(fallback_preds[start:start + batch_beam_size])
+                        pred_score_rows.append(fallback_pred_scores[start:start + batch_beam_size])
+                    else:
+                        pred_rows.append(preds[i * batch_beam_size:(i + 1) * batch_beam_size])
+                        pred_score_rows.append(pred_scores[i * batch_beam_size:(i + 1) * batch_beam_size])
+                batch_id = batch_start_id // self.dev_batch_size
+                pred_list[batch_id] = ops.pad_and_cat(pred_rows, self.out_vocab.pad_id)
+                pred_score_list[batch_id] = torch.cat(pred_score_rows)
+
+            for i, (schema, _, hardness, _, _, outputs) in enumerate(batch_outputs):
+                exp_output_strs, exp_output_scores, exp_seq_lens, exp_correct = outputs
+                num_preds = len(exp_output_strs)
+                pred_decoded_list.append(exp_output_strs)
+                pred_decoded_score_list.append(exp_output_scores[:num_preds])
+                if verbose:
+                    predictions = zip(exp_output_strs, exp_output_scores, exp_seq_lens, exp_correct)
+                    is_error_case = self.print_predictions(
+                        batch_start_id + i, mini_batch[i], hardness, predictions, schema)
+                    if is_error_case:
+                        num_error_cases += 1
+                        print('Error Case {}'.format(num_error_cases))
+                        print()
+                        # if num_error_cases == 50:
+                        #     import sys
+                        #     sys.exit()
+                if not pred_decoded_list[-1] and not self.args.demo:
+                    pred_decoded_list[-1].append(get_default_prediction(schema))
+                    pred_decoded_score_list[-1].append(-ops.HUGE_INT)
+
+        if self.decoding_algorithm not in DECODING_ALGORITHMS:
+            raise NotImplementedError
+        # The adaptive decoder runs a small beam first and re-decodes the examples without a valid prediction with
+        # the full beam
+        beam_size = self.fast_beam_size if self.decoding_algorithm == 'adaptive' else None
+        num_error_cases, num_fallback_cases = 0, 0
+        # The beam search outputs of a mini-batch are post-processed by the workers while the next mini-batch is
+        # decoded, pending holds the mini-batch submitted last
+        post_processor, pending = None, None
+        if (decode_str_output or verbose) and not self.save_vis:
+            post_processor = self.start_post_processor()
+        stop_at_first_valid = self.args.first_valid_prediction_only and not self.args.execution_guided_decoding
+        execution_checker = None
+        if self.args.execution_guided_decoding and (decode_str_output or verbose):
+            assert(engine is not None)
+            execution_checker = ExecutionChecker(engine, num_workers=self.args.num_execution_workers,
+                                                 timeout=self.args.execution_timeout,
+                                                 max_rows=self.args.execution_max_rows)
+        try:
+            for batch_start_id in tqdm(range(0, len(examples), self.dev_batch_size)):
+                mini_batch = examples[batch_start_id:batch_start_id + self.dev_batch_size]
+                formatted_batch, decoded, confusion_spans = decode(mini_batch, beam_size=beam_size)
+                if confusion_spans is not None:
+                    confusion_span_list.extend(confusion_spans)
+                preds, pred_scores = decoded[:2]
+
+                pred_list.append(preds)
+                pred_score_list.append(pred_scores)
+                if decode_str_output or verbose:
+                    if post_processor is None:
+                        with tracing.span('post_processing'):
+                            post_process_batch(batch_start_id, mini_batch, formatted_batch, decoded)
+                        continue
+                    preds_cpu, batch_beam_size = preds.cpu(), decoded[-1]
+                    tasks = [(example,
+                              preds_cpu[i * batch_beam_size:(i + 1) * batch_beam_size],
+                              *get_schema_perceived_order(formatted_batch, i),
+                              stop_at_first_valid) for i, example in enumerate(mini_batch)]
+                    if pending is not None:
+                        with tracing.span('post_processing'):
+                            post_process_batch(*pending[:-1], batch_candidates=pending[-1].get())
+                    pending = (batch_start_id, mini_batch, formatted_batch, decoded,
+                               post_processor.submit(tasks, **post_process_kwargs))
+            if pending is not None:
+                with tracing.span('post_processing'):
+                    post_process_batch(*pending[:-1], batch_candidates=pending[-1].get())
+        finally:
+            if execution_checker is not None:
+                execution_checker.close()
+        if self.decoding_algorithm == 'adaptive':
+            print('{}/{} examples re-decoded with beam size {}'.format(
+                num_fallback_cases, len(examples), self.beam_size))
 
         out_dict = dict()
         out_dict['preds'] = ops.pad_and_cat(pred_list, self.out_vocab.pad_id)
@@ -286,6 +493,8 @@ class EncoderDecoderLFramework(LFramework):
             out_dict['pred_decoded_scores'] = pred_decoded_score_list
         if restore_clause_order:
             out_dict['pred_restored_cache'] = pred_restored_cache
+        if confusion_span_list:
+            out_dict['confusion_spans'] = confusion_span_list
 
         if self.save_vis:
             vis_dict = dict()
@@ -302,6 +511,8 @@ class EncoderDecoderLFramework(LFramework):
         return out_dict
 
     def format_batch(self, mini_batch):
+        # Allocate the input tensors directly on the device of the model
+        device = self.device
 
         def get_decoder_input_ids():
             if self.training:
@@ -309,7 +520,7 @@ class EncoderDecoderLFramework(LFramework):
                     X = [exp.program_singleton_field_input_ids for exp in mini_batch]
                 else:
                     X = [exp.program_input_ids for exp in mini_batch]
-                return ops.pad_batch(X, self.mdl.out_vocab.pad_id)
+                return ops.pad_batch(X, self.mdl.out_vocab.pad_id, device=device)
             else:
                 return None
 
@@ -335,7 +546,7 @@ class EncoderDecoderLFramework(LFramework):
             return encoder_attn_mask
 
         super().format_batch(mini_batch)
-        encoder_input_ids = ops.pad_batch([exp.text_ids for exp in mini_batch], self.mdl.in_vocab.pad_id)
+        encoder_input_ids = ops.pad_batch([exp.text_ids for exp in mini_batch], self.mdl.in_vocab.pad_id, device=device)
         decoder_input_ids = get_decoder_input_ids()
 
         table_samples = []
@@ -445,22 +656,23 @@ class EncoderDecoderLFramework(LFramework):
                     if self.args.read_picklist:
                         transformer_output_value_masks.append(exp.transformer_output_value_mask)
 
-            encoder_ptr_input_ids = ops.pad_batch(encoder_ptr_input_ids, self.mdl.in_vocab.pad_id)
-            encoder_ptr_value_ids = ops.pad_batch(encoder_ptr_value_ids, self.mdl.in_vocab.pad_id)
-            schema_memory_masks = ops.pad_batch(schema_memory_masks, pad_id=0) \
+            encoder_ptr_input_ids = ops.pad_batch(encoder_ptr_input_ids, self.mdl.in_vocab.pad_id, device=device)
+            encoder_ptr_value_ids = ops.pad_batch(encoder_ptr_value_ids, self.mdl.in_vocab.pad_id, device=device)
+            schema_memory_masks = ops.pad_batch(schema_memory_masks, pad_id=0, device=device) \
                 if (self.args.use_pred_tables and not self.training) else (None, None)
-            decoder_ptr_value_ids = ops.pad_batch(decoder_ptr_value_ids, self.mdl.out_vocab.pad_id) \
+            decoder_ptr_value_ids = ops.pad_batch(decoder_ptr_value_ids, self.mdl.out_vocab.pad_id, device=device) \
                 if self.training else None
-            primary_key_ids = ops.pad_batch(primary_key_ids, self.mdl.in_vocab.pad_id)
-            foreign_key_ids = ops.pad_batch(foreign_key_ids, self.mdl.in_vocab.pad_id)
-            field_type_ids = ops.pad_batch(field_type_ids, self.mdl.in_vocab.pad_id)
-            table_masks = ops.pad_batch(table_masks, pad_id=0)
-            transformer_output_value_masks = ops.pad_batch(transformer_output_value_masks, pad_id=0, dtype=torch.uint8) \
+            primary_key_ids = ops.pad_batch(primary_key_ids, self.mdl.in_vocab.pad_id, device=device)
+            foreign_key_ids = ops.pad_batch(foreign_key_ids, self.mdl.in_vocab.pad_id, device=device)
+            field_type_ids = ops.pad_batch(field_type_ids, self.mdl.in_vocab.pad_id, device=device)
+            table_masks = ops.pad_batch(table_masks, pad_id=0, device=device)
+            transformer_output_value_masks = ops.pad_batch(transformer_output_value_masks, pad_id=0, dtype=torch.uint8,
+                                                           device=device) \
                 if self.args.read_picklist else (None, None)
             if not self.training:
-                table_positions = ops.pad_batch(table_positions, pad_id=-1) \
+                table_positions = ops.pad_batch(table_positions, pad_id=-1, device=device) \
                     if self.args.process_sql_in_execution_order else (None, None)
-                table_field_scopes = ops.pad_batch_2D(table_field_scopes, pad_id=0) \
+                table_field_scopes = ops.pad_batch_2D(table_field_scopes, pad_id=0, device=device) \
                     if self.args.process_sql_in_execution_order else (None, None)
             graphs = None
             return encoder_input_ids, decoder_input_ids, encoder_ptr_input_ids, encoder_ptr_value_ids, \
@@ -471,14 +683,57 @@ class EncoderDecoderLFramework(LFramework):
             encoder_ptr_input_ids = [exp.ptr_input_ids for exp in mini_batch]
             encoder_ptr_value_ids = [exp.ptr_value_ids for exp in mini_batch]
             decoder_ptr_value_ids = [exp.program_text_ptr_value_ids for exp in mini_batch]
-            encoder_ptr_input_ids = ops.pad_batch(encoder_ptr_input_ids, self.mdl.in_vocab.pad_id)
-            encoder_ptr_value_ids = ops.pad_batch(encoder_ptr_value_ids, self.mdl.in_vocab.pad_id)
-            decoder_ptr_value_ids = ops.pad_batch(decoder_ptr_value_ids, self.mdl.out_vocab.pad_id)
+            encoder_ptr_input_ids = ops.pad_batch(encoder_ptr_input_ids, self.mdl.in_vocab.pad_id, device=device)
+            encoder_ptr_value_ids = ops.pad_batch(encoder_ptr_value_ids, self.mdl.in_vocab.pad_id, device=device)
+            decoder_ptr_value_ids = ops.pad_batch(decoder_ptr_value_ids, self.mdl.out_vocab.pad_id, device=device)
             return encoder_input_ids, decoder_input_ids, encoder_ptr_input_ids, encoder_ptr_value_ids, \
                    decoder_ptr_value_ids
         else:
             raise NotImplementedError
 
+    def post_process_beam_search_outputs(self, example_id, example, preds, beam_size, schema, text_ptr_weights=None,
+                                         p_pointers=None, table_po=None, field_po=None, restore_clause_order=False,
+                                         pred_restored_cache=None, check_schema_consistency_=True, verbose=False):
+        """
+        Convert the beam search outputs of an example to SQL queries and check their syntax and schema consistency,
+        one beam at a time.
+        :param pred_restored_cache: RestoredSQLCache of the restored queries. If set to None, the restorations are
+            not cached.
+        :return: generator of (j, post_processed_output, pred_sql) of the j-th beam, where pred_sql is None if the
+            output failed the checks.
+        """
+        db_name = example.db_name
+        for j in range(beam_size):
+            beam_id = example_id * beam_size + j
+            post_processed_output = self.post_process_nn_output(
+                beam_id, example.dataset_id, example, preds, schema, text_ptr_weights, p_pointers,
+                table_po=table_po, field_po=field_po, verbose=verbose)
+            if post_processed_output:
+                pred_sql = post_processed_output[0]
+                # print('{}\t{}'.format(pred_sql, float(pred_scores[beam_id])))
+                if restore_clause_order:
+                    is_cached, restored_pred = pred_restored_cache.get(db_name, pred_sql) \
+                        if pred_restored_cache is not None else (False, None)
+                    if not is_cached:
+                        restored_pred = moz_sp.restore_clause_order(
+                            pred_sql, schema, check_schema_consistency_=check_schema_consistency_,
+                            verbose=verbose)
+                        if pred_restored_cache is not None:
+                            pred_restored_cache.put(db_name, pred_sql, restored_pred)
+                    if restored_pred:
+                        pred_sql = restored_pred
+                    else:
+                        pred_sql = None
+                else:
+                    if check_schema_consistency_:
+                        if not moz_sp.check_schema_consistency(
+                                pred_sql, schema,
+                                in_execution_order=self.args.process_sql_in_execution_order):
+                            pred_sql = None
+            else:
+                pred_sql = None
+            yield j, post_processed_output, pred_sql
+
     def post_process_nn_output(self, idx, dataset_id, example, decoder_outputs, schema=None,
                                text_ptr_weights=None, p_pointers=None, table_po=None, field_po=None, verbose=False):
         decoder_output = ops.var_to_numpy(decoder_outputs[idx])
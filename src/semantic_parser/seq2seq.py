@@ -12,7 +12,7 @@ import torch.nn as nn
 
 from src.semantic_parser.decoding_algorithms import beam_search
 from src.common.nn_modules import WeightDropoutLSTM, LSTMWithPacking, \
-    MultiHead, AttentionDotProduct, ConcatAndProject
+    MultiHead, AttentionDotProduct, ConcatAndProject, beam_attention
 import src.common.ops as ops
 from src.semantic_parser.decoder import Decoder
 from src.semantic_parser.encoder_decoder import EncoderDecoder
@@ -108,7 +108,7 @@ class RNNEncoder(nn.Module):
         :return c: [num_layers*num_directions, batch_size, hidden_size]
         """
         if input_masks is None:
-            input_masks = ops.int_zeros_var_cuda([inputs.size(0), inputs.size(1)])
+            input_masks = ops.int_zeros_var([inputs.size(0), inputs.size(1)], device=inputs.device)
         max_seq_len = input_masks.size(1)
         input_sizes = max_seq_len - torch.sum(input_masks, dim=1).long()
         outputs, (h, c) = self.rnn(inputs, input_sizes.cpu())
@@ -152,8 +152,10 @@ class RNNDecoder(Decoder):
         :param hidden: (h, c)
             h - [num_layers, batch_size, hidden_dim]
             c - [num_layers, batch_size, hidden_dim]
-        :param encoder_hiddens: [batch_size, input_seq_len, hidden_dim]
-        :param encoder_masks: [batch_size, input_seq_len]
+        :param encoder_hiddens: [encoder_batch_size, input_seq_len, hidden_dim]
+            During beam search, the encoder outputs are shared by the beam_size hypotheses of each example, i.e.
+            batch_size = encoder_batch_size * beam_size.
+        :param encoder_masks: [encoder_batch_size, input_seq_len]
         :return outputs: [batch_size, seq_len(=1), output_vocab_size]
         :return hidden: updated decoder hidden state
         :return attn_weights: [batch_size, num_head, seq_len(=1), encoder_seq_len]
@@ -167,7 +169,7 @@ class RNNDecoder(Decoder):
             if self.training and self.return_hiddens:
                 hiddens.append(hidden)
             # [batch_size, 1, hidden_dim], [batch_size, num_head, seq_len(=1), encoder_seq_len]
-            attn_vec, attn_weights = self.attn(output, encoder_hiddens, encoder_hiddens, encoder_masks)
+            attn_vec, attn_weights = beam_attention(self.attn, output, encoder_hiddens, encoder_masks)
             # [batch_size, 1, hidden_dim]
             output = self.attn_combine(output, attn_vec)
             # [batch_size, 1, output_vocab_size]
@@ -9,7 +9,7 @@
 
 import torch
 
-from src.common.nn_modules import PointerSwitch, selective_read
+from src.common.nn_modules import PointerSwitch, selective_read, beam_attention, beam_scatter_add
 import src.common.ops as ops
 from src.semantic_parser.decoding_algorithms import beam_search
 from src.semantic_parser.seq2seq import Seq2Seq, RNNEncoder, RNNDecoder
@@ -100,12 +100,14 @@ class PointerGeneratorDecoder(RNNDecoder):
         :param hidden: (h, c)
             h - [num_layers, batch_size, hidden_dim]
             c - [num_layers, batch_size, hidden_dim]
-        :param encoder_hiddens: [batch_size, encoder_seq_len, hidden_dim]
-        :param encoder_hidden_masks: [batch_size, encoder_seq_len]
+        :param encoder_hiddens: [encoder_batch_size, encoder_seq_len, hidden_dim]
+            During beam search, the encoder outputs are shared by the beam_size hypotheses of each example, i.e.
+            batch_size = encoder_batch_size * beam_size.
+        :param encoder_hidden_masks: [encoder_batch_size, encoder_seq_len]
         :param pointer_context
             p_pointer - [batch_size, seq_len(=1), 1]
             attn_weights - [batch_size, seq_len(=1), attn_value_dim]
-        :param encoder_ptr_value_ids: [batch_size, encoder_seq_len]
+        :param encoder_ptr_value_ids: [encoder_batch_size, encoder_seq_len]
             Mapping element in the memory to the pointing-generating vocabulary. If None, the pointing and generating
             vocabularies do not overlap.
         :param decoder_ptr_value_ids: [batch_size, decoder_seq_len]
@@ -126,8 +128,9 @@ class PointerGeneratorDecoder(RNNDecoder):
         if pointer_context:
             p_pointer, attn_weights = pointer_context
         else:
-            p_pointer = ops.zeros_var_cuda([batch_size, 1, 1])
-            attn_weights = ops.zeros_var_cuda([batch_size, self.attn.num_heads, 1, encoder_hiddens.size(1)])
+            p_pointer = ops.zeros_var([batch_size, 1, 1], device=encoder_hiddens.device)
+            attn_weights = ops.zeros_var([batch_size, self.attn.num_heads, 1, encoder_hiddens.size(1)],
+                                         device=encoder_hiddens.device)
 
         outputs, hiddens = [], []
         seq_attn_weights = []
@@ -138,7 +141,7 @@ class PointerGeneratorDecoder(RNNDecoder):
             # compute selective read
             if self.training and decoder_ptr_value_ids is not None:
                 if i == 0:
-                    last_output = ops.int_fill_var_cuda([batch_size, 1], self.vocab.start_id)
+                    last_output = ops.int_fill_var([batch_size, 1], self.vocab.start_id, device=encoder_hiddens.device)
                 else:
                     last_output = decoder_ptr_value_ids[:, i:i+1]
             else:
@@ -154,7 +157,7 @@ class PointerGeneratorDecoder(RNNDecoder):
                 hiddens.append(hidden)
             # a) compute attention vector and attention weights
             # [batch_size, 1, attn_value_dim], [batch_size, num_head, 1, encoder_seq_len]
-            attn_vec, attn_weights = self.attn(output, encoder_hiddens, encoder_hiddens, encoder_hidden_masks)
+            attn_vec, attn_weights = beam_attention(self.attn, output, encoder_hiddens, encoder_hidden_masks)
             # b) compute pointer-generator switch
             # [batch_size, 1, 1]
             p_pointer = self.pointer_switch(output, attn_vec)
@@ -169,11 +172,11 @@ class PointerGeneratorDecoder(RNNDecoder):
                 point_gen_prob = torch.cat([(1 - p_pointer) * torch.exp(gen_logit),
                                             p_pointer * self.merge_multi_head_attention(attn_weights)], dim=2)
             else:
-                gen_prob_zeros_pad = ops.zeros_var_cuda((batch_size, 1, encoder_ptr_value_ids.size(1)))
+                gen_prob_zeros_pad = ops.zeros_var((batch_size, 1, encoder_ptr_value_ids.size(1)),
+                                                   device=encoder_hiddens.device)
                 weighted_gen_prob = torch.cat([(1 - p_pointer) * torch.exp(gen_logit), gen_prob_zeros_pad], dim=2)
                 weighted_point_prob = p_pointer * self.merge_multi_head_attention(attn_weights)
-                point_gen_prob = weighted_gen_prob.scatter_add_(
-                    dim=2, index=encoder_ptr_value_ids.unsqueeze(1), src=weighted_point_prob)
+                point_gen_prob = beam_scatter_add(weighted_gen_prob, encoder_ptr_value_ids, weighted_point_prob)
             point_gen_logit = ops.safe_log(point_gen_prob)
 
             outputs.append(point_gen_logit)
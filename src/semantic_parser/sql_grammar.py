@@ -0,0 +1,210 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Incremental SQL grammar constraints for beam search.
+"""
+
+import torch
+
+import src.common.ops as ops
+
+# Categories of the output tokens
+OTHER = 0
+LEFT_PAREN = 1
+RIGHT_PAREN = 2
+QUOTE = 3
+CLAUSE = 4
+SET_OP = 5
+JOIN = 6
+ON = 7
+TABLE = 8
+FIELD = 9
+VALUE = 10
+EOS = 11
+NUM_CATEGORIES = 12
+
+# Tokens that cannot be followed by the end of the query
+OPEN_CATEGORIES = [LEFT_PAREN, CLAUSE, SET_OP, JOIN, ON]
+
+clauses = ['select', 'from', 'where', 'group by', 'having', 'order by', 'limit']
+clauses_in_execution_order = ['from', 'where', 'group by', 'having', 'select', 'order by', 'limit']
+# The revtok vocabulary splits "group by" and "order by"
+clause_aliases = {
+    'group': 'group by',
+    'order': 'order by'
+}
+
+token_categories = {
+    '(': LEFT_PAREN,
+    ')': RIGHT_PAREN,
+    '"': QUOTE,
+    'union': SET_OP,
+    'intersect': SET_OP,
+    'except': SET_OP,
+    'join': JOIN,
+    'on': ON
+}
+
+
+class SQLGrammar(object):
+    """
+    Token-level SQL grammar used to prune invalid continuations during beam search.
+
+    The grammar tracks for each hypothesis the parentheses nesting depth and, for each nesting level, the last SQL
+    clause, whether the query at the level has a SELECT clause and whether the FROM clause reached its join
+    conditions. It only rules out continuations that are invalid in every query:
+        - clauses out of order or repeated in a query
+        - unbalanced parentheses
+        - tables outside the FROM clause, fields and values in the FROM clause (except in join conditions)
+        - ending the output in a nested query, before the SELECT clause or after an incomplete clause
+    The tokens in quoted values are not constrained.
+    """
+    def __init__(self, vocab, in_execution_order=False, max_depth=8):
+        self.vocab = vocab
+        self.max_depth = max_depth
+        clause_order = clauses_in_execution_order if in_execution_order else clauses
+        self.from_rank = clause_order.index('from') + 1
+        self.select_rank = clause_order.index('select') + 1
+
+        category = [OTHER for _ in range(vocab.size)]
+        clause_rank = [0 for _ in range(vocab.size)]
+        for idx in range(vocab.size):
+            token = vocab.to_token(idx).strip().lower()
+            token = clause_aliases.get(token, token)
+            if token in clause_order:
+                category[idx] = CLAUSE
+                clause_rank[idx] = clause_order.index(token) + 1
+            elif token in token_categories:
+                category[idx] = token_categories[token]
+        category[vocab.table_id] = TABLE
+        category[vocab.field_id] = FIELD
+        category[vocab.value_id] = VALUE
+        category[vocab.eos_id] = EOS
+        self.token_category = category
+        self.clause_rank = clause_rank
+        self.tables = dict()
+
+    def get_tables(self, device):
+        """
+        :return token_category: [vocab_size] category of each output token.
+        :return clause_rank: [vocab_size] position of each clause keyword in a query, 0 for the other tokens.
+        """
+        if device not in self.tables:
+            self.tables[device] = (ops.long_var(self.token_category, device=device),
+                                   ops.long_var(self.clause_rank, device=device))
+        return self.tables[device]
+
+    def init_state(self, num_rows, memory_inputs):
+        """
+        :param memory_inputs: [batch_size, memory_size] table, field or value token of each memory entry.
+        """
+        return SQLGrammarState(self, num_rows, memory_inputs)
+
+
+class SQLGrammarState(object):
+    """
+    Grammar states of a batch of hypotheses.
+    """
+    def __init__(self, grammar, num_rows, memory_inputs):
+        self.grammar = grammar
+        device = memory_inputs.device
+        self.token_category, self.clause_rank = grammar.get_tables(device)
+        # [batch_size, memory_size]
+        self.memory_category = self.token_category[memory_inputs]
+        # [num_rows]
+        self.depth = ops.int_zeros_var([num_rows], device=device)
+        self.quote = ops.byte_zeros_var([num_rows], device=device).bool()
+        self.last_category = ops.int_fill_var([num_rows], OTHER, device=device)
+        # [num_rows, max_depth]
+        self.clause = ops.int_zeros_var([num_rows, grammar.max_depth], device=device)
+        self.select = ops.byte_zeros_var([num_rows, grammar.max_depth], device=device).bool()
+        self.join_condition = ops.byte_zeros_var([num_rows, grammar.max_depth], device=device).bool()
+
+    def index_select(self, rows):
+        """
+        :param rows: [num_rows] hypothesis from which each new hypothesis is extended.
+        """
+        for name in ['depth', 'quote', 'last_category', 'clause', 'select', 'join_condition']:
+            setattr(self, name, torch.index_select(getattr(self, name), 0, rows))
+        return self
+
+    def select_examples(self, examples):
+        """
+        :param examples: examples kept in the batch.
+        """
+        self.memory_category = torch.index_select(self.memory_category, 0, examples)
+        return self
+
+    def update(self, tokens):
+        """
+        :param tokens: [num_rows] last output of each hypothesis, where the copied memory entries are replaced by
+            their table, field or value token.
+        """
+        category = self.token_category[tokens]
+        rank = self.clause_rank[tokens]
+        rows = ops.arange_var(tokens.size(0), device=tokens.device)
+        level = self.depth.clamp(max=self.grammar.max_depth - 1)
+        outside_quote = ~self.quote
+
+        clause, select, join_condition = \
+            self.clause[rows, level], self.select[rows, level], self.join_condition[rows, level]
+        is_clause = outside_quote & (category == CLAUSE)
+        clause = torch.where(is_clause, rank, clause)
+        select = select | (is_clause & (rank == self.grammar.select_rank))
+        join_condition = (join_condition | (outside_quote & (category == ON))) & \
+                         ~(is_clause | (outside_quote & (category == JOIN)))
+        # a set operator starts a new query at the same level
+        is_set_op = outside_quote & (category == SET_OP)
+        clause = clause * (~is_set_op).long()
+        select = select & ~is_set_op
+        self.clause[rows, level], self.select[rows, level], self.join_condition[rows, level] = \
+            clause, select, join_condition
+
+        # a left parenthesis starts a new level
+        is_left_paren = outside_quote & (category == LEFT_PAREN)
+        next_level = (self.depth + 1).clamp(max=self.grammar.max_depth - 1)
+        self.clause[rows, next_level] = self.clause[rows, next_level] * (~is_left_paren).long()
+        self.select[rows, next_level] = self.select[rows, next_level] & ~is_left_paren
+        self.join_condition[rows, next_level] = self.join_condition[rows, next_level] & ~is_left_paren
+        is_right_paren = outside_quote & (category == RIGHT_PAREN) & (self.depth > 0)
+        self.depth = self.depth + is_left_paren.long() - is_right_paren.long()
+
+        self.quote = self.quote ^ (category == QUOTE)
+        self.last_category = category
+
+    def get_masks(self):
+        """
+        :return vocab_masks: [num_rows, vocab_size] binary mask in which the output tokens allowed as the next token
+            are set to 1.
+        :return memory_masks: [num_rows, memory_size] binary mask in which the memory entries allowed as the next token
+            are set to 1.
+        """
+        num_rows = self.depth.size(0)
+        batch_size, memory_size = self.memory_category.size()
+        rows = ops.arange_var(num_rows, device=self.depth.device)
+        level = self.depth.clamp(max=self.grammar.max_depth - 1)
+        clause = self.clause[rows, level]
+        in_from = (clause == self.grammar.from_rank) & ~self.join_condition[rows, level]
+        last_open = torch.zeros_like(self.quote)
+        for c in OPEN_CATEGORIES:
+            last_open = last_open | (self.last_category == c)
+
+        # [num_rows, num_categories]
+        allowed = ops.byte_ones_var([num_rows, NUM_CATEGORIES], device=self.depth.device).bool()
+        allowed[:, RIGHT_PAREN] = self.depth > 0
+        allowed[:, TABLE] = in_from
+        allowed[:, FIELD] = ~in_from
+        allowed[:, VALUE] = ~in_from
+        allowed[:, EOS] = (self.depth == 0) & self.select[:, 0] & ~last_open
+        allowed = allowed | self.quote.unsqueeze(1)
+
+        vocab_masks = allowed[:, self.token_category]
+        clause_order_masks = (self.clause_rank.unsqueeze(0) > clause.unsqueeze(1)) | (self.clause_rank == 0)
+        vocab_masks = vocab_masks & (clause_order_masks | self.quote.unsqueeze(1))
+        # the memory is shared by the hypotheses of each example
+        memory_masks = torch.gather(allowed.view(batch_size, -1, NUM_CATEGORIES), 2,
+                                    self.memory_category.unsqueeze(1).expand(-1, int(num_rows / batch_size), -1))
+        return vocab_masks, memory_masks.view(num_rows, memory_size)
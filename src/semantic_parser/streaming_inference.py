@@ -0,0 +1,185 @@
+"""
+ Copyright (c) 2020, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Streaming batch inference over large question files.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import src.data_processor.processor_utils as data_utils
+from src.data_processor.processors.data_processor_spider import preprocess_example
+
+# State of the preprocessing worker processes, inherited from the inference process when the workers are forked
+worker_args = None
+worker_schema_graphs = None
+worker_vocabs = None
+worker_tokenizers = None
+
+
+def read_questions(in_jsonl, offset=0):
+    """
+    Read the questions of a JSONL file lazily.
+    :param offset: Byte offset in the file of the first question read.
+    :return: Generator of (offset of the next line, question) pairs, the question is a dictionary with the keys
+        "question" and "db_id" and optionally "id".
+    """
+    with open(in_jsonl, 'rb') as f:
+        f.seek(offset)
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            if line.strip():
+                yield offset, json.loads(line.decode('utf-8'))
+
+
+def preprocess_question(question):
+    """
+    Preprocess a question in a worker process (or in the inference process if there are no workers).
+    :return: (example, error) where error is None if the question is preprocessed.
+    """
+    text_tokenize, program_tokenize, post_process, tu = worker_tokenizers
+    db_name = question['db_id']
+    if db_name not in worker_schema_graphs.db_index:
+        return None, 'unknown database {}'.format(db_name)
+    schema_graph = worker_schema_graphs[db_name]
+    example = data_utils.Text2SQLExample(data_utils.OTHERS, db_name, db_id=worker_schema_graphs.get_db_id(db_name))
+    example.text = question['question']
+    try:
+        preprocess_example('test', example, worker_args, {}, text_tokenize, program_tokenize, post_process, tu,
+                           schema_graph, worker_vocabs)
+    except Exception as e:
+        return None, 'preprocessing failed: {}'.format(repr(e))
+    finally:
+        # the picklist matches are cached by question and are not reused by the other questions of the stream
+        schema_graph.question_field_match_cache.clear()
+    return example, None
+
+
+def get_input_length(example):
+    return len(example.ptr_input_ids) if example.ptr_input_ids is not None else len(example.text_ids)
+
+
+class StreamingInference(object):
+    """
+    Translate the questions of a JSONL file in chunks of chunk_size questions and append the predictions to a JSONL
+    file, so that the memory use does not grow with the number of questions.
+
+    The questions of a chunk are preprocessed by a pool of worker processes while the previous chunk is decoded.
+    Within a chunk, the questions are sorted by input length before they are split into mini-batches, so that the
+    questions of a mini-batch have similar lengths and little padding. The predictions of a chunk are written in the
+    order of the questions.
+
+    After each chunk, the output file is flushed and the progress (offsets in the input and output files) is saved
+    to a checkpoint file next to it. A job that was interrupted resumes after the last chunk written.
+    """
+    def __init__(self, sp, schema_graphs, vocabs, tokenizers, chunk_size=1000, num_workers=0, **inference_kwargs):
+        """
+        :param sp: EncoderDecoderLFramework used for inference.
+        :param schema_graphs: Lexicalized SchemaGraphs of the databases of the questions.
+        :param vocabs: Vocabularies of the semantic parser.
+        :param tokenizers: Output of tok.get_tokenizers.
+        :param chunk_size: Number of questions preprocessed and decoded together.
+        :param num_workers: Number of preprocessing worker processes; 0 preprocesses in the inference process.
+        :param inference_kwargs: Keyword arguments passed to sp.inference.
+        """
+        global worker_args, worker_schema_graphs, worker_vocabs, worker_tokenizers
+        worker_args, worker_schema_graphs, worker_vocabs, worker_tokenizers = \
+            sp.args, schema_graphs, vocabs, tokenizers
+        self.sp = sp
+        self.chunk_size = chunk_size
+        self.inference_kwargs = inference_kwargs
+        self.pool = multiprocessing.get_context('fork').Pool(num_workers) if num_workers > 0 else None
+
+    def preprocess(self, questions):
+        """
+        :return: AsyncResult of the list of preprocessed questions if the questions are preprocessed by the workers,
+            the list otherwise.
+        """
+        if self.pool is None:
+            return [preprocess_question(question) for question in questions]
+        return self.pool.map_async(preprocess_question, questions, chunksize=16)
+
+    def translate(self, questions, preprocessed):
+        """
+        :return: Predictions of the questions, in the order of the questions.
+        """
+        outputs = [{'id': question.get('id', None), 'db_id': question['db_id'], 'sql': None}
+                   for question in questions]
+        example_ids = []
+        for i, (example, error) in enumerate(preprocessed):
+            if error is None:
+                example_ids.append(i)
+            else:
+                outputs[i]['error'] = error
+        # length bucketing: consecutive mini-batches of sp.inference hold questions of similar lengths
+        example_ids.sort(key=lambda i: get_input_length(preprocessed[i][0]))
+        if example_ids:
+            out_dict = self.sp.inference([preprocessed[i][0] for i in example_ids], **self.inference_kwargs)
+            for i, pred_decoded, pred_decoded_scores in \
+                    zip(example_ids, out_dict['pred_decoded'], out_dict['pred_decoded_scores']):
+                if pred_decoded:
+                    outputs[i]['sql'] = pred_decoded[0]
+                    outputs[i]['score'] = float(pred_decoded_scores[0])
+        return outputs
+
+    def run(self, in_jsonl, out_jsonl):
+        checkpoint_path = out_jsonl + '.checkpoint'
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            print('resuming after {} questions'.format(checkpoint['num_questions']))
+        else:
+            checkpoint = {'input_offset': 0, 'output_offset': 0, 'num_questions': 0}
+        questions = read_questions(in_jsonl, offset=checkpoint['input_offset'])
+
+        def next_chunk():
+            chunk = list(itertools.islice(questions, self.chunk_size))
+            if not chunk:
+                return None
+            offsets, chunk = zip(*chunk)
+            return offsets[-1], chunk, self.preprocess(chunk)
+
+        start_time = time.time()
+        num_questions = 0
+        with open(out_jsonl, 'ab') as o_f:
+            # the predictions written after the last checkpoint are discarded
+            o_f.truncate(checkpoint['output_offset'])
+            pending = next_chunk()
+            while pending is not None:
+                input_offset, chunk, preprocessed = pending
+                if self.pool is not None:
+                    preprocessed = preprocessed.get()
+                # the next chunk is preprocessed while the current one is decoded
+                pending = next_chunk()
+                for output in self.translate(chunk, preprocessed):
+                    o_f.write('{}\n'.format(json.dumps(output)).encode('utf-8'))
+                o_f.flush()
+                os.fsync(o_f.fileno())
+                num_questions += len(chunk)
+                checkpoint = {
+                    'input_offset': input_offset,
+                    'output_offset': o_f.tell(),
+                    'num_questions': checkpoint['num_questions'] + len(chunk)
+                }
+                with open(checkpoint_path + '.tmp', 'w') as c_f:
+                    json.dump(checkpoint, c_f)
+                os.replace(checkpoint_path + '.tmp', checkpoint_path)
+                print('{} questions translated ({:.1f} questions/s)'.format(
+                    checkpoint['num_questions'], num_questions / (time.time() - start_time)))
+        print('Model predictions saved to {}'.format(out_jsonl))
+
+    def close(self):
+        global worker_args, worker_schema_graphs, worker_vocabs, worker_tokenizers
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        worker_args, worker_schema_graphs, worker_vocabs, worker_tokenizers = None, None, None, None
@@ -6,6 +6,7 @@
 
  Codalab leaderboard submission.
 """
+import src.common.ops as ops
 import src.data_processor.data_loader as data_loader
 from src.data_processor.processors.data_processor_spider import preprocess_example
 from src.data_processor.path_utils import get_checkpoint_path
@@ -19,13 +20,10 @@ import src.utils.utils as utils
 from src.parse_args import args
 
 import torch
-if not args.data_parallel:
-    torch.cuda.set_device(args.gpu)
+device = ops.setup_device(args)
 torch.manual_seed(args.seed)
 torch.cuda.manual_seed_all(args.seed)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
 # Set model ID
 if args.predict_tables:
     args.model = args.model + '.pt'
@@ -81,7 +79,7 @@ def run_inference(args):
     else:
         raise NotImplementedError
 
-    sp.cuda()
+    sp.to(device)
 
     with torch.set_grad_enabled(False):
         inference(sp)
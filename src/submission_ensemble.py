@@ -6,25 +6,24 @@
 
  Codalab leaderboard submission.
 """
+import src.common.ops as ops
 import src.data_processor.data_loader as data_loader
 from src.data_processor.processors.data_processor_spider import preprocess_example
 import src.data_processor.schema_loader as schema_loader
 from src.data_processor.sql.sql_reserved_tokens import sql_reserved_tokens, sql_reserved_tokens_revtok
 import src.data_processor.tokenizers as tok
 from src.data_processor.vocab_utils import functional_token_index, Vocabulary
+from src.semantic_parser.ensemble import EnsembleRuntime
 from src.semantic_parser.learn_framework import EncoderDecoderLFramework
 import src.utils.utils as utils
 
 from src.parse_args import args
 
 import torch
-if not args.data_parallel:
-    torch.cuda.set_device(args.gpu)
+device = ops.setup_device(args)
 torch.manual_seed(args.seed)
 torch.cuda.manual_seed_all(args.seed)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
 # Set model ID
 if args.predict_tables:
     args.model = args.model + '.pt'
@@ -63,14 +62,14 @@ def ensemble():
     for i, checkpoint_path in enumerate(checkpoint_paths):
         sps[i].schema_graphs = schema_graphs
         sps[i].load_checkpoint(checkpoint_path)
-        sps[i].cuda()
+        sps[i].to(device)
         sps[i].eval()
 
     out_dict = sps[0].inference(examples,
                                 restore_clause_order=args.process_sql_in_execution_order,
                                 check_schema_consistency_=args.sql_consistency_check,
                                 inline_eval=False,
-                                model_ensemble=[sp.mdl for sp in sps],
+                                model_ensemble=EnsembleRuntime([sp.mdl for sp in sps]),
                                 verbose=False)
 
     assert(sps[0].args.prediction_path is not None)
@@ -64,6 +64,8 @@ parser.add_argument('--xavier_initialization', type=bool, default=True,
                     help='Initialize all model parameters using xavier initialization (default: True)')
 
 parser.add_argument('--gpu', type=int, default=0, help='gpu device (default: 0)')
+parser.add_argument('--cpu', action='store_true',
+                    help='If set, run on the CPU even if a GPU is available (default: False)')
 parser.add_argument('--seed', type=int, default=543, metavar='S', help='random seed (default: 543)')
 
 args = ['--gpu', '0']
@@ -28,91 +28,64 @@ from src.trans_checker.args import args
 from src.utils.trans import bert_utils as bu
 import src.utils.utils as utils
 
-torch.cuda.set_device('cuda:{}'.format(args.gpu))
 torch.manual_seed(args.seed)
 torch.cuda.manual_seed_all(args.seed)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-
-class SpanExtractor(nn.Module):
-    def __init__(self, input_dim):
-        super().__init__()
-        self.start_pred = Linear(input_dim, 1)
-        self.end_pred = Linear(input_dim, 1)
-        self.log_softmax = nn.LogSoftmax(dim=-1)
-
-    def forward(self, encoder_hiddens, text_masks):
+class TranslatabilityChecker(nn.Module):
+    def __init__(self, args, shared_encoder_dim=None):
         """
-        :param encoder_hiddens: [batch_size, encoder_seq_len, hidden_dim]
-        :param text_masks: [batch_size, text_len + text_start_offset]
+        :param shared_encoder_dim: If set, the checker has no transformer encoder of its own and its span extractor
+            reads the transformer encoder outputs of a semantic parser, which are of this dimension.
         """
-        # [batch_size, encoder_seq_len]
-        start_potential = self.start_pred(encoder_hiddens).squeeze(2)
-        end_potential = self.end_pred(encoder_hiddens).squeeze(2)
-        start_logit = self.log_softmax(start_potential - text_masks * ops.HUGE_INT)
-        end_logit = self.log_softmax(end_potential - text_masks * ops.HUGE_INT)
-        return torch.cat([start_logit.unsqueeze(1), end_logit.unsqueeze(1)], dim=1)
-
-
-class TranslatabilityChecker(nn.Module):
-    def __init__(self, args):
         super().__init__()
         self.pretrained_transformer = args.pretrained_transformer
         self.pretrained_lm_dropout = args.pretrained_lm_dropout_rate
-        self.transformer_encoder = TransformerHiddens(self.pretrained_transformer, dropout=self.pretrained_lm_dropout,
-                                                      requires_grad=True)
-        self.encoder_hidden_dim = args.encoder_hidden_dim if args.encoder_hidden_dim > 0 else args.encoder_input_dim
+        if shared_encoder_dim is None:
+            self.transformer_encoder = TransformerHiddens(self.pretrained_transformer,
+                                                          dropout=self.pretrained_lm_dropout, requires_grad=True)
+            self.encoder_hidden_dim = \
+                args.encoder_hidden_dim if args.encoder_hidden_dim > 0 else args.encoder_input_dim
+        else:
+            self.transformer_encoder = None
+            self.encoder_hidden_dim = shared_encoder_dim
         self.span_extractor = SpanExtractor(self.encoder_hidden_dim)
 
-    def forward(self, input_ids, text_masks):
+    def forward(self, input_ids, text_masks, shared_encoder=None):
+        """
+        :param shared_encoder: Semantic parser model (Bridge) whose transformer encoder outputs are read by the span
+            extractor. The shared encoder is not updated.
+        """
         inputs, input_masks = input_ids
-        batch_size = len(inputs)
-        segment_ids, position_ids = self.get_segment_and_position_ids(inputs)
-        inputs_embedded, _ = self.transformer_encoder(inputs, input_masks,
-                                                      segments=segment_ids, position_ids=position_ids)
-        text_masks = torch.cat([ops.zeros_var_cuda([batch_size, 1]), text_masks.float()], dim=1)
-        text_embedded = inputs_embedded[:, :text_masks.size(1), :]
-        output = self.span_extractor(text_embedded, text_masks)
-        return output
-
-    def inference(self, dev_data):
+        if shared_encoder is not None:
+            with torch.no_grad():
+                inputs_embedded = shared_encoder.encode_transformer(inputs, input_masks)
+        else:
+            segment_ids, position_ids = self.get_segment_and_position_ids(inputs)
+            inputs_embedded, _ = self.transformer_encoder(inputs, input_masks,
+                                                          segments=segment_ids, position_ids=position_ids)
+        return self.span_extractor.extract(inputs_embedded, text_masks)
+
+    def inference(self, dev_data, shared_encoder=None):
         self.eval()
         batch_size = 32
+        device = next(self.parameters()).device
 
         output_spans = []
         for batch_start_id in tqdm(range(0, len(dev_data), batch_size)):
             mini_batch = dev_data[batch_start_id: batch_start_id + batch_size]
-            _, text_masks = ops.pad_batch([exp.text_ids for exp in mini_batch], bu.pad_id)
-            encoder_input_ids = ops.pad_batch([exp.ptr_input_ids for exp in mini_batch], bu.pad_id)
+            _, text_masks = ops.pad_batch([exp.text_ids for exp in mini_batch], bu.pad_id, device=device)
+            encoder_input_ids = ops.pad_batch([exp.ptr_input_ids for exp in mini_batch], bu.pad_id, device=device)
             # [batch_size, 2, encoder_seq_len]
-            output = self.forward(encoder_input_ids, text_masks)
-            encoder_seq_len = output.size(2)
-            # [batch_size, encoder_seq_len]
-            start_logit = output[:, 0, :]
-            end_logit = output[:, 1, :]
-            # [batch_size, encoder_seq_len, encoder_seq_len]
-            span_logit = start_logit.unsqueeze(2) + end_logit.unsqueeze(1)
-            valid_span_pos = ops.ones_var_cuda([batch_size, encoder_seq_len, encoder_seq_len]).triu()
-            span_logit = span_logit - (1 - valid_span_pos) * ops.HUGE_INT
-
-            for i in range(len(mini_batch)):
-                span_pos = span_logit[i].argmax()
-                start = int(span_pos / encoder_seq_len)
-                end = int(span_pos % encoder_seq_len)
-                output_spans.append((start, end))
-                # print(start, end)
-                # print(mini_batch[i].text)
-                # confusion_span_size = end - start + 1
-                # if start > 0 and confusion_span_size < 5:
-                #     print(mini_batch[i].text_tokens[start-1:end])
-                #     print()
+            output = self.forward(encoder_input_ids, text_masks, shared_encoder=shared_encoder)
+            output_spans.extend(SpanExtractor.get_spans(output))
 
         return output_spans
 
     def get_segment_and_position_ids(self, encoder_input_ids):
         batch_size, input_size = encoder_input_ids.size()
-        position_ids = ops.arange_cuda(input_size).unsqueeze(0).expand_as(encoder_input_ids)
+        position_ids = \
+            ops.arange_var(input_size, device=encoder_input_ids.device).unsqueeze(0).expand_as(encoder_input_ids)
         # [CLS] t1 t2 ... [SEP] ...
         # 0     0  0  ...  0    ...
         seg1_sizes = (encoder_input_ids == bu.sep_id).nonzero()[:, 1].view(batch_size, 2)[:, 0] + 1
@@ -124,7 +97,9 @@ class TranslatabilityChecker(nn.Module):
     def load_checkpoint(self, in_tar):
         if os.path.isfile(in_tar):
             print('=> loading checkpoint \'{}\''.format(in_tar))
-            checkpoint = torch.load(in_tar)
+            # the checkpoint is loaded on the CPU and moved to the device of the module, so that a checkpoint saved
+            # on a GPU can be loaded on a CPU-only host
+            checkpoint = torch.load(in_tar, map_location='cpu')
             self.load_state_dict(checkpoint['model_state_dict'])
         else:
             print('=> no checkpoint found at \'{}\''.format(in_tar))
@@ -158,14 +133,25 @@ def run_train():
         train(train_data, dev_data)
 
 
-def train(train_data, dev_data):
+def train(train_data, dev_data, shared_encoder=None, model_path=None):
+    """
+    :param shared_encoder: If set, train the span extractor on the frozen transformer encoder outputs of this
+        semantic parser model (Bridge) instead of a transformer encoder of its own.
+    :param model_path: Checkpoint path of the best model, model-best.tar in the model directory by default.
+    """
     # Model
-    model_dir = get_model_dir(args)
-    if not os.path.exists(model_dir):
-        os.mkdir(model_dir)
-
-    trans_checker = TranslatabilityChecker(args)
-    trans_checker.cuda()
+    if model_path is None:
+        model_dir = get_model_dir(args)
+        if not os.path.exists(model_dir):
+            os.mkdir(model_dir)
+        model_path = os.path.join(model_dir, 'model-best.tar')
+
+    if shared_encoder is not None:
+        shared_encoder.eval()
+        trans_checker = TranslatabilityChecker(args, shared_encoder_dim=shared_encoder.encoder_input_dim)
+    else:
+        trans_checker = TranslatabilityChecker(args)
+    trans_checker.to(ops.device)
     ops.initialize_module(trans_checker, 'xavier')
 
     wandb.init(project='translatability-prediction', name=get_wandb_tag(args))
@@ -204,7 +190,7 @@ def train(train_data, dev_data):
             _, text_masks = ops.pad_batch([exp.text_ids for exp in mini_batch], bu.pad_id)
             encoder_input_ids = ops.pad_batch([exp.ptr_input_ids for exp in mini_batch], bu.pad_id)
             target_span_ids, _ = ops.pad_batch([exp.span_ids for exp in mini_batch], bu.pad_id)
-            output = trans_checker(encoder_input_ids, text_masks)
+            output = trans_checker(encoder_input_ids, text_masks, shared_encoder=shared_encoder)
             loss = loss_fun(output, target_span_ids)
             loss.backward()
             epoch_losses.append(float(loss))
@@ -219,12 +205,11 @@ def train(train_data, dev_data):
             stdout_msg = 'Epoch {}: average training loss = {}'.format(epoch_id, np.mean(epoch_losses))
             print(stdout_msg)
             wandb.log({'cross_entropy_loss/{}'.format(args.dataset_name): np.mean(epoch_losses)})
-            pred_spans = trans_checker.inference(dev_data)
+            pred_spans = trans_checker.inference(dev_data, shared_encoder=shared_encoder)
             target_spans = [exp.span_ids for exp in dev_data]
             trans_acc = translatablity_eval(pred_spans, target_spans)
             print('Dev translatability accuracy = {}'.format(trans_acc))
             if trans_acc > best_dev_metrics:
-                model_path = os.path.join(model_dir, 'model-best.tar')
                 trans_checker.save_checkpoint(optimizer, lr_scheduler, model_path)
                 best_dev_metrics = trans_acc
 
@@ -249,7 +234,7 @@ def run_inference():
     model_path = os.path.join(model_dir, 'model-best.tar')
     trans_checker = TranslatabilityChecker(args)
     trans_checker.load_checkpoint(model_path)
-    trans_checker.cuda()
+    trans_checker.to(ops.device)
     trans_checker.eval()
 
     with torch.set_grad_enabled(False):
@@ -371,6 +356,7 @@ def get_wandb_tag(args):
 
 
 if __name__ == '__main__':
+    ops.setup_device(args)
     run_train()
     # run_inference()
 